@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-import argparse, os, sys
+import argparse, os, sys, subprocess, hashlib, tempfile, shutil
+import concurrent.futures
 from bsvAdd import create_machine_file
 from scripts.bsvInterfaceBuilder import create_interfaces, list_available_interfaces
 
@@ -30,10 +31,72 @@ def create_directories(path, test_dir):
         os.mkdir("{}/test".format(path))
     os.mkdir("{}/libraries".format(path))
 
-def create_libraries(path, lib_urls):
+def mirror_dir():
+    return os.getenv('BSV_MIRROR_DIR', os.path.expanduser('~/.cache/bsvtools/mirrors'))
+
+def repo_name(url):
+    name = os.path.basename(url.rstrip('/'))
+    return name[:-4] if name.endswith('.git') else name
+
+def mirror_path(url):
+    return os.path.join(mirror_dir(), "{}-{}.git".format(repo_name(url), hashlib.sha1(url.encode()).hexdigest()[:8]))
+
+def git(args):
+    """runs git quietly, returns the error output on failure"""
+    t = subprocess.run(["git"] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return None if t.returncode == 0 else t.stdout.decode(errors="replace").strip()
+
+def update_mirror(url, offline):
+    """creates or updates the bare mirror of url shared by all projects.
+    Returns the mirror path and an error or warning message."""
+    mirror = mirror_path(url)
+    if os.path.isdir(mirror):
+        if offline:
+            return mirror, None
+        error = git(["-C", mirror, "fetch", "--prune", "--quiet"])
+        return mirror, error and "Could not update mirror of {}, using the cached state: {}".format(url, error)
+    if offline:
+        return None, "No mirror of {} in {} (run once without --offline)".format(url, mirror_dir())
+    os.makedirs(mirror_dir(), exist_ok=True)
+    # Cloned under a temporary name, concurrent runs never see a partial mirror
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(mirror) + ".", dir=mirror_dir())
+    error = git(["clone", "--mirror", "--quiet", url, tmp])
+    if error:
+        shutil.rmtree(tmp, ignore_errors=True)
+        return None, "Could not clone {}: {}".format(url, error)
+    try:
+        os.rename(tmp, mirror)
+    except OSError:
+        # Another run created the mirror in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+    return mirror, None
+
+def fetch_library(path, url, offline, use_mirror):
+    """clones url into the libraries of the project, returns (ok, message)"""
+    dest = os.path.join(path, "libraries", repo_name(url))
+    if not use_mirror:
+        error = git(["clone", "--quiet", url, dest])
+        return error is None, error or "Cloned {}".format(url)
+    mirror, message = update_mirror(url, offline)
+    if mirror is None:
+        return False, message
+    # A local clone hardlinks the objects of the mirror instead of copying them
+    error = git(["clone", "--quiet", mirror, dest]) or git(["-C", dest, "remote", "set-url", "origin", url])
+    if error:
+        return False, "Could not clone {}: {}".format(url, error)
+    return True, "\n".join(m for m in [message, "Cloned {}".format(url)] if m)
+
+def create_libraries(path, lib_urls, offline=False, use_mirror=True):
+    """returns False if a library could not be fetched"""
     print("Fetching dependencies...")
-    for lib in lib_urls:
-        os.system("git -C {}/libraries clone {}".format(path, lib))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(lib_urls))) as pool:
+        results = list(pool.map(lambda url: fetch_library(path, url, offline, use_mirror), lib_urls))
+    for ok, message in results:
+        print(message)
+    if not all(ok for ok, _ in results):
+        print("Not all libraries could be fetched.")
+        return False
+    return True
 
 def bsvLineJoin(indent_count, lines, default = ""):
     if len(lines) == 0:
@@ -49,7 +112,7 @@ makefile_temp = """###
 ###
 TOP_MODULE=mk{0}
 TESTBENCH_MODULE=mkTestbench
-IGNORE_MODULES=mkTestbench mkTestsMainTest
+IGNORE_MODULES=mkTestbench mkTestbenchAll mkTestsMainTest
 MAIN_MODULE={0}
 TESTBENCH_FILE={1}/Testbench.bsv
 {2}
@@ -93,6 +156,10 @@ CXX_NO_OPT := 1
 # Flags added to simulator execution
 # RUN_FLAGS+=-V dump.vcd
 
+# Link all tests into one simulation binary and select them at runtime
+# (make sim TESTS="TestsMainTest"), no recompilation when switching tests
+# MULTI_TEST := 1
+
 # Add additional parameters for IP-XACT generation. Passed directly to Vivado.
 # Any valid TCL during packaging is allowed
 # Typically used to fix automatic inference for e.g. clock assignments
@@ -119,6 +186,7 @@ def create_makefile(path, project_name, test_dir):
 
 gitignore = """.deps
 .bsv_tools
+.bsv_test_history
 build
 """
 
@@ -267,6 +335,8 @@ def main():
     parser.add_argument('--path', type=dir_path, default='./')
     parser.add_argument('project_name')
     parser.add_argument('--test_dir', help='Set in case you want to separate in src and test folder', action='store_true')
+    parser.add_argument('--offline', help='Create the libraries from the local mirrors without network access', action='store_true')
+    parser.add_argument('--no_mirror', help='Clone the libraries directly instead of through the shared mirrors (BSV_MIRROR_DIR)', action='store_true')
     parser.add_argument('--interfaces', help='Add interfaces to the BSV module (supported interfaces are "{}")'.format('", "'.join(list_available_interfaces())), nargs='+')
 
     args = None
@@ -291,11 +361,14 @@ def main():
     intfs = create_interfaces(args.interfaces)
 
     create_directories(args.path, args.test_dir)
-    create_libraries(args.path, intfs.libraries)
+    fetched = create_libraries(args.path, intfs.libraries, args.offline, not args.no_mirror)
     create_machine_file(args.path)
     create_gitignore(args.path)
     create_makefile(args.path, args.project_name, args.test_dir)
     create_base_src(args.path, args.project_name, args.test_dir, intfs)
+    # The project is complete apart from the missing libraries
+    if not fetched:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
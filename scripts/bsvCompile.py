@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import hashlib
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+from bsvFiles import stamp, hashFile
+
+# Output directory options of bsc. Outputs are written to private temporary
+# directories first, so concurrent compiles never mix up their files.
+outputDirs = ['-bdir', '-vdir', '-simdir', '-info-dir']
+# Options that only depend on the location of the checkout
+ignoredOptions = ['-p', '-fdir']
+cacheVersion = 1
+
+def parseSize(s):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    s = s.strip().upper()
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+def objectKey(bo):
+    """identifies an imported object. Objects produced by this wrapper carry the
+    key they were compiled with, which covers their imports transitively."""
+    keyfile = os.path.splitext(bo)[0] + ".key"
+    try:
+        with open(keyfile, "r") as f:
+            k = json.load(f)
+        if k["stamp"] == stamp(bo):
+            return k["key"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return hashFile(bo)
+
+def writeObjectKey(bo, key):
+    with open(os.path.splitext(bo)[0] + ".key", "w") as f:
+        json.dump({"key": key, "stamp": stamp(bo)}, f)
+
+def compilerVersion(cacheDir, bsc):
+    """fingerprint of the bsc version banner, only queried again when the
+    compiler binary changed"""
+    path = shutil.which(bsc) or bsc
+    try:
+        st = os.stat(path)
+        fingerprint = [path, st.st_mtime_ns, st.st_size]
+    except OSError:
+        fingerprint = [path]
+    versionFile = os.path.join(cacheDir, "toolchain.json")
+    try:
+        with open(versionFile, "r") as f:
+            cached = json.load(f)
+        if cached["fingerprint"] == fingerprint:
+            return cached["version"]
+    except (OSError, ValueError, KeyError):
+        pass
+    t = subprocess.run([bsc, "-v"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+    version = hashlib.sha256(t).hexdigest()
+    atomicWrite(versionFile, json.dumps({"fingerprint": fingerprint, "version": version}))
+    return version
+
+def atomicWrite(filename, content):
+    tmp = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, filename)
+
+def splitCommand(command, macros=None):
+    """returns (output dir option -> dir, key relevant arguments, source file).
+    If macros is given, only defines of these macros are key relevant."""
+    dirs = {}
+    keyArgs = []
+    source = None
+    i = 0
+    while i < len(command):
+        a = command[i]
+        if a.startswith('-D') and macros is not None:
+            define = a[2:]
+            if not define and i + 1 < len(command):
+                i += 1
+                define = command[i]
+            if define.partition('=')[0] in macros:
+                keyArgs.append('-D' + define)
+            i += 1
+            continue
+        if a in outputDirs and i + 1 < len(command):
+            dirs[a] = command[i + 1]
+            keyArgs.append(a)
+            i += 2
+            continue
+        if a in ignoredOptions and i + 1 < len(command):
+            i += 2
+            continue
+        if a.endswith('.bsv'):
+            source = a
+            a = os.path.basename(a)
+        keyArgs.append(a)
+        i += 1
+    return dirs, keyArgs, source
+
+def computeKey(cacheDir, command, keyArgs, deps):
+    h = hashlib.sha256()
+    h.update("bsvCompile {}\n".format(cacheVersion).encode())
+    h.update(compilerVersion(cacheDir, command[0]).encode() + b"\n")
+    h.update(json.dumps(keyArgs[1:]).encode() + b"\n")
+    for d in deps:
+        if d.endswith('.bo'):
+            h.update("import {} {}\n".format(os.path.basename(d), objectKey(d)).encode())
+        else:
+            h.update("source {} {}\n".format(os.path.basename(d), hashFile(d)).encode())
+    return h.hexdigest()
+
+def privateCommand(command, dirs, tmp):
+    """redirects all output directories into tmp. The original bdir is added to
+    the search path so imported objects are still found."""
+    result = []
+    i = 0
+    while i < len(command):
+        a = command[i]
+        if a in dirs:
+            result += [a, os.path.join(tmp, a.strip('-'))]
+            i += 2
+            continue
+        if a == '-p' and '-bdir' in dirs and i + 1 < len(command):
+            result += [a, dirs['-bdir'] + ':' + command[i + 1]]
+            i += 2
+            continue
+        result.append(a)
+        i += 1
+    if '-bdir' in dirs and '-p' not in command:
+        result[1:1] = ['-p', dirs['-bdir'] + ':.:%/Libraries']
+    return result
+
+def runCompiler(command):
+    """runs bsc, streaming its output while keeping a copy for the cache"""
+    log = []
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in p.stdout:
+        sys.stdout.buffer.write(line)
+        sys.stdout.flush()
+        log.append(line)
+    return p.wait(), b"".join(log)
+
+def collectOutputs(dirs, tmp):
+    outputs = []
+    for opt in dirs:
+        base = os.path.join(tmp, opt.strip('-'))
+        for root, _, files in os.walk(base):
+            for f in files:
+                rel = os.path.relpath(os.path.join(root, f), base)
+                outputs.append((opt, rel))
+    return outputs
+
+def install(src, dst):
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    tmp = "{}.{}.tmp".format(dst, os.getpid())
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+def entryPath(cacheDir, key):
+    return os.path.join(cacheDir, "objects", key[:2], key)
+
+def restore(cacheDir, key, dirs):
+    entry = entryPath(cacheDir, key)
+    try:
+        with open(os.path.join(entry, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        for opt, rel in manifest["outputs"]:
+            install(os.path.join(entry, opt.strip('-'), rel), os.path.join(dirs[opt], rel))
+        with open(os.path.join(entry, "log"), "rb") as f:
+            sys.stdout.buffer.write(f.read())
+            sys.stdout.flush()
+    except (OSError, ValueError, KeyError):
+        return False
+    # entry mtime is used for least recently used eviction
+    os.utime(entry)
+    return True
+
+def store(cacheDir, key, tmp, outputs, log):
+    entry = entryPath(cacheDir, key)
+    if os.path.exists(entry):
+        return
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    staging = tempfile.mkdtemp(dir=os.path.dirname(entry))
+    size = len(log)
+    for opt, rel in outputs:
+        src = os.path.join(tmp, opt.strip('-'), rel)
+        install(src, os.path.join(staging, opt.strip('-'), rel))
+        size += os.path.getsize(src)
+    with open(os.path.join(staging, "log"), "wb") as f:
+        f.write(log)
+    with open(os.path.join(staging, "manifest.json"), "w") as f:
+        json.dump({"outputs": outputs, "size": size}, f)
+    try:
+        os.rename(staging, entry)
+    except OSError:
+        # Another build stored the same entry in the meantime
+        shutil.rmtree(staging, ignore_errors=True)
+
+def evict(cacheDir, maxSize, interval=60):
+    """removes least recently used entries once the cache exceeds maxSize. Runs
+    at most once per interval seconds."""
+    stampFile = os.path.join(cacheDir, ".last_cleanup")
+    try:
+        if time.time() - os.path.getmtime(stampFile) < interval:
+            return
+    except OSError:
+        pass
+    open(stampFile, "a").close()
+    os.utime(stampFile)
+    entries = []
+    total = 0
+    objects = os.path.join(cacheDir, "objects")
+    for prefix in os.listdir(objects) if os.path.isdir(objects) else []:
+        for e in os.scandir(os.path.join(objects, prefix)):
+            try:
+                with open(os.path.join(e.path, "manifest.json"), "r") as f:
+                    size = json.load(f)["size"]
+                entries.append((e.stat().st_mtime, size, e.path))
+                total += size
+            except (OSError, ValueError, KeyError):
+                continue
+    entries.sort()
+    for _, size, path in entries:
+        if total <= maxSize * 0.9:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile a single BSV package through a content addressed cache.')
+    parser.add_argument('--cache_dir', default=os.getenv('BSV_CACHE_DIR', os.path.expanduser('~/.cache/bsvtools/bsc')), type=str)
+    parser.add_argument('--cache_size', default='5G', type=str, help='Maximum cache size, e.g. 500M or 5G')
+    parser.add_argument('--deps', nargs='*', default=[], type=str, help='Source, included files and imported objects of the package')
+    parser.add_argument('--macros', nargs='*', default=None, type=str, help='Macros referenced by the package, other defines do not affect the cache key')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    cli = parser.parse_args()
+
+    command = cli.command[1:] if cli.command[:1] == ['--'] else cli.command
+    if not command:
+        parser.error("bsc command missing")
+    dirs, keyArgs, source = splitCommand(command, cli.macros)
+    if source is None or '-bdir' not in dirs:
+        sys.exit(subprocess.call(command))
+    dirs = {opt: os.path.abspath(d) for opt, d in dirs.items()}
+
+    os.makedirs(cli.cache_dir, exist_ok=True)
+    key = computeKey(cli.cache_dir, command, keyArgs, cli.deps)
+    bo = os.path.join(dirs['-bdir'], os.path.splitext(os.path.basename(source))[0] + ".bo")
+    if restore(cli.cache_dir, key, dirs):
+        writeObjectKey(bo, key)
+        # Set by bsvTrace.py, cache hits are not compile times
+        if os.getenv("BSV_COMPILE_HIT_FILE"):
+            open(os.getenv("BSV_COMPILE_HIT_FILE"), "w").close()
+        return
+
+    tmp = tempfile.mkdtemp(prefix=".bsvCompile.", dir=dirs['-bdir'])
+    try:
+        for opt in dirs:
+            os.makedirs(os.path.join(tmp, opt.strip('-')), exist_ok=True)
+        ret, log = runCompiler(privateCommand(command, dirs, tmp))
+        if ret != 0:
+            sys.exit(ret)
+        outputs = collectOutputs(dirs, tmp)
+        for opt, rel in outputs:
+            install(os.path.join(tmp, opt.strip('-'), rel), os.path.join(dirs[opt], rel))
+        store(cli.cache_dir, key, tmp, outputs, log)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if os.path.exists(bo):
+        writeObjectKey(bo, key)
+    evict(cli.cache_dir, parseSize(cli.cache_size))
+
+if __name__ == '__main__':
+    main()
@@ -1,69 +1,405 @@
 #!/usr/bin/env python3
 
 import sys
-import glob
 import os
-import re
+import json
+import hashlib
+import argparse
+import heapq
+import collections
+import concurrent.futures
+from bsvFiles import stamp
+from bsvPreprocessor import preprocess, parseDefines
+from bsvTestbench import testbenchSource
+from bsvNinja import ninjaFile, regenCommand
 
-def main():
-    directory = sys.argv[1]
-    builddir = sys.argv[2]
-    extra_module = ""
-    if(len(sys.argv) > 3):
-        extra_module = sys.argv[3]
-    projectModules = {}
-    for filename in glob.glob(os.path.join(directory, '*.bsv')):
-        m = re.match(".*/(.*).bsv", filename)
-        modName = m.group(1).strip()
-        projectModules[modName] = []
+# Parsed imports are cached per file in the build directory so unchanged
+# sources are not rescanned on every make invocation.
+cacheName = ".bsv_deps_cache"
+cacheVersion = 4
+
+def loadCache(builddir):
+    try:
+        with open(os.path.join(builddir, cacheName), "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("version") != cacheVersion:
+        return {}
+    return cache.get("files", {})
+
+def storeCache(builddir, files):
+    os.makedirs(builddir, exist_ok=True)
+    filename = os.path.join(builddir, cacheName)
+    tmp = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump({"version": cacheVersion, "files": files}, f)
+    os.replace(tmp, filename)
+
+def entryValid(entry, defines):
+    """an entry stays valid as long as its includes are unchanged, no include
+    that could not be found has appeared and the macros it referenced still
+    have the same command line values"""
+    try:
+        if any(stamp(path) != s for path, s in entry["includes"]):
+            return False
+    except OSError:
+        return False
+    if any(os.path.isfile(path) for path in entry["missingIncludes"]):
+        return False
+    return all(defines.get(m) == v for m, v in entry["macros"].items())
+
+def scanFile(filename, cache, defines, searchPath):
+    """returns the cache entry for filename, preprocessing the file only if it changed"""
+    fileStamp = stamp(filename)
+    entry = cache.get(filename)
+    if entry and entry["stamp"] == fileStamp and entryValid(entry, defines):
+        return entry
+    with open(filename, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha1(content).hexdigest()
+    if not entry or entry["hash"] != digest or not entryValid(entry, defines):
+        result = preprocess(filename, defines, searchPath, content.decode(errors="replace"))
+        entry = {
+            "path": filename,
+            "hash": digest,
+            "imports": result["imports"],
+            "includes": [[path, stamp(path)] for path in result["includes"]],
+            "missingIncludes": result["missingIncludes"],
+            "macros": {m: defines.get(m) for m in result["macros"]},
+            "testModules": result["testModules"]
+        }
+    # A new dict, the cache compares against the unchanged entries when storing
+    return dict(entry, stamp=fileStamp)
+
+def writeIfChanged(filename, content):
+    """only touches filename if content differs, keeping make from seeing a new file"""
+    try:
         with open(filename, "r") as f:
-            for line in f:
-                if line.strip().startswith("import"):
-                    m = re.match("import(.*)::", line.strip())
-                    if m:
-                        mod = m.group(1).strip()
-                        if mod == "`RUN_TEST":
-                            mod = extra_module
-                        projectModules[modName].append(mod)
-
-    # Remove duplicates
-    for module, deps in projectModules.items():
-        projectModules[module] = list(set(deps))
-
-    # Remove non project Dependencies
-    for module, deps in projectModules.items():
-        old = list(deps)
-        for dep in old:
-            if not dep in projectModules:
-                deps.remove(dep)
+            if f.read() == content:
+                return
+    except OSError:
+        pass
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as f:
+        f.write(content)
+
+def topologicalOrder(graph):
+    """orders the packages in graph (package -> imported packages) so that every
+    package comes after its imports. Runs in O(V+E), ties are broken by name.
+    Returns the order and a list of import cycles (empty if there are none)."""
+    remaining = {m: len(d) for m, d in graph.items()}
+    importedBy = {m: [] for m in graph}
+    for m, d in graph.items():
+        for dep in d:
+            importedBy[dep].append(m)
+    ready = [m for m, c in remaining.items() if c == 0]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        m = heapq.heappop(ready)
+        order.append(m)
+        for user in importedBy[m]:
+            remaining[user] -= 1
+            if remaining[user] == 0:
+                heapq.heappush(ready, user)
+    if len(order) == len(graph):
+        return order, []
+    unresolved = {m for m, c in remaining.items() if c > 0}
+    cycles = []
+    for component in stronglyConnected({m: [d for d in graph[m] if d in unresolved] for m in unresolved}):
+        if len(component) > 1 or component[0] in graph[component[0]]:
+            cycles.append(findCycle(graph, set(component)))
+    return order, cycles
+
+def stronglyConnected(graph):
+    """iterative Tarjan, returns the strongly connected components of graph"""
+    index = {}
+    lowlink = {}
+    stack = []
+    onStack = set()
+    components = []
+    for root in sorted(graph):
+        if root in index:
+            continue
+        work = [(root, iter(sorted(graph[root])))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        onStack.add(root)
+        while work:
+            node, children = work[-1]
+            child = next(children, None)
+            if child is not None:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    onStack.add(child)
+                    work.append((child, iter(sorted(graph[child]))))
+                elif child in onStack:
+                    lowlink[node] = min(lowlink[node], index[child])
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    m = stack.pop()
+                    onStack.discard(m)
+                    component.append(m)
+                    if m == node:
+                        break
+                components.append(sorted(component))
+    return components
+
+def findCycle(graph, component):
+    """returns the shortest import cycle through the smallest package of component"""
+    start = min(component)
+    previous = {}
+    queue = collections.deque([start])
+    while queue:
+        m = queue.popleft()
+        for dep in sorted(graph[m]):
+            if dep not in component:
+                continue
+            if dep == start:
+                cycle = [m]
+                while cycle[-1] != start:
+                    cycle.append(previous[cycle[-1]])
+                return list(reversed(cycle)) + [start]
+            if dep not in previous:
+                previous[dep] = m
+                queue.append(dep)
+    return [start, start]
+
+def listSources(root):
+    try:
+        names = sorted(os.listdir(root))
+    except OSError:
+        return []
+    return [os.path.join(root, n) for n in names if n.endswith('.bsv')]
+
+def listPrebuilt(root):
+    try:
+        names = sorted(os.listdir(root))
+    except OSError:
+        return []
+    return [os.path.join(root, n) for n in names if n.endswith('.bo')]
+
+def resolveRoots(roots, bluespecdir):
+    """expands the bsc search path into (directory, prebuilt) tuples. %
+    stands for the Bluespec installation which only provides compiled .bo
+    files; it is skipped if the installation is unknown."""
+    resolved = []
+    for r in roots:
+        if '%' in r:
+            if bluespecdir:
+                resolved.append((r.replace('%', bluespecdir), True))
+        else:
+            resolved.append((r, False))
+    return list(dict.fromkeys(resolved))
+
+def scanRoots(roots, cache, defines, jobs=None):
+    """scans the (directory, prebuilt) roots concurrently and returns
+    (package -> entry, filename -> cache entry). As in the bsc search path
+    the first root defining a package wins. Prebuilt packages have no
+    imports and are not compiled by the project."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        listings = list(pool.map(lambda r: listPrebuilt(r[0]) if r[1] else listSources(r[0]), roots))
+        files = [f for (_, prebuilt), listing in zip(roots, listings) if not prebuilt for f in listing]
+        searchPath = [r for r, prebuilt in roots if not prebuilt]
+        entries = dict(zip(files, pool.map(lambda f: scanFile(f, cache, defines, searchPath), files)))
+    packages = {}
+    for listing in listings:
+        for filename in listing:
+            name, ext = os.path.splitext(os.path.basename(filename))
+            if name in packages:
+                continue
+            if ext == '.bo':
+                packages[name] = {"path": filename, "prebuilt": True, "imports": []}
+            else:
+                packages[name] = entries[filename]
+    return packages, entries
 
+class PackageGraph:
+    def __init__(self):
+        # package -> imported project packages
+        self.imports = {}
+        self.sources = {}
+        self.includes = {}
+        # package -> precompiled .bo files it imports
+        self.external = {}
+        # package -> macros referenced while preprocessing it
+        self.macros = {}
+        self.tests = []
+
+def resolveGraph(roots, builddir, defines, jobs=None, testbench=None):
+    """scans the search path and returns the PackageGraph of all packages
+    that can be compiled from source. If testbench is given, a testbench
+    running all tests found is generated into that file and added."""
+    cache = loadCache(builddir)
+    packages, newCache = scanRoots(roots, cache, defines, jobs)
+
+    graph = PackageGraph()
+    prebuilt = {}
+    for modName, entry in packages.items():
+        if entry.get("prebuilt"):
+            prebuilt[modName] = entry["path"]
+            continue
+        # Tests are selected through RUN_TEST=<package>, TESTNAME=mk<package>
+        if "mk" + modName in entry["testModules"]:
+            graph.tests.append(modName)
+        graph.sources[modName] = entry["path"]
+        graph.includes[modName] = [path for path, _ in entry["includes"]]
+        graph.macros[modName] = sorted(entry["macros"])
+        graph.imports[modName] = list(entry["imports"])
+    graph.tests.sort()
+
+    if testbench:
+        name = os.path.splitext(os.path.basename(testbench))[0]
+        writeIfChanged(testbench, testbenchSource(name, graph.tests))
+        entry = scanFile(testbench, cache, defines, [r for r, prebuilt in roots if not prebuilt])
+        newCache[testbench] = entry
+        graph.sources[name] = testbench
+        graph.includes[name] = [path for path, _ in entry["includes"]]
+        graph.macros[name] = sorted(entry["macros"])
+        graph.imports[name] = list(entry["imports"])
+    if newCache != cache:
+        storeCache(builddir, newCache)
+
+    # Imports of precompiled packages from the Bluespec installation
+    for module, deps in graph.imports.items():
+        graph.external[module] = sorted({prebuilt[dep] for dep in deps if dep in prebuilt})
+
+    # Remove duplicates and Dependencies outside the search path
+    for module, deps in graph.imports.items():
+        graph.imports[module] = {dep for dep in deps if dep in graph.imports}
+    return graph
+
+def graphJson(graph, order, builddir):
+    """machine readable graph with forward and reverse adjacency. Transitive
+    closures are stored as hex bitsets over the topological order."""
+    index = {m: i for i, m in enumerate(order)}
+    importedBy = {m: [] for m in order}
+    for m in order:
+        for dep in graph.imports[m]:
+            importedBy[dep].append(m)
+    closure = {}
+    for m in order:
+        bits = 0
+        for dep in graph.imports[m]:
+            bits |= closure[dep] | (1 << index[dep])
+        closure[m] = bits
+    reverseClosure = {}
+    for m in reversed(order):
+        bits = 0
+        for user in importedBy[m]:
+            bits |= reverseClosure[user] | (1 << index[user])
+        reverseClosure[m] = bits
+    packages = {}
+    for m in order:
+        packages[m] = {
+            "index": index[m],
+            "path": graph.sources[m],
+            "object": "{}/{}.bo".format(builddir, m),
+            "includes": graph.includes[m],
+            "imports": sorted(graph.imports[m]),
+            "importedBy": sorted(importedBy[m]),
+            "external": graph.external[m],
+            "macros": graph.macros[m],
+            "test": m in graph.tests,
+            "closure": format(closure[m], 'x'),
+            "reverseClosure": format(reverseClosure[m], 'x')
+        }
+    return json.dumps({"version": 1, "builddir": builddir, "order": order, "packages": packages}, indent=1, sort_keys=True) + "\n"
+
+def writeDeps(graph, builddir, output=None, jsonFile=None, ninja=None):
+    """writes the make rules (to stdout without output), the JSON graph and
+    with ninja (the settings of bsvNinja.ninjaFile) build.ninja. Returns the
+    import cycles, nothing is written if there are any."""
+    projectModules = graph.imports
+    sources = graph.sources
+
+    out = []
     # Create List of modules for dependency resolution
-    for m, d in projectModules.items():
-        print("{}/{}.bo: {}/{}.bsv {}".format(builddir, m, directory, m, " ".join(map(lambda x : "{}/{}.bo".format(builddir, x), d))))
+    for m in sorted(projectModules):
+        d = sorted(projectModules[m])
+        d = graph.includes[m] + ["{}/{}.bo".format(builddir, x) for x in d] + graph.external[m]
+        out.append("{}/{}.bo: {} {}".format(builddir, m, sources[m], " ".join(d)))
+        # Only these defines can influence the compiled package (used by the compile cache)
+        if graph.macros[m]:
+            out.append("{}/{}.bo: private PACKAGE_MACROS={}".format(builddir, m, " ".join(graph.macros[m])))
 
-    depList = []
     # Produce dependency list
-    while len(projectModules.keys()) > 0:
-        # Look for Module without dependency
-        found = False
-        for m, d in projectModules.items():
-            if not d:
-                found = True
-                depList.append(m)
-                del projectModules[m]
-                for _, d in projectModules.items():
-                    if m in d:
-                        d.remove(m)
-                break
-        if not found:
-            print("Loop detected")
-            break
+    depList, cycles = topologicalOrder(projectModules)
+    if cycles:
+        return cycles
     depListFull = []
     for d in depList:
         d = builddir + "/" + d + ".bo"
         depListFull.append(d)
     t = "OBJS=" + " ".join(depListFull)
-    print(t)
+    out.append(t)
+
+    content = "\n".join(out) + "\n"
+    if output:
+        writeIfChanged(output, content)
+    else:
+        sys.stdout.write(content)
+    if jsonFile:
+        writeIfChanged(jsonFile, graphJson(graph, depList, builddir))
+    if ninja:
+        writeIfChanged(ninja["output"], ninjaFile(graph, depList, builddir, ninja))
+    return []
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate make dependencies for BSV packages.')
+    parser.add_argument('roots', nargs='+', type=str, help='bsc search path entries in search order')
+    parser.add_argument('--builddir', default="build", type=str)
+    parser.add_argument('--bluespec_dir', default=os.getenv('BLUESPECDIR', ''), type=str, help='Replaces % in the search path')
+    parser.add_argument('--flags', default="", type=str, help='bsc flags, -D defines are applied while scanning')
+    parser.add_argument('--run_test', default="", type=str, help='Shorthand for -D RUN_TEST=<package>')
+    parser.add_argument('--jobs', default=None, type=int, help='Number of concurrent file scans')
+    parser.add_argument('--output', default=None, type=str, help='Write rules to this file (only if changed) instead of stdout')
+    parser.add_argument('--testbench', default=None, type=str, help='Generate a testbench running all tests into this file')
+    parser.add_argument('--json', default=None, type=str, help='Also write the graph as JSON to this file (only if changed)')
+    parser.add_argument('--ninja', default=None, type=str, help='Also write a ninja build file (only if changed)')
+    parser.add_argument('--bsc', default="bsc", type=str, help='bsc command (ninja)')
+    parser.add_argument('--compile_flags', default="", type=str, help='bsc flags of every package compilation (ninja)')
+    parser.add_argument('--elab', nargs='+', default=[], type=str, help='PACKAGE=MODULE, elaborate MODULE when compiling PACKAGE (ninja)')
+    parser.add_argument('--link', default=None, type=str, help='Shell command linking the simulation (ninja)')
+    parser.add_argument('--link_output', default=None, type=str, help='Simulation binary written by --link (ninja)')
+    parser.add_argument('--link_package', default=None, type=str, help='Package elaborating the testbench (ninja)')
+    parser.add_argument('--link_inputs', nargs='+', default=[], type=str, help='C/C++ files linked into the simulation (ninja)')
+    parser.add_argument('--sim', default=None, type=str, help='Shell command running the simulation (ninja)')
+    parser.add_argument('--ip', default=None, type=str, help='Shell command packaging the IP (ninja)')
+    parser.add_argument('--ip_elab', default=None, type=str, help='Shell command elaborating the top module to Verilog for --ip (ninja)')
+    parser.add_argument('--ip_elab_output', default=None, type=str, help='Verilog file written by --ip_elab (ninja)')
+    parser.add_argument('--ip_elab_package', default=None, type=str, help='Package containing the top module (ninja)')
+    parser.add_argument('--link_jobs', default=1, type=int, help='Concurrent links (ninja)')
+    parser.add_argument('--sim_jobs', default=1, type=int, help='Concurrent simulations (ninja)')
+    parser.add_argument('--ip_jobs', default=1, type=int, help='Concurrent IP packaging runs (ninja)')
+    cli = parser.parse_args()
+
+    builddir = cli.builddir
+    defines = parseDefines(cli.flags)
+    if cli.run_test:
+        defines.setdefault("RUN_TEST", cli.run_test)
+    roots = resolveRoots(cli.roots, cli.bluespec_dir)
+    graph = resolveGraph(roots, builddir, defines, cli.jobs, cli.testbench)
+    ninja = None
+    if cli.ninja:
+        ninja = {k: getattr(cli, k) for k in ["bsc", "compile_flags", "link", "link_output", "link_package", "link_inputs",
+                                              "sim", "ip", "ip_elab", "ip_elab_output", "ip_elab_package", "link_jobs", "sim_jobs", "ip_jobs"]}
+        ninja.update({"output": cli.ninja, "elab": dict(e.split('=', 1) for e in cli.elab),
+                      "regen": regenCommand(sys.argv), "sources": [r for r, prebuilt in roots if not prebuilt]})
+    cycles = writeDeps(graph, builddir, cli.output, cli.json, ninja)
+    if cycles:
+        for cycle in cycles:
+            print("Import cycle detected: {}".format(" -> ".join("{} ({})".format(m, graph.sources[m]) for m in cycle)), file=sys.stderr)
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
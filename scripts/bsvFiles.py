@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+# File fingerprints shared by the caches of the other scripts: a cheap stamp
+# that changes whenever a file is written and a hash of its content.
+
+import os
+import hashlib
+
+def stamp(filename):
+    """modification time and size of filename, raises OSError if it is missing"""
+    st = os.stat(filename)
+    return [st.st_mtime_ns, st.st_size]
+
+def hashFile(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
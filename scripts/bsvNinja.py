@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# build.ninja generated from the package graph of bsvDeps.py. Every package
+# is compiled by its own edge, link, simulation and IP packaging run in pools
+# limiting their concurrency. The file regenerates itself when a source
+# directory or source changes.
+
+import os
+import shlex
+
+def escapePath(path):
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+def escapeCommand(command):
+    return command.replace('$', '$$').replace('\n', ' ')
+
+def paths(files):
+    return " ".join(escapePath(f) for f in files)
+
+def ninjaFile(graph, order, builddir, settings):
+    """settings: bsc, compile_flags, elab (package -> elaborated module), link
+    (command), link_output, link_package (elaborated testbench), link_inputs, sim,
+    ip, ip_elab (command elaborating the top module to Verilog), ip_elab_output,
+    ip_elab_package, output (this file), regen (the command writing it), sources
+    (directories whose listing is part of the graph), link_jobs, sim_jobs and ip_jobs"""
+    elab = settings["elab"]
+    out = ["# Generated by bsvDeps.py, changes are overwritten", "ninja_required_version = 1.7", "",
+           "builddir = {}".format(escapePath(builddir)), ""]
+    for pool in ["link", "sim", "ip"]:
+        out += ["pool {}_pool".format(pool), "  depth = {}".format(settings["{}_jobs".format(pool)]), ""]
+    out += ["rule regen",
+            "  command = {}".format(escapeCommand(settings["regen"])),
+            "  description = Regenerating build.ninja",
+            "  generator = 1",
+            "  restat = 1",
+            "",
+            # Importers of a .bo left untouched by the command are not rebuilt
+            "rule bsc",
+            "  command = {} $flags {} $in".format(escapeCommand(settings["bsc"]), escapeCommand(settings["compile_flags"])),
+            "  description = BSC $package",
+            "  restat = 1",
+            ""]
+
+    for m in order:
+        imports = ["{}/{}.bo".format(builddir, d) for d in sorted(graph.imports[m])]
+        inputs = graph.includes[m] + imports + graph.external[m]
+        out.append("build {}: bsc {} | {}".format(escapePath("{}/{}.bo".format(builddir, m)), escapePath(graph.sources[m]), paths(inputs)))
+        out.append("  package = {}".format(m))
+        if m in elab:
+            out.append("  flags = -elab -g {}".format(elab[m]))
+    out.append("")
+
+    targets = ["compile"]
+    compiled = [m for m in elab if m in graph.sources]
+    out.append("build compile: phony {}".format(paths(["{}/{}.bo".format(builddir, m) for m in compiled])))
+    if settings.get("link"):
+        outfile = settings["link_output"]
+        out += ["rule link", "  command = {}".format(escapeCommand(settings["link"])), "  description = Linking $out", "  pool = link_pool", "",
+                "build {}: link {} | {}".format(escapePath(outfile), escapePath("{}/{}.bo".format(builddir, settings["link_package"])), paths(settings["link_inputs"])),
+                "build link: phony {}".format(escapePath(outfile)), ""]
+        targets.append("link")
+        if settings.get("sim"):
+            # sim is never created, so the simulation always runs
+            out += ["rule sim", "  command = {}".format(escapeCommand(settings["sim"])), "  description = Simulating $in", "  pool = sim_pool", "",
+                    "build sim: sim {}".format(escapePath(outfile)), ""]
+            targets.append("sim")
+    package = settings.get("ip_elab_package")
+    if settings.get("ip") and package in graph.sources:
+        # The IP is packaged from Verilog, independent of the simulator the
+        # packages are compiled for. Waiting for the package keeps both bsc
+        # runs apart when they share the build directory.
+        verilog = escapePath(settings["ip_elab_output"])
+        out += ["rule ip_elab", "  command = {}".format(escapeCommand(settings["ip_elab"])), "  description = BSC Verilog $package", "  restat = 1", "",
+                "build {}: ip_elab {} | {}".format(verilog, escapePath(graph.sources[package]), escapePath("{}/{}.bo".format(builddir, package))),
+                "  package = {}".format(package), "",
+                "rule ip", "  command = {}".format(escapeCommand(settings["ip"])), "  description = Packaging IP", "  pool = ip_pool", "",
+                "build ip: ip {}".format(verilog), ""]
+        targets.append("ip")
+
+    # Generated files (the testbench of MULTI_TEST) are written by regen itself
+    generated = os.path.abspath(builddir) + os.sep
+    sources = sorted(f for f in set(graph.sources.values()) | {i for m in order for i in graph.includes[m]}
+                     if not os.path.abspath(f).startswith(generated))
+    directories = sorted(d for d in settings["sources"] if os.path.isdir(d))
+    out += ["build {}: regen | {}".format(escapePath(settings["output"]), paths(directories + sources)), ""]
+    # A deleted source triggers the regeneration instead of stopping ninja
+    out += ["build {}: phony".format(escapePath(f)) for f in sources] + [""]
+    out.append("default {}".format("sim" if "sim" in targets else targets[-1]))
+    return "\n".join(out) + "\n"
+
+def regenCommand(argv):
+    """the command line of the running generator, repeated by ninja"""
+    return " ".join(shlex.quote(a) for a in argv)
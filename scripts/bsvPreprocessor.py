@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# Subset of the BSV preprocessor used for dependency scanning. Handles
+# comments, strings, `define/`undef, `ifdef/`ifndef/`elsif/`else/`endif,
+# `include and macro expansion, so that the imports found are the ones bsc
+# actually sees.
+
+import os
+import shlex
+
+maxDepth = 32
+
+def parseDefines(flags):
+    """extracts the -D macro definitions from a bsc command line"""
+    defines = {}
+    args = shlex.split(flags) if isinstance(flags, str) else list(flags)
+    i = 0
+    while i < len(args):
+        a = args[i]
+        d = None
+        if a == '-D' and i + 1 < len(args):
+            i += 1
+            d = args[i]
+        elif a.startswith('-D') and len(a) > 2:
+            d = a[2:]
+        if d is not None:
+            name, _, value = d.partition('=')
+            defines[name] = value
+        i += 1
+    return defines
+
+def isIdentChar(c):
+    return c.isalnum() or c == '_' or c == '$'
+
+class Preprocessor:
+    def __init__(self, defines, searchPath):
+        # macro name -> (parameters or None, body)
+        self.macros = {k: (None, v) for k, v in defines.items()}
+        self.searchPath = searchPath
+        self.referenced = set()
+        self.imports = []
+        self.includes = []
+        # paths an unresolved `include was looked up at, the file may appear later
+        self.missingIncludes = []
+        self.conditions = []
+        self.window = []
+        self.testModules = []
+        self.moduleHeader = None
+
+    def active(self):
+        return all(c[0] for c in self.conditions)
+
+    def emit(self, token):
+        # import <Package> :: and module headers are the only constructs we are interested in
+        self.window = (self.window + [token])[-3:]
+        if len(self.window) == 3 and self.window[0] == 'import' and self.window[2] == '::':
+            name = self.window[1]
+            if name[0].isalpha() and name not in self.imports:
+                self.imports.append(name)
+        if token == 'module':
+            self.moduleHeader = []
+        elif self.moduleHeader is not None:
+            if token == ';':
+                self.moduleHeader = self.checkTestModule(self.moduleHeader)
+            else:
+                self.moduleHeader.append(token)
+
+    def checkTestModule(self, header):
+        """records modules providing a TestHandler interface, e.g.
+        module [Module] mkTest(TestHelper::TestHandler);"""
+        level = 0
+        name = None
+        for t in header:
+            if t == '[':
+                level += 1
+            elif t == ']':
+                level -= 1
+            elif level == 0 and isIdentChar(t[0]):
+                name = t
+                break
+        if name and 'TestHandler' in header and name not in self.testModules:
+            self.testModules.append(name)
+        return None
+
+    def includeCandidates(self, name, current):
+        return [os.path.join(d, name) for d in [os.path.dirname(current)] + self.searchPath]
+
+    def resolveInclude(self, name, current):
+        for candidate in self.includeCandidates(name, current):
+            if os.path.isfile(candidate):
+                return candidate
+        return None
+
+    def run(self, text, filename, depth=0):
+        if depth > maxDepth:
+            return
+        i = 0
+        n = len(text)
+        while i < n:
+            c = text[i]
+            if text.startswith('//', i):
+                i = text.find('\n', i)
+                i = n if i < 0 else i
+            elif text.startswith('/*', i):
+                i = text.find('*/', i + 2)
+                i = n if i < 0 else i + 2
+            elif c == '"':
+                j = i + 1
+                while j < n and text[j] != '"' and text[j] != '\n':
+                    j += 2 if text[j] == '\\' else 1
+                if self.active():
+                    self.emit(text[i:j + 1])
+                i = j + 1
+            elif c == '`':
+                i = self.directive(text, i + 1, filename, depth)
+            elif isIdentChar(c):
+                j = i
+                while j < n and isIdentChar(text[j]):
+                    j += 1
+                if self.active():
+                    self.emit(text[i:j])
+                i = j
+            elif c.isspace():
+                i += 1
+            elif text.startswith('::', i):
+                if self.active():
+                    self.emit('::')
+                i += 2
+            else:
+                if self.active():
+                    self.emit(c)
+                i += 1
+
+    def readName(self, text, i):
+        n = len(text)
+        while i < n and text[i] in ' \t':
+            i += 1
+        j = i
+        while j < n and isIdentChar(text[j]):
+            j += 1
+        return text[i:j], j
+
+    def readLine(self, text, i):
+        """reads up to the end of the line, honoring backslash continuations"""
+        parts = []
+        n = len(text)
+        while True:
+            j = text.find('\n', i)
+            j = n if j < 0 else j
+            line = text[i:j]
+            if line.endswith('\\'):
+                parts.append(line[:-1])
+                i = j + 1
+            else:
+                parts.append(line)
+                return "\n".join(parts), j
+
+    def directive(self, text, i, filename, depth):
+        name, i = self.readName(text, i)
+        if name in ('ifdef', 'ifndef', 'elsif'):
+            macro, i = self.readName(text, i)
+            self.referenced.add(macro)
+            defined = macro in self.macros
+            if name == 'elsif':
+                if self.conditions:
+                    c = self.conditions[-1]
+                    c[0] = defined and not c[1]
+                    c[1] = c[1] or c[0]
+            else:
+                taken = defined if name == 'ifdef' else not defined
+                self.conditions.append([taken, taken])
+        elif name == 'else':
+            if self.conditions:
+                c = self.conditions[-1]
+                c[0] = not c[1]
+                c[1] = True
+        elif name == 'endif':
+            if self.conditions:
+                self.conditions.pop()
+        elif name == 'define':
+            line, i = self.readLine(text, i)
+            if self.active():
+                self.define(line)
+        elif name == 'undef':
+            macro, i = self.readName(text, i)
+            if self.active():
+                self.macros.pop(macro, None)
+        elif name == 'include':
+            line, i = self.readLine(text, i)
+            target = line.strip().strip('"<>').strip()
+            if self.active() and target:
+                path = self.resolveInclude(target, filename)
+                if path:
+                    if path not in self.includes:
+                        self.includes.append(path)
+                    with open(path, "r", errors="replace") as f:
+                        self.run(f.read(), path, depth + 1)
+                else:
+                    for candidate in self.includeCandidates(target, filename):
+                        if candidate not in self.missingIncludes:
+                            self.missingIncludes.append(candidate)
+        elif name in ('line', 'resetall', 'timescale'):
+            _, i = self.readLine(text, i)
+        elif name:
+            self.referenced.add(name)
+            if self.active() and name in self.macros:
+                params, body = self.macros[name]
+                if params is not None:
+                    args, i = self.readArguments(text, i)
+                    for p, a in zip(params, args):
+                        body = self.substitute(body, p, a)
+                self.run(body, filename, depth + 1)
+        return i
+
+    def define(self, line):
+        name, j = self.readName(line, 0)
+        if not name:
+            return
+        params = None
+        if line[j:j + 1] == '(':
+            k = line.find(')', j)
+            if k > 0:
+                params = [p.strip() for p in line[j + 1:k].split(',') if p.strip()]
+                j = k + 1
+        body = line[j:]
+        k = body.find('//')
+        if k >= 0:
+            body = body[:k]
+        self.macros[name] = (params, body.strip())
+
+    def readArguments(self, text, i):
+        n = len(text)
+        while i < n and text[i].isspace():
+            i += 1
+        if i >= n or text[i] != '(':
+            return [], i
+        args = []
+        level = 0
+        start = i + 1
+        for j in range(i, n):
+            if text[j] == '(':
+                level += 1
+            elif text[j] == ')':
+                level -= 1
+                if level == 0:
+                    args.append(text[start:j].strip())
+                    return args, j + 1
+            elif text[j] == ',' and level == 1:
+                args.append(text[start:j].strip())
+                start = j + 1
+        return args, n
+
+    def substitute(self, body, param, arg):
+        out = []
+        i = 0
+        n = len(body)
+        while i < n:
+            if isIdentChar(body[i]):
+                j = i
+                while j < n and isIdentChar(body[j]):
+                    j += 1
+                out.append(arg if body[i:j] == param and (i == 0 or body[i - 1] != '`') else body[i:j])
+                i = j
+            else:
+                out.append(body[i])
+                i += 1
+        return "".join(out)
+
+def preprocess(filename, defines, searchPath, text=None):
+    """returns the imports, included files, unresolved include paths and referenced macros of a BSV file
+    as bsc would see them with the given command line defines"""
+    p = Preprocessor(defines, searchPath)
+    if text is None:
+        with open(filename, "r", errors="replace") as f:
+            text = f.read()
+    p.run(text, filename)
+    return {"imports": p.imports, "includes": p.includes, "missingIncludes": p.missingIncludes, "macros": sorted(p.referenced), "testModules": p.testModules}
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import json
+
+def loadGraph(filename):
+    with open(filename, "r") as f:
+        graph = json.load(f)
+    if graph.get("version") != 1:
+        raise ValueError("Unsupported graph version in {}".format(filename))
+    return graph
+
+def decodeBits(graph, bits):
+    """returns the packages of a hex bitset, in topological order"""
+    value = int(bits, 16) if bits else 0
+    order = graph["order"]
+    return [order[i] for i, b in enumerate(reversed(bin(value)[2:])) if b == '1']
+
+def packagesForFiles(graph, files):
+    """maps changed files (sources or included files) to the packages using them"""
+    changed = {os.path.realpath(f) for f in files}
+    result = []
+    for name in graph["order"]:
+        p = graph["packages"][name]
+        used = [p["path"]] + p["includes"]
+        if any(os.path.realpath(f) in changed for f in used):
+            result.append(name)
+    return result
+
+def affectedPackages(graph, packages):
+    """packages that have to be rebuilt if packages change, in build order"""
+    bits = 0
+    for name in packages:
+        p = graph["packages"][name]
+        bits |= (1 << p["index"]) | int(p["reverseClosure"] or "0", 16)
+    return decodeBits(graph, format(bits, 'x'))
+
+def importedPackages(graph, name):
+    return decodeBits(graph, graph["packages"][name]["closure"])
+
+def importingPackages(graph, name):
+    return decodeBits(graph, graph["packages"][name]["reverseClosure"])
+
+def printResult(cli, packages, graph):
+    if cli.json:
+        print(json.dumps({"packages": packages, "total": len(graph["order"])}))
+    else:
+        for p in packages:
+            print(p)
+        print("{} of {} packages".format(len(packages), len(graph["order"])), file=sys.stderr)
+
+def affected(cli, graph):
+    changed = packagesForFiles(graph, cli.changed) + [p for p in cli.packages if p in graph["packages"]]
+    printResult(cli, affectedPackages(graph, changed), graph)
+
+def imports(cli, graph):
+    printResult(cli, importedPackages(graph, cli.package), graph)
+
+def importers(cli, graph):
+    printResult(cli, importingPackages(graph, cli.package), graph)
+
+commands = {'affected': affected, 'imports': imports, 'importers': importers}
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the package graph written by bsvDeps.py --json.')
+    parser.add_argument('--graph', default="build/current/deps.json", type=str)
+    parser.add_argument('--json', help='Print machine readable output', action='store_true')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('affected', help='Packages rebuilt when the given files or packages change')
+    p.add_argument('--changed', nargs='+', default=[], type=str, help='Changed source or include files')
+    p.add_argument('--packages', nargs='+', default=[], type=str, help='Changed packages')
+    p = sub.add_parser('imports', help='Packages transitively imported by a package')
+    p.add_argument('package', type=str)
+    p = sub.add_parser('importers', help='Packages transitively importing a package')
+    p.add_argument('package', type=str)
+    cli = parser.parse_args()
+
+    try:
+        graph = loadGraph(cli.graph)
+    except (OSError, ValueError) as e:
+        print("Could not load dependency graph: {}".format(e))
+        sys.exit(1)
+    if getattr(cli, 'package', None) is not None and cli.package not in graph["packages"]:
+        print("Unknown package {}".format(cli.package))
+        sys.exit(1)
+    commands[cli.command](cli, graph)
+
+if __name__ == '__main__':
+    main()
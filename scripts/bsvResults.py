@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Test results: history store, JSON/JUnit reports and detection of slowdowns
+# against the previous runs of a test.
+
+import os
+import json
+import math
+import time
+import subprocess
+import xml.etree.ElementTree as ET
+
+# Phases compared against the history
+phases = ['compile', 'link', 'sim']
+
+# How a test was run. A single binary only has a sim phase, and its sim times
+# are not comparable to those of a matrix run.
+modes = ['matrix', 'single_binary']
+
+def gitRevision():
+    t = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return t.stdout.decode().strip() or None
+
+def loadHistory(filename):
+    """returns all recorded runs, oldest first"""
+    runs = []
+    try:
+        with open(filename, "r") as f:
+            for line in f:
+                try:
+                    runs.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return runs
+
+def appendHistory(filename, results):
+    """one line per test run, appending keeps concurrent writers from
+    clobbering each other"""
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+    revision = gitRevision()
+    lines = []
+    for r in results:
+        entry = {"time": now, "revision": revision}
+        entry.update({k: r.get(k) for k in ["test", "mode", "passed", "seconds", "phases", "simMaxRss", "cycles"]})
+        lines.append(json.dumps(entry, sort_keys=True) + "\n")
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "a") as f:
+        f.write("".join(lines))
+
+def baseline(history, test, mode, phase, window):
+    """durations of the last window passing runs of test in the same mode.
+    Runs recorded without a mode were matrix runs."""
+    values = [h["phases"][phase] for h in history
+              if h.get("test") == test and (h.get("mode") or modes[0]) == mode and h.get("passed")
+              and (h.get("phases") or {}).get(phase) is not None]
+    return values[-window:]
+
+def findSlowdowns(history, results, window=10, minRuns=3, sigma=3.0, threshold=0.1):
+    """compares every phase of the passing results against the mean of the
+    previous runs. A phase is slower if it exceeds the mean by more than sigma
+    standard deviations and by more than threshold relative to the mean."""
+    slowdowns = []
+    for r in results:
+        if not r["passed"]:
+            continue
+        for phase in phases:
+            current = (r.get("phases") or {}).get(phase)
+            mode = r.get("mode") or modes[0]
+            values = baseline(history, r["test"], mode, phase, window)
+            if current is None or len(values) < minRuns:
+                continue
+            mean = sum(values) / len(values)
+            stdev = math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+            if current > mean + sigma * stdev and current > mean * (1 + threshold):
+                slowdowns.append({"test": r["test"], "mode": mode, "phase": phase, "seconds": current,
+                                  "mean": mean, "stdev": stdev, "runs": len(values)})
+    return slowdowns
+
+def writeJson(filename, results, slowdowns):
+    with open(filename, "w") as f:
+        json.dump({"results": results, "slowdowns": slowdowns}, f, indent=1, sort_keys=True)
+        f.write("\n")
+
+def logTail(filename, lines=50):
+    try:
+        with open(filename, "r", errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+    except OSError:
+        return ""
+
+def writeJunit(filename, results, skipped=[]):
+    suite = ET.Element("testsuite", name="bsv", tests=str(len(results) + len(skipped)),
+                       failures=str(len([r for r in results if not r["passed"]])), skipped=str(len(skipped)),
+                       time="{:.3f}".format(sum(r["seconds"] for r in results)))
+    for r in results:
+        case = ET.SubElement(suite, "testcase", classname="bsv", name=r["test"], time="{:.3f}".format(r["seconds"]))
+        props = ET.SubElement(case, "properties")
+        for phase, seconds in sorted((r.get("phases") or {}).items()):
+            ET.SubElement(props, "property", name="{}_seconds".format(phase), value="{:.3f}".format(seconds))
+        for k in ["simMaxRss", "cycles"]:
+            if r.get(k) is not None:
+                ET.SubElement(props, "property", name=k, value=str(r[k]))
+        if not r["passed"]:
+            failure = ET.SubElement(case, "failure", message=r.get("failure") or "Test failed")
+            failure.text = logTail(r["log"])
+    for t in skipped:
+        case = ET.SubElement(suite, "testcase", classname="bsv", name=t, time="0")
+        ET.SubElement(case, "skipped", message="not affected")
+    ET.ElementTree(suite).write(filename, encoding="utf-8", xml_declaration=True)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import re
+import time
+import select
+import signal
+import argparse
+import json
+import resource
+import subprocess
+import collections
+
+# Lines longer than this are split, a simulator printing without newlines
+# cannot grow the buffer without bound.
+maxLineLength = 1 << 16
+# Matches kept with their context for the report
+maxMatches = 10
+# Simulated time reported by $finish, e.g. "$finish called at time 1200" or
+# "tb.v:10: $finish(1) called at 1200 (1ps)". Cycles printed by the design
+# during the simulation need an explicit --cycle_pattern.
+defaultCyclePattern = r'\$finish(?:\(\d\))? called at (?:time )?(\d+)'
+
+class SimMonitor:
+    """matches simulator output line by line against failure and success
+    patterns. Only the last window lines and the context of matches are kept."""
+    def __init__(self, failPatterns, successPattern=None, cyclePattern=None, maxCycles=None, window=200, context=5):
+        self.fail = [re.compile(p) for p in failPatterns]
+        self.success = re.compile(successPattern) if successPattern else None
+        self.cyclePattern = re.compile(cyclePattern or defaultCyclePattern)
+        self.maxCycles = maxCycles
+        self.context = context
+        self.tail = collections.deque(maxlen=window)
+        self.matches = []
+        # matches still collecting lines after the match
+        self.pending = []
+        self.succeeded = False
+        self.cycles = None
+        self.failure = None
+        self.lines = 0
+
+    def feed(self, line):
+        """processes one line, returns False once the simulation should be stopped"""
+        self.lines += 1
+        for m in self.pending:
+            m["after"].append(line)
+        self.pending = [m for m in self.pending if len(m["after"]) < self.context]
+        c = self.cyclePattern.search(line)
+        if c and any(c.groups()):
+            self.cycles = int(next(g for g in c.groups() if g))
+            if self.maxCycles is not None and self.cycles > self.maxCycles:
+                self.failure = "Cycle limit of {} exceeded".format(self.maxCycles)
+        for p in self.fail:
+            if p.search(line):
+                self.record(line)
+                self.failure = self.failure or "Failure pattern '{}' matched in line {}".format(p.pattern, self.lines)
+                break
+        else:
+            if self.success and self.success.search(line):
+                self.succeeded = True
+                self.record(line)
+        self.tail.append(line)
+        return self.failure is None
+
+    def record(self, line):
+        if len(self.matches) < maxMatches:
+            m = {"line": self.lines, "before": list(self.tail)[-self.context:] if self.context else [], "text": line, "after": []}
+            self.matches.append(m)
+            if self.context:
+                self.pending.append(m)
+
+    def finish(self, returncode):
+        """returns the failure reason or None if the simulation passed"""
+        if self.failure:
+            return self.failure
+        if returncode != 0:
+            return "Simulator exited with {}".format(returncode)
+        if self.success and not self.succeeded:
+            return "Success pattern '{}' not found".format(self.success.pattern)
+        return None
+
+    def report(self, tail=True):
+        out = []
+        for m in self.matches:
+            out.append("--- line {} ---".format(m["line"]))
+            out += m["before"] + ["> " + m["text"]] + m["after"]
+        if tail:
+            out.append("--- last {} lines ---".format(len(self.tail)))
+            out += list(self.tail)
+        return "\n".join(out) + "\n"
+
+def stop(p, grace=5):
+    """terminates the simulator and everything it started"""
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+        p.wait(grace)
+    except subprocess.TimeoutExpired:
+        os.killpg(p.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    p.wait()
+
+def run(command, monitor, timeout=None, echo=True, drain=0.5):
+    """runs command, feeding its output to monitor. Returns the failure reason
+    or None. After a failure, output is read for at most drain seconds to
+    complete the context of the match before the simulator is stopped."""
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    deadline = time.monotonic() + timeout if timeout else None
+    fd = p.stdout.fileno()
+    pending = b""
+    try:
+        while not (monitor.failure and not monitor.pending):
+            wait = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([fd], [], [], wait)
+            if not ready:
+                monitor.failure = monitor.failure or "Timeout after {}s".format(timeout)
+                break
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                if pending:
+                    monitor.feed(pending.decode(errors="replace"))
+                break
+            if echo:
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.flush()
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            if len(pending) > maxLineLength:
+                lines.append(pending)
+                pending = b""
+            for l in lines:
+                if not monitor.feed(l.decode(errors="replace").rstrip("\r")) and drain is not None:
+                    deadline = min(deadline or float('inf'), time.monotonic() + drain)
+                    drain = None
+    except KeyboardInterrupt:
+        monitor.failure = "Interrupted"
+    if p.poll() is None:
+        stop(p)
+    p.stdout.close()
+    return monitor.finish(p.wait())
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a simulation and check its output while it is running.')
+    parser.add_argument('--fail', nargs='+', default=['ERROR'], type=str, help='Regular expressions stopping the simulation as failed')
+    parser.add_argument('--success', default=None, type=str, help='Regular expression that has to appear for the simulation to pass')
+    parser.add_argument('--timeout', default=None, type=float, help='Wall clock limit in seconds')
+    parser.add_argument('--cycle_pattern', default=None, type=str, help='Regular expression whose first matching group is the current cycle')
+    parser.add_argument('--max_cycles', default=None, type=int, help='Cycle limit')
+    parser.add_argument('--window', default=200, type=int, help='Number of trailing lines kept for the report')
+    parser.add_argument('--context', default=5, type=int, help='Lines kept before and after a match')
+    parser.add_argument('--report', default=None, type=str, help='Write matches and trailing lines to this file')
+    parser.add_argument('--stats', default=None, type=str, help='Write run time, peak memory and simulated cycles as JSON to this file')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    cli = parser.parse_args()
+
+    command = cli.command[1:] if cli.command[:1] == ['--'] else cli.command
+    if not command:
+        parser.error("simulator command missing")
+
+    monitor = SimMonitor(cli.fail, cli.success, cli.cycle_pattern, cli.max_cycles, cli.window, cli.context)
+    start = time.monotonic()
+    failure = run(command, monitor, cli.timeout)
+    if cli.stats:
+        with open(cli.stats, "w") as f:
+            json.dump({
+                "failure": failure,
+                "seconds": time.monotonic() - start,
+                # kilobytes, largest of the simulator and the processes it started
+                "maxRss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                "cycles": monitor.cycles,
+                "lines": monitor.lines
+            }, f)
+    if cli.report:
+        with open(cli.report, "w") as f:
+            f.write(monitor.report())
+    if failure:
+        print("Simulation failed: {}".format(failure))
+        if monitor.matches:
+            print(monitor.report(tail=False), end='')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import subprocess
+import json
+import fnmatch
+import time
+import concurrent.futures
+from bsvQuery import loadGraph, packagesForFiles, affectedPackages, importedPackages
+from bsvResults import loadHistory, appendHistory, findSlowdowns, writeJson, writeJunit
+from bsvTestbench import testPlusarg
+
+# Changed files that are not part of the package graph but cannot influence a
+# simulation. Any other unknown file (C++ models, Makefile, deleted or renamed
+# packages, ...) selects all tests.
+ignoredExtensions = ['.md', '.txt']
+simMonitor = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bsvSimMonitor.py")
+
+def makeVariable(make, target, args=[]):
+    """runs a rules.mk helper target that prints a single value"""
+    t = subprocess.run([make, "-s", "--no-print-directory", target] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if t.returncode != 0:
+        sys.stdout.write(t.stdout.decode(errors="replace"))
+        sys.stdout.write(t.stderr.decode(errors="replace"))
+        print("Running {} {} failed.".format(make, target))
+        sys.exit(1)
+    return t.stdout.decode().strip().splitlines()[-1]
+
+def projectGraph(cli):
+    # Any make invocation regenerates the graph of the current configuration
+    return loadGraph(cli.graph or makeVariable(cli.make, "deps_graph"))
+
+def gitChangedFiles(rev):
+    top = subprocess.run(["git", "rev-parse", "--show-toplevel"], stdout=subprocess.PIPE).stdout.decode().strip()
+    if not top:
+        print("Not inside a git repository.")
+        sys.exit(1)
+    files = []
+    for cmd in (["git", "diff", "--name-only", rev, "--"], ["git", "ls-files", "--others", "--exclude-standard", "--full-name"]):
+        t = subprocess.run(cmd, cwd=top, stdout=subprocess.PIPE)
+        if t.returncode != 0:
+            print("{} failed.".format(" ".join(cmd)))
+            sys.exit(1)
+        files += [os.path.join(top, f) for f in t.stdout.decode().splitlines() if f]
+    return files
+
+def testPackages(graph):
+    return [p for p in graph["order"] if graph["packages"][p]["test"]]
+
+def impactedTests(graph, files, testbench):
+    """returns (impacted tests, reason per impacted test)"""
+    tests = testPackages(graph)
+    changed = []
+    for f in files:
+        packages = packagesForFiles(graph, [f])
+        if packages:
+            changed += packages
+        elif os.path.splitext(f)[1] not in ignoredExtensions:
+            return tests, {t: "{} changed".format(os.path.relpath(f)) for t in tests}
+    affected = set(affectedPackages(graph, changed))
+    # The testbench and everything it imports besides the selected test is shared by all tests
+    if testbench in graph["packages"]:
+        common = {testbench}
+        for i in graph["packages"][testbench]["imports"]:
+            if i not in tests:
+                common |= {i} | set(importedPackages(graph, i))
+        shared = sorted(common & set(changed))
+        if shared:
+            return tests, {t: "{} changed".format(shared[0]) for t in tests}
+    impacted = [t for t in tests if t in affected]
+    reasons = {}
+    for t in impacted:
+        direct = [c for c in changed if c == t or c in importedPackages(graph, t)]
+        reasons[t] = "{} changed".format(direct[0] if direct else t)
+    return impacted, reasons
+
+def selectTests(graph, patterns):
+    tests = testPackages(graph)
+    if not patterns:
+        return tests
+    selected = []
+    for p in patterns:
+        matches = fnmatch.filter(tests, p)
+        if not matches:
+            print("No test matches {}".format(p))
+            sys.exit(1)
+        selected += [m for m in matches if m not in selected]
+    return selected
+
+def matrixArgs(cli, tests):
+    """make arguments shared by all tests of a run. Every RUN_TEST value builds
+    in its own configuration directory, packages that do not depend on the test
+    are shared through the compile cache."""
+    cacheDir = os.getenv('BSV_CACHE_DIR') or os.path.abspath(os.path.join(cli.log_dir, "cache"))
+    return ["BSV_CACHE_DIR={}".format(cacheDir), "BUILD_CONFIGS_KEEP={}".format(len(tests) + 8)] + cli.make_args
+
+def statsFile(cli, test):
+    return os.path.abspath(os.path.join(cli.log_dir, "{}.stats.json".format(test)))
+
+def runPhases(cli, test, mode, phases, cwd=None):
+    """runs the (phase, command) steps of a test into its log file, stopping at
+    the first failing step. The simulation step writes the statistics of
+    bsvSimMonitor.py to statsFile. mode (see bsvResults.modes) is recorded
+    with the result."""
+    os.makedirs(cli.log_dir, exist_ok=True)
+    logfile = os.path.join(cli.log_dir, "{}.log".format(test))
+    stats = statsFile(cli, test)
+    if os.path.exists(stats):
+        os.remove(stats)
+    result = {"test": test, "mode": mode, "passed": True, "failure": None, "phases": {}, "simMaxRss": None, "cycles": None, "log": logfile}
+    with open(logfile, "w") as log:
+        for phase, command in phases:
+            start = time.time()
+            ret = subprocess.call(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+            result["phases"][phase] = time.time() - start
+            if ret != 0:
+                result["passed"] = False
+                result["failure"] = "{} failed".format(phase)
+                break
+    try:
+        with open(stats, "r") as f:
+            s = json.load(f)
+        result["simMaxRss"] = s["maxRss"]
+        result["cycles"] = s["cycles"]
+        result["failure"] = s["failure"] or result["failure"]
+    except (OSError, ValueError, KeyError):
+        pass
+    result["seconds"] = sum(result["phases"].values())
+    print("{} {} ({:.1f}s)".format("PASS" if result["passed"] else "FAIL", test, result["seconds"]), flush=True)
+    return result
+
+def runTest(cli, test, args):
+    make = [cli.make, "--no-print-directory"]
+    args = ["RUN_TEST={}".format(test)] + args
+    # Link and sim skip the bsc -u check of compile, their times only cover linking and simulating
+    return runPhases(cli, test, "matrix", [
+        ("compile", make + ["compile"] + args),
+        ("link", make + ["link", "COMPILED=1"] + args),
+        ("sim", make + ["sim", "COMPILED=1", "SIM_STATS={}".format(statsFile(cli, test))] + args)])
+
+def runMatrix(cli, tests):
+    """builds and simulates tests concurrently, returns one result per test"""
+    if not tests:
+        return []
+    args = matrixArgs(cli, tests)
+    # Compile the packages shared by all tests once before fanning out
+    print("Compiling shared packages")
+    subprocess.call([cli.make, "--no-print-directory", "compile", "RUN_TEST={}".format(tests[0])] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=cli.jobs) as pool:
+        results = list(pool.map(lambda t: runTest(cli, t, args), tests))
+    return results
+
+def runSingleBinary(cli, tests):
+    """builds one simulation binary containing all tests and runs the tests as
+    concurrent processes, selected with +test=<package>:"""
+    if not tests:
+        return []
+    print("Building simulation binary")
+    binary = makeVariable(cli.make, "sim_binary", ["MULTI_TEST=1"] + cli.make_args)
+    command = lambda t: [simMonitor, "--stats", statsFile(cli, t), "--", "./" + os.path.basename(binary)] + cli.sim_args + [testPlusarg(t)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=cli.jobs) as pool:
+        return list(pool.map(lambda t: runPhases(cli, t, "single_binary", [("sim", command(t))], os.path.dirname(binary)), tests))
+
+def printSummary(results, skipped=[], slowdowns=[]):
+    width = max([len(r["test"]) for r in results] + [len(t) for t in skipped] + [4])
+    print("{:{w}}  {:7}  {:>9}  {:>9}  {:>9}  {:>9}  {:>12}  {:>9}".format("Test", "Result", "Compile", "Link", "Sim", "Total", "Cycles", "Sim RSS", w=width))
+    for r in results:
+        times = ["{:8.1f}s".format(r["phases"][p]) if p in r["phases"] else "        -" for p in ["compile", "link", "sim"]]
+        cycles = "-" if r["cycles"] is None else r["cycles"]
+        rss = "-" if r["simMaxRss"] is None else "{}M".format(r["simMaxRss"] // 1024)
+        print("{:{w}}  {:7}  {}  {:>8.1f}s  {:>12}  {:>9}".format(r["test"], "PASS" if r["passed"] else "FAIL", "  ".join(times), r["seconds"], cycles, rss, w=width))
+    for t in skipped:
+        print("{:{w}}  {:7}".format(t, "SKIPPED", w=width))
+    failed = [r for r in results if not r["passed"]]
+    print("{} tests run, {} failed, {} skipped".format(len(results), len(failed), len(skipped)))
+    for s in slowdowns:
+        print("SLOWER: {} {} took {:.1f}s, previously {:.1f}s +- {:.1f}s over {} runs".format(s["test"], s["phase"], s["seconds"], s["mean"], s["stdev"], s["runs"]))
+    for r in failed:
+        print("FAILED: {} ({}, see {})".format(r["test"], r["failure"], r["log"]))
+    return not failed
+
+def report(cli, results, skipped=[]):
+    """records the results in the history and prints the summary. Returns
+    False if a test failed (or became slower with --fail_on_slowdown)."""
+    slowdowns = []
+    if cli.history:
+        slowdowns = findSlowdowns(loadHistory(cli.history), results, cli.history_window)
+        appendHistory(cli.history, results)
+    if cli.json:
+        writeJson(cli.json, results, slowdowns)
+    if cli.junit:
+        writeJunit(cli.junit, results, skipped)
+    passed = printSummary(results, skipped, slowdowns)
+    return passed and not (slowdowns and cli.fail_on_slowdown)
+
+def affected(cli):
+    graph = projectGraph(cli)
+    files = list(cli.changed)
+    if cli.git:
+        files += gitChangedFiles(cli.git)
+    impacted, reasons = impactedTests(graph, files, cli.testbench)
+    skipped = [t for t in testPackages(graph) if t not in impacted]
+    for t in impacted:
+        print("Affected: {} ({})".format(t, reasons[t]))
+    for t in skipped:
+        print("Skipped:  {} (not affected)".format(t))
+    if not cli.run:
+        return
+    if not report(cli, runMatrix(cli, impacted), skipped):
+        sys.exit(1)
+
+def run(cli):
+    graph = projectGraph(cli)
+    tests = selectTests(graph, cli.tests)
+    runner = runSingleBinary if cli.single_binary else runMatrix
+    if not report(cli, runner(cli, tests)):
+        sys.exit(1)
+
+commands = {'affected': affected, 'run': run}
+
+def main():
+    parser = argparse.ArgumentParser(description='Test selection and execution for BSV projects.')
+    parser.add_argument('--make', default=os.getenv('MAKE', 'make'), type=str)
+    parser.add_argument('--graph', default=None, type=str, help='Dependency graph (default: ask make for the current one)')
+    parser.add_argument('--testbench', default='Testbench', type=str, help='Package of the testbench')
+    parser.add_argument('--make_args', nargs='+', default=[], type=str, help='Additional make arguments')
+    parser.add_argument('--jobs', default=os.cpu_count(), type=int, help='Number of tests run concurrently')
+    parser.add_argument('--log_dir', default='build/tests', type=str, help='Directory for per test logs')
+    parser.add_argument('--history', default='.bsv_test_history', type=str, help='Append the results to this file, empty to disable')
+    parser.add_argument('--history_window', default=10, type=int, help='Number of previous runs a test is compared against')
+    parser.add_argument('--fail_on_slowdown', help='Fail if a test became significantly slower', action='store_true')
+    parser.add_argument('--json', default=None, type=str, help='Write the results as JSON to this file')
+    parser.add_argument('--junit', default=None, type=str, help='Write the results as JUnit XML to this file')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('affected', help='Select (and run) the tests affected by a change')
+    p.add_argument('--changed', nargs='+', default=[], type=str, help='Changed files')
+    p.add_argument('--git', default=None, type=str, help='Use the files changed since this git revision')
+    p.add_argument('--run', help='Build and simulate the affected tests', action='store_true')
+    p = sub.add_parser('run', help='Build and simulate tests concurrently')
+    p.add_argument('tests', nargs='*', type=str, help='Tests or glob patterns (default: all tests)')
+    p.add_argument('--single_binary', help='Compile and link all tests into one simulation binary', action='store_true')
+    p.add_argument('--sim_args', nargs='+', default=[], type=str, help='Additional simulator arguments (with --single_binary)')
+    cli = parser.parse_args()
+
+    commands[cli.command](cli)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Testbench of MULTI_TEST, instantiating every package that provides a
+# TestHandler in one simulation binary. Written by bsvDeps.py on every make,
+# so it does not import the Vivado tooling of bsvTools.py.
+
+testbenchAllTemp = """// Generated by BSVTools from the packages providing a TestHandler. Do not edit.
+package {package};
+    import StmtFSM :: *;
+
+    import TestHelper :: *;
+
+{imports}
+
+    // Tests are selected at runtime with +test=<package>: (repeatable), no
+    // +test argument runs all tests.
+    (* synthesize *)
+    module [Module] {module}();
+{instances}
+
+        Reg#(Bool) noneSelected <- mkReg(False);
+{selected}
+
+        Stmt s = {{
+            seq
+                action
+                    Bool any <- $test$plusargs("test=");
+                    noneSelected <= !any;
+{plusargs}
+{select}
+                endaction
+{runs}
+            endseq
+        }};
+        mkAutoFSM(s);
+    endmodule
+
+endpackage
+"""
+
+def testPlusarg(test):
+    """the argument selecting test. $test$plusargs matches prefixes, the
+    terminating colon keeps +test=TestsAB from selecting TestsA."""
+    return "+test={}:".format(test)
+
+def testbenchSource(package, tests):
+    """returns a testbench running all tests in one simulation binary"""
+    lines = {k: [] for k in ['imports', 'instances', 'selected', 'plusargs', 'select', 'runs']}
+    for i, t in enumerate(tests):
+        lines['imports'].append("    import {} :: *;".format(t))
+        lines['instances'].append("        TestHandler test{} <- mk{}();".format(i, t))
+        lines['selected'].append("        Reg#(Bool) selected{} <- mkReg(False);".format(i))
+        lines['plusargs'].append("                    Bool t{} <- $test$plusargs(\"{}\");".format(i, testPlusarg(t)[1:]))
+        lines['select'].append("                    selected{} <= t{};".format(i, i))
+        lines['runs'].append("""                if (noneSelected || selected{i}) seq
+                    $display("Running test {t}");
+                    test{i}.go();
+                    await(test{i}.done());
+                endseq""".format(i=i, t=t))
+    return testbenchAllTemp.format(package=package, module="mk" + package, **{k: "\n".join(v) for k, v in lines.items()})
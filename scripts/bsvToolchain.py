@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Locations of bsc, the Bluespec library and Vivado. Every tool is looked up
+# on first use only and the result is kept in the .bsv_tools file of the
+# project, valid as long as PATH and the tool binary are unchanged.
+
+import os
+import re
+import json
+import hashlib
+import subprocess
+from shutil import which
+from bsvFiles import stamp
+
+machineFile = ".bsv_tools"
+# Make ignores the line, it is a comment
+cachePrefix = "# bsvTools toolchain: "
+
+def findMachineFile(start):
+    """the .bsv_tools file of the project containing start"""
+    path = os.path.abspath(start)
+    while True:
+        candidate = os.path.join(path, machineFile)
+        if os.path.isfile(candidate):
+            return candidate
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def pathHash():
+    return hashlib.sha1(os.getenv("PATH", "").encode()).hexdigest()[:16]
+
+class Toolchain:
+    def __init__(self, start="."):
+        self.file = findMachineFile(start)
+        self.cache = self.load()
+        self.converted = {}
+
+    def load(self):
+        if not self.file:
+            return {}
+        try:
+            with open(self.file, "r") as f:
+                for l in f:
+                    if l.startswith(cachePrefix):
+                        return json.loads(l[len(cachePrefix):])
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def store(self):
+        if not self.file:
+            return
+        try:
+            with open(self.file, "r") as f:
+                lines = [l for l in f if not l.startswith(cachePrefix)]
+            lines.append(cachePrefix + json.dumps(self.cache, sort_keys=True) + "\n")
+            tmp = "{}.{}.tmp".format(self.file, os.getpid())
+            with open(tmp, "w") as f:
+                f.write("".join(lines))
+            os.replace(tmp, self.file)
+        except OSError:
+            pass
+
+    def valid(self, entry):
+        try:
+            return entry["path"] is not None and entry["env"] == pathHash() and stamp(entry["path"]) == entry["stamp"]
+        except (OSError, KeyError, TypeError):
+            return False
+
+    def lookup(self, name, probe=None):
+        """returns the cache entry of the tool name: its path and the result of
+        probe(path), which only runs if the tool changed"""
+        entry = self.cache.get(name)
+        if entry is not None and self.valid(entry):
+            return entry
+        path = which(name)
+        entry = {"path": path and os.path.realpath(path), "env": pathHash(), "stamp": path and stamp(path)}
+        if path and probe:
+            entry["info"] = probe(path)
+        self.cache[name] = entry
+        if path:
+            self.store()
+        return entry
+
+    def bluespecDir(self):
+        """BLUESPECDIR or the Bluespec directory reported by bsc, '' if unknown"""
+        if os.getenv("BLUESPECDIR"):
+            return os.getenv("BLUESPECDIR")
+        def probe(bsc):
+            t = subprocess.run([bsc, "-help"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            m = re.search(r"^Bluespec directory: (.*)$", t.stdout.decode(errors="replace"), re.M)
+            return m.group(1).strip() if m else ''
+        entry = self.lookup("bsc", probe)
+        directory = entry.get("info") or ''
+        if directory and not os.path.isdir(directory):
+            # Installation moved without touching the bsc binary
+            del self.cache["bsc"]
+            directory = self.lookup("bsc", probe).get("info") or ''
+        return directory
+
+    def wsl(self):
+        return os.getenv("WSL_DISTRO_NAME") is not None
+
+    def vivado(self):
+        """path of vivado, None if it is not in the path"""
+        return self.lookup("vivado")["path"]
+
+    def convertPath(self, path):
+        """converts a linux path to the path Vivado sees (the windows path in WSL)"""
+        if not self.wsl():
+            return path
+        if path not in self.converted:
+            process = subprocess.run(["wslpath", "-m", path], capture_output=True)
+            if process.returncode != 0:
+                print("Could not convert {path} to windows path".format(path=path))
+                return path # something went wrong, maybe the path did not exist?
+            self.converted[path] = process.stdout.decode().replace('\n', '') # wslpath ends its output with \n
+        return self.converted[path]
+
+current = None
+
+def toolchain():
+    """the toolchain of the project in the working directory, resolved lazily"""
+    global current
+    if current is None:
+        current = Toolchain()
+    return current
@@ -8,7 +8,16 @@ import shutil
 import glob
 import subprocess
 import re
-from shutil import which
+import signal
+import collections
+import json
+import hashlib
+import fcntl
+import concurrent.futures
+from bsvVivadoServer import VivadoServer, ServerDied
+from bsvVerilog import primitiveIndex, requiredLibraryFiles
+from bsvToolchain import toolchain
+from bsvFiles import hashFile
 
 vendor = "esa.informatik.tu-darmstadt.de"
 createNewProject = """
@@ -47,10 +56,11 @@ close_project -delete
 puts "VIVADO FINISHED SUCCESSFULLY"
 """
 
-def copyBSVVerilog(src, dest):
-    for filename in glob.glob(os.path.join(src, 'Verilog', '*.v')):
-        addLicenseHeader(shutil.copy(filename, dest))
-    for filename in glob.glob(os.path.join(src, 'Verilog.Vivado', '*.v')):
+def copyBSVVerilog(src, dest, topModule):
+    """copies the Bluespec library modules instantiated by topModule from the
+    sources in dest"""
+    sources = [os.path.join(dest, f) for f in os.listdir(dest)]
+    for filename in requiredLibraryFiles(topModule, sources, primitiveIndex(src)):
         addLicenseHeader(shutil.copy(filename, dest))
 
 
@@ -65,83 +75,225 @@ def addLicenseHeader(file):
     open(file, 'w').write(header + f)
 
 def copyNGC(src, dest, exclude):
+    stageFiles([p for p in src if p.endswith('.ngc') and not os.path.basename(p) in exclude], dest, rewrite=False)
+
+def verilogFiles(src, exclude):
+    """the files copyVerilog copies"""
+    extensions = ('.v', '.vhd', '.h', '.sv')
+    files = []
     for path in src:
-        if path.endswith('.ngc'):
-            if not os.path.basename(path) in exclude:
-                    shutil.copy(path, dest)
+        if path.endswith(extensions):
+            candidates = [path]
+        else:
+            candidates = sorted(f for e in extensions for f in glob.glob(os.path.join(path, '*' + e)))
+        files += [f for f in candidates if os.path.basename(f) not in exclude]
+    return files
 
 def copyVerilog(src, dest, exclude):
-    for path in src:
-        if path.endswith('.v') or path.endswith('.vhd') or path.endswith('.h') or path.endswith('.sv'):
-            if not os.path.basename(path) in exclude:
-                    flattenVerilogIncludes(path, dest)
+    stageFiles(verilogFiles(src, exclude), dest)
+
+def stageFiles(files, dest, rewrite=True, jobs=None):
+    """copies files into dest on a thread pool. Files containing an `include are
+    rewritten by flattenVerilogIncludes (if rewrite is set), all others are
+    copied without passing through Python. Of files with the same name the
+    last one is kept."""
+    targets = {}
+    for f in files:
+        targets[os.path.join(dest, os.path.basename(f))] = f
+    def stage(item):
+        dst, src = item
+        if rewrite and hasInclude(src):
+            flattenVerilogIncludes(src, dest)
         else:
-            verilogfiles = glob.glob(os.path.join(path, '*.v'))
-            sysverilogfiles = glob.glob(os.path.join(path, '*.sv'))
-            vhdlfiles = glob.glob(os.path.join(path, '*.vhd'))
-            headerfiles = glob.glob(os.path.join(path, '*.h'))
-            allfiles = verilogfiles + vhdlfiles + headerfiles + sysverilogfiles
-            for filename in allfiles:
-                if not os.path.basename(filename) in exclude:
-                    flattenVerilogIncludes(filename, dest)
-
-def wslpath(path):
-    """converts the linux path to the corresponding windows path"""
-    process = subprocess.run(["wslpath", "-m", path], capture_output=True)
-    wpath = process.stdout.decode().replace('\n', '') # wslpath ends its output with \n
-    if process.returncode != 0:
-        print("Could not convert {path} to windows path".format(path=path))
-        return path # something went wrong, maybe the path did not exist?
-    return wpath
+            copyFile(src, dst)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or min(32, (os.cpu_count() or 1) * 4)) as pool:
+        list(pool.map(stage, targets.items()))
+
+def vivadoCommand():
+    """returns the command starting Vivado and a function converting paths for it"""
+    tools = toolchain()
+    if tools.vivado() is None:
+        print("Could not find \"vivado\". Make sure Vivado is in the path.")
+        sys.exit(1)
+    if tools.wsl():
+        print("Detected that we are running in WSL")
+        return "cmd.exe /c vivado.bat", tools.convertPath # run vivado.bat through cmd.exe
+    return "vivado", tools.convertPath
 
+def renderTcl(tcl, vendor, projectname, ippath, tmpdir, topModule, additional, includes, convert):
+    ippath = convert(ippath) # convert linux paths to windows paths
+    tmpdir = convert(tmpdir)
+    includes = [convert(include) for include in includes]
+    return tcl.format(vendor=vendor,directory=ippath,projectname=projectname,tmpdir=tmpdir,topModule=topModule, additional_parameters=additional, includes=" ".join(includes))
 
 def executeVivado(tcl, vendor, projectname, ippath, tmpdir, topModule, additional, includes):
-    vivadoCmd = "vivado"
-    # check whether we are running in WSL
-    if os.getenv("WSL_DISTRO_NAME") is not None:
-        print("Detected that we are running in WSL")
-        vivadoCmd = "cmd.exe /c vivado.bat" # run vivado.bat through cmd.exe
-        ippath = wslpath(ippath) # convert linux paths to windows paths
-        tmpdir = wslpath(tmpdir)
-        includes = [wslpath(include) for include in includes]
-
-    if which("vivado") is None:
-        print("Could not find \"vivado\". Make sure Vivado is in the path.")
+    render = lambda tmp, convert: renderTcl(tcl, vendor, projectname, ippath, tmp, topModule, additional, includes, convert)
+    usedfiles, tail = runVivado(render, tmpdir)
+    if usedfiles is None:
+        print("\n".join(tail))
+        print("Vivado failed. Check above log for errors.")
         sys.exit(1)
+    print("Vivado finished successfully.")
+    return usedfiles
+
+def showProgress(onLine):
+    """wraps onLine, printing the executed TCL commands (echoed with a leading #)
+    and critical warnings as progress"""
+    count = [0]
+    def show(l):
+        count[0] += 1
+        if l.startswith("# ") or l.startswith("CRITICAL WARNING:"):
+            print(l, flush=True)
+        elif count[0] % 10000 == 0:
+            print("... {} lines of Vivado output".format(count[0]), flush=True)
+        return onLine(l)
+    return show
+
+def streamVivado(cmd, onLine, tailLength=200):
+    """runs Vivado, passing every line of its output to onLine while it is
+    produced. Vivado is stopped as soon as onLine returns False. Returns the
+    exit code and the last lines of the log."""
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    tail = collections.deque(maxlen=tailLength)
+    stopped = False
+    for raw in p.stdout:
+        l = raw.decode(errors="replace").rstrip()
+        tail.append(l)
+        if onLine(l) is False:
+            stopped = True
+            break
+    if stopped:
+        os.killpg(p.pid, signal.SIGTERM)
+    p.stdout.close()
+    return p.wait(), list(tail)
+
+def runScript(render, tmpdir, onLine):
+    """executes the packaging script render(tmpdir, convert) returns. It runs on
+    the Vivado server if one was started (see startVivadoServer), in a new Vivado
+    batch process otherwise. Returns the exit code and the last lines of the output."""
+    vivadoCmd, convert = vivadoCommand()
+    onLine = showProgress(onLine)
+    server = VivadoServer(toolchain().vivado())
+    if server.configured() and not toolchain().wsl():
+        for attempt in range(2):
+            if not server.alive():
+                print("Vivado server is not running, restarting it.")
+                if not server.start():
+                    print("Could not start the Vivado server, using batch mode.")
+                    break
+            try:
+                return server.run(lambda tmp: render(tmp, convert), onLine, timeout=float(os.getenv("BSV_VIVADO_TIMEOUT", "3600")))
+            except ServerDied:
+                print("Vivado server died.")
     with open('temp.tcl', "w+") as f:
-        f.write(tcl.format(vendor=vendor,directory=ippath,projectname=projectname,tmpdir=tmpdir,topModule=topModule, additional_parameters=additional, includes=" ".join(includes)))
-    t = subprocess.Popen(vivadoCmd + " -mode batch -source temp.tcl -nojournal -nolog", shell=True, stdout=subprocess.PIPE).stdout.read()
+        f.write(render(tmpdir, convert))
+    ret, tail = streamVivado(vivadoCmd + " -mode batch -source temp.tcl -nojournal -nolog", onLine)
     os.remove('temp.tcl')
+    return ret, tail
+
+def runVivado(render, tmpdir):
+    """runs a single core script. Vivado is stopped on the first ERROR. Returns
+    the used files (None on failure) and the last lines of the log."""
     usedfiles = []
-    s = t.decode()
-    success = re.search(r"VIVADO FINISHED SUCCESSFULLY", s)
-    if success:
-        print("Vivado finished successfully.")
-    else:
-        print(s)
-        print("Vivado failed. Check above log for errors.")
+    state = {"success": False, "failed": False}
+    def onLine(l):
+        if l.startswith("USED FILE:"):
+            usedfiles.append(l.split(':', 1)[1])
+        elif l.startswith("VIVADO FINISHED SUCCESSFULLY"):
+            state["success"] = True
+        elif l.startswith("ERROR:"):
+            state["failed"] = True
+            return False
+    ret, tail = runScript(render, tmpdir, onLine)
+    if state["failed"] or not state["success"]:
+        return None, tail
+    if ret != 0:
+        print("Vivado exited with {} after finishing.".format(ret))
+    return list(dict.fromkeys(usedfiles)), tail
+
+def startVivadoServer(cli):
+    """starts a Vivado process that stays running and packages the cores of
+    later mkVivado and mkVivadoBatch calls"""
+    if toolchain().wsl():
+        print("The Vivado server is not supported in WSL.")
+        sys.exit(1)
+    vivadoCommand() # exits if Vivado is missing
+    server = VivadoServer(toolchain().vivado())
+    if server.alive():
+        print("Vivado server is already running.")
+        return
+    print("Starting Vivado server (log in {})".format(server.log))
+    if not server.start():
+        print("Vivado server did not start. Check {} for errors.".format(server.log))
         sys.exit(1)
+    print("Vivado server is running.")
 
-    for l in t.splitlines():
-        if l.startswith(b"USED FILE:"):
-            lt = l.split(b':')
-            usedfiles.append(lt[1].decode("utf-8") )
-    return usedfiles
+def stopVivadoServer(cli):
+    vivadoCommand() # exits if Vivado is missing
+    VivadoServer(toolchain().vivado()).stop()
+    print("Vivado server stopped.")
 
 def removeUnused(used, srcpath):
+    used = set(used)
     for filename in os.listdir(srcpath):
         fullname = os.path.join(srcpath, filename)
         if not fullname in used:
             os.unlink(fullname)
 
+includeMarker = b'`include'
+includePattern = re.compile(rb'^\s*`include\s*"(.*)"')
+# Linux ioctl cloning a file on copy-on-write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+
+def hasInclude(filename, blockSize=1 << 20):
+    tail = b""
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            if includeMarker in tail + block:
+                return True
+            tail = block[1 - len(includeMarker):]
+    return False
+
+def copyFile(src, dst):
+    """hardlinks src (with BSV_STAGE_HARDLINKS=1, edits of the source then show
+    up in the core), reflinks it or copies it inside the kernel"""
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if os.getenv("BSV_STAGE_HARDLINKS") == "1":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    pass
+                return
+            except OSError:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
 def flattenVerilogIncludes(src, dst):
-    with open(src, "r") as src_file:
+    """copies src into dst, removing the directories from `include paths"""
+    with open(src, "rb", buffering=1 << 20) as src_file:
         dstFilename = dst + '/' + os.path.basename(src)
-        with open(dstFilename, "w") as dst_file:
+        # Never write through a hardlink into a source
+        if os.path.lexists(dstFilename):
+            os.unlink(dstFilename)
+        with open(dstFilename, "wb", buffering=1 << 20) as dst_file:
             for l in src_file:
-                m = re.search(r'^\s*`include \"(.*)\"', l)
+                m = includePattern.search(l) if includeMarker in l else None
                 if m:
-                    dst_file.write("`include \"" + os.path.basename(m.group(1)) + "\"")
+                    dst_file.write(b"`include \"" + os.path.basename(m.group(1)) + b"\"" + (b"\n" if l.endswith(b"\n") else b""))
                 else:
                     dst_file.write(l)
 
@@ -161,7 +313,7 @@ def parseConstraints(s):
             constraints.append({"path":p, "priority":t})
     return constraints
 
-def processConstraints(s, p):
+def processConstraints(s, p, merge=True):
     additional = ""
     if s:
         os.makedirs(p)
@@ -172,11 +324,63 @@ def processConstraints(s, p):
             shutil.copyfile(cp, p+'/'+filename)
             additional += "add_files -fileset constrs_1 -norecurse {}/{}\n".format(p, filename)
             additional += "set_property PROCESSING_ORDER {} [get_files {}/{}]\n".format(ct, p, filename)
-        additional += "ipx::merge_project_changes files [ipx::current_core]"
+        if merge:
+            additional += "ipx::merge_project_changes files [ipx::current_core]"
     return additional
 
 
-def mkVivado(cli):
+# Used instead of createNewProject if only the constraints of a core changed.
+# The merge also drops the removed constraints if there are no new ones.
+updateConstraints = """
+ipx::edit_ip_in_project -upgrade true -name edit_ip_project -directory {tmpdir} {directory}/component.xml
+ipx::current_core {directory}/component.xml
+foreach f [get_files -quiet -of_objects [get_filesets constrs_1]] {{
+    remove_files $f
+}}
+{additional_parameters}
+ipx::merge_project_changes files [ipx::current_core]
+ipx::update_checksums [ipx::current_core]
+ipx::save_core [ipx::current_core]
+close_project -delete
+puts "VIVADO FINISHED SUCCESSFULLY"
+"""
+
+# Content hashes of the packaging inputs, stored next to component.xml
+inputsName = ".bsv_inputs.json"
+
+def coreInputs(cli, constraints, includefiles):
+    """everything the packaged core depends on, grouped by the steps using it.
+    A different Vivado binary packages the whole core again."""
+    sources = verilogFiles(cli.verilog_dir, cli.exclude) + verilogFiles(includefiles, cli.exclude)
+    sources += [p for p in cli.verilog_dir if p.endswith('.ngc') and os.path.basename(p) not in cli.exclude]
+    vivado = toolchain().lookup("vivado")
+    return {
+        "version": 1,
+        "core": {
+            "settings": [cli.projectname, cli.topModule, cli.vendor, hashlib.sha256(createNewProject.encode()).hexdigest()],
+            "vivado": [vivado["path"], vivado["stamp"]],
+            "sources": {f: hashFile(f) for f in sources},
+            "library": primitiveIndex(cli.bluespec_dir)["fingerprint"],
+            "includes": [os.path.basename(f) for f in includefiles],
+            "additional": list(cli.additional)
+        },
+        "constraints": [[c["path"], c["priority"], hashFile(c["path"])] for c in constraints]
+    }
+
+def loadInputs(ippath):
+    if not os.path.exists(os.path.join(ippath, "component.xml")):
+        return None
+    try:
+        with open(os.path.join(ippath, inputsName), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def prepareCore(cli):
+    """copies the sources of a core into ip/<projectname>. Returns the
+    parameters of the packaging script or None if the core cannot be created.
+    Cores whose inputs did not change are reused (mode skip), if only the
+    constraints changed they are replaced in the existing core (mode constraints)."""
     ippath = "{cwd}/ip/{projectname}".format(projectname=cli.projectname,cwd=os.getcwd())
     srcpath = "{ippath}/src".format(ippath=ippath)
     inclpath = "{ippath}/src".format(ippath=ippath)
@@ -191,74 +395,195 @@ def mkVivado(cli):
                 includefiles.append(filename)
 
     includes = ['{ippath}/src/{file}'.format(ippath=ippath, file=os.path.basename(x)) for x in includefiles]
-    tmpdir = "{cwd}/tmp".format(cwd=os.getcwd())
-    print("Creating project with files in {}".format(cli.verilog_dir[0]))
+    tmpdir = "{cwd}/tmp/{projectname}".format(cwd=os.getcwd(), projectname=cli.projectname)
     for path in cli.verilog_dir:
         if not os.path.exists(path):
             print("Cant find {}".format(path))
-            return
-    if not os.path.exists(srcpath):
-        os.makedirs(srcpath)
-    else:
-        print("{} already exists.".format(srcpath))
-        return
-
+            return None
+    for c in constraints:
+        if not os.path.exists(c["path"]):
+            print("Cant find {}".format(c["path"]))
+            return None
+
+    inputs = coreInputs(cli, constraints, includefiles)
+    previous = loadInputs(ippath)
+    core = {"projectname": cli.projectname, "topModule": cli.topModule, "ippath": ippath, "srcpath": srcpath,
+            "tmpdir": tmpdir, "includes": includes, "inputs": inputs, "tcl": createNewProject}
+    if previous == inputs:
+        print("{} is up to date.".format(cli.projectname))
+        core["mode"] = "skip"
+        return core
     if not os.path.exists(tmpdir):
         os.makedirs(tmpdir)
+    if previous and previous.get("core") == inputs["core"]:
+        print("Updating constraints of {}".format(cli.projectname))
+        shutil.rmtree(constraintpath, ignore_errors=True)
+        core.update({"mode": "constraints", "tcl": updateConstraints, "additional": processConstraints(constraints, constraintpath, merge=False) + '\n'})
+        return core
+
+    print("Creating project with files in {}".format(cli.verilog_dir[0]))
+    if os.path.exists(ippath):
+        shutil.rmtree(ippath)
+    os.makedirs(srcpath)
 
     copyVerilog(cli.verilog_dir, srcpath, cli.exclude)
     if cli.includes:
         copyVerilog(cli.includes, inclpath, cli.exclude)
     copyNGC(cli.verilog_dir, srcpath, cli.exclude)
-    copyBSVVerilog(cli.bluespec_dir, srcpath)
+    copyBSVVerilog(cli.bluespec_dir, srcpath, cli.topModule)
     additional = "\n".join(cli.additional)
     additional += '\n'
 
     additional += processConstraints(constraints, constraintpath)
+    core.update({"mode": "full", "additional": additional})
+    return core
+
+def finishCore(core, used):
+    """removes the files Vivado did not use from the core and records the
+    inputs it was packaged from"""
+    ippath = core["ippath"]
+    if core["mode"] == "full":
+        used_fullpath = []
+        usedNGC = []
+        for usedFile in used:
+            base_file, ext = os.path.splitext(usedFile)
+            used_fullpath.append("{}/src/{}".format(ippath, os.path.basename(usedFile)))
+            ngcFile = base_file + ".ngc"
+            if os.path.exists(ngcFile):
+                usedNGC += [base_file + ".ngc"]
+
+        used = used_fullpath + usedNGC
+        removeUnused(used, core["srcpath"])
+    with open(os.path.join(ippath, inputsName), "w") as f:
+        json.dump(core["inputs"], f, indent=1, sort_keys=True)
 
-    used = executeVivado(createNewProject, cli.vendor, cli.projectname, ippath, tmpdir, cli.topModule, additional, includes)
-    used_fullpath = []
-    usedNGC = []
-    for usedFile in used:
-        base_file, ext = os.path.splitext(usedFile)
-        used_fullpath.append("{}/src/{}".format(ippath, os.path.basename(usedFile)))
-        ngcFile = base_file + ".ngc"
-        if os.path.exists(ngcFile):
-            usedNGC += [base_file + ".ngc"]
-
-    used = used_fullpath + usedNGC
-    removeUnused(used, srcpath)
-
-commands = {'mkVivado':mkVivado}
-
-def find_bluespec():
-    pattern = "Bluespec directory: (.*)"
-    t = subprocess.Popen("bsc -help", shell=True, stdout=subprocess.PIPE).stdout.read()
-    s = t.decode()
-    for l in s.splitlines():
-        m = re.match(pattern, l)
-        if m:
-            return m.group(1)
-    else:
-        return ''
+def mkVivado(cli):
+    if not cli.projectname or not cli.topModule:
+        print("mkVivado requires projectname and topModule.")
+        sys.exit(1)
+    core = prepareCore(cli)
+    if core is None or core["mode"] == "skip":
+        return
+    used = executeVivado(core["tcl"], cli.vendor, core["projectname"], core["ippath"], core["tmpdir"], core["topModule"], core["additional"], core["includes"])
+    finishCore(core, used)
+
+# Every core of a batch runs in its own catch block, so a failing core does not
+# stop the others. The markers attribute the output to the cores.
+batchCore = """
+puts "CORE BEGIN:{projectname}"
+if {{[catch {{
+{script}
+}} err]}} {{
+    puts "CORE FAILED:{projectname}:$err"
+    catch {{close_project -delete}}
+}} else {{
+    puts "CORE FINISHED:{projectname}"
+}}
+"""
+
+def loadManifest(cli):
+    """reads the cores of a batch. Every core takes the keys name, topModule,
+    verilog_dir, includes, constraints, additional and exclude. Missing keys
+    default to the command line options."""
+    try:
+        with open(cli.manifest, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print("Could not read manifest {}: {}".format(cli.manifest, e))
+        sys.exit(1)
+    cores = []
+    for entry in manifest.get("cores", []):
+        if "name" not in entry or "topModule" not in entry:
+            print("Every core in {} needs a name and a topModule.".format(cli.manifest))
+            sys.exit(1)
+        spec = argparse.Namespace(**vars(cli))
+        spec.projectname = entry["name"]
+        for key in ["topModule", "verilog_dir", "includes", "constraints", "additional", "exclude"]:
+            if key in entry:
+                setattr(spec, key, [entry[key]] if key != "topModule" and isinstance(entry[key], str) else entry[key])
+        cores.append(spec)
+    return cores
+
+def mkVivadoBatch(cli):
+    """packages all cores of a manifest in a single Vivado session"""
+    if not cli.manifest:
+        print("mkVivadoBatch requires --manifest.")
+        sys.exit(1)
+    specs = loadManifest(cli)
+    cores = {}
+    for spec in specs:
+        core = prepareCore(spec)
+        if core is None:
+            print("Skipping {}.".format(spec.projectname))
+            continue
+        if core["mode"] == "skip":
+            continue
+        cores[spec.projectname] = core
+        core.update({"used": [], "errors": [], "status": None, "vendor": spec.vendor})
+    if not cores:
+        print("All cores are up to date.")
+        return
+
+    current = {"core": None}
+    def onLine(l):
+        core = cores.get(current["core"])
+        if l.startswith("CORE BEGIN:"):
+            current["core"] = l.split(':', 1)[1]
+            print("Packaging {}".format(current["core"]), flush=True)
+        elif core is None:
+            return
+        elif l.startswith("USED FILE:"):
+            core["used"].append(l.split(':', 1)[1])
+        elif l.startswith("ERROR:"):
+            core["errors"].append(l)
+        elif l.startswith("CORE FINISHED:"):
+            core["status"] = "finished"
+        elif l.startswith("CORE FAILED:"):
+            core["status"] = "failed"
+            core["errors"].append(l.split(':', 2)[2])
+
+    def render(tmp, convert):
+        return "".join(batchCore.format(projectname=name, script=renderTcl(core["tcl"], core["vendor"], name, core["ippath"],
+                       os.path.join(tmp, name), core["topModule"], core["additional"], core["includes"], convert)) for name, core in cores.items())
+    ret, tail = runScript(render, "{cwd}/tmp".format(cwd=os.getcwd()), onLine)
+
+    failed = []
+    for name, core in cores.items():
+        if core["status"] == "finished":
+            finishCore(core, list(dict.fromkeys(core["used"])))
+            print("{}: packaged ({} files used)".format(name, len(core["used"])))
+        else:
+            failed.append(name)
+            print("{}: FAILED".format(name))
+            for e in core["errors"][-10:] or ["Vivado stopped before the core was finished"]:
+                print("    {}".format(e))
+    if failed:
+        if ret != 0:
+            print("\n".join(tail))
+        print("Packaging failed for {}.".format(", ".join(failed)))
+        sys.exit(1)
 
+commands = {'mkVivado':mkVivado, 'mkVivadoBatch':mkVivadoBatch, 'startVivadoServer':startVivadoServer, 'stopVivadoServer':stopVivadoServer}
 
 def main():
     parser = argparse.ArgumentParser(description='Tools for BSV developers.')
     parser.add_argument('base_dir', type=str)
     parser.add_argument('command', type=str, choices=commands.keys())
-    parser.add_argument('projectname', type=str)
-    parser.add_argument('topModule', type=str)
+    parser.add_argument('projectname', nargs='?', type=str)
+    parser.add_argument('topModule', nargs='?', type=str)
     parser.add_argument('--verilog_dir', nargs='+', default="verilog", type=str)
     parser.add_argument('--vendor', default=vendor, type=str)
-    parser.add_argument('--bluespec_dir', default=os.getenv('BLUESPECDIR', find_bluespec()), type=str)
+    parser.add_argument('--bluespec_dir', default=None, type=str, help='Default: BLUESPECDIR or the directory reported by bsc')
     parser.add_argument('--exclude', nargs='+', default="", type=str)
     parser.add_argument('--additional', nargs='+', default="", type=str)
     parser.add_argument('--includes', nargs='+', default="", type=str)
     parser.add_argument('--constraints', nargs='+', default="", type=str)
+    parser.add_argument('--manifest', default=None, type=str, help='JSON list of cores for mkVivadoBatch')
 
     cli = parser.parse_args()
 
+    if cli.command in ['mkVivado', 'mkVivadoBatch']:
+        cli.bluespec_dir = cli.bluespec_dir or toolchain().bluespecDir()
     if cli.bluespec_dir == '':
         print("BLUESPEC_DIR is missing and could not be determined.")
         sys.exit(1)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import heapq
+import json
+import subprocess
+import tempfile
+import time
+from bsvQuery import loadGraph
+
+def phaseOf(command):
+    """classifies a bsc invocation"""
+    if '-e' in command:
+        return "link"
+    if '-g' in command:
+        return "verilog" if '-verilog' in command else "elab"
+    return "compile"
+
+def record(cli):
+    command = cli.bsc[1:] if cli.bsc[:1] == ['--'] else cli.bsc
+    if not command:
+        print("Command missing.")
+        sys.exit(1)
+    # bsvCompile.py creates this file when it restored the package from its cache
+    hitFile = os.path.join(tempfile.gettempdir(), "bsvTrace.{}.hit".format(os.getpid()))
+    start = time.time()
+    ret = subprocess.call(command, env=dict(os.environ, BSV_COMPILE_HIT_FILE=hitFile))
+    end = time.time()
+    cached = os.path.exists(hitFile)
+    if cached:
+        os.remove(hitFile)
+    entry = {"name": cli.name, "phase": phaseOf(command), "start": start, "end": end,
+             "run": os.getenv("BSV_TRACE_RUN"), "ok": ret == 0, "cached": cached}
+    # A single short write with O_APPEND keeps concurrent compiles from interleaving lines
+    fd = os.open(cli.trace, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(entry, sort_keys=True) + "\n").encode())
+    finally:
+        os.close(fd)
+    sys.exit(ret)
+
+def loadTrace(filename):
+    entries = []
+    with open(filename, "r") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return [e for e in entries if e.get("ok")]
+
+def durations(entries):
+    """latest compile duration per package. Incremental builds only compile
+    changed packages, so earlier runs provide the others. Packages restored from
+    the compile cache keep the duration of their last compilation."""
+    result = {}
+    for e in entries:
+        if not e.get("cached"):
+            result[e["name"]] = e["end"] - e["start"]
+    return result
+
+def criticalPath(graph, cost):
+    """longest chain of imports weighted by compile time. Returns (seconds,
+    packages from the first compiled to the last)."""
+    finish = {}
+    previous = {}
+    for m in graph["order"]:
+        imports = graph["packages"][m]["imports"]
+        before = max(imports, key=lambda d: finish[d], default=None)
+        finish[m] = cost.get(m, 0) + (finish[before] if before else 0)
+        previous[m] = before
+    if not finish:
+        return 0, []
+    m = max(finish, key=lambda p: finish[p])
+    total = finish[m]
+    path = []
+    while m:
+        path.append(m)
+        m = previous[m]
+    return total, list(reversed(path))
+
+def schedule(graph, cost, cores):
+    """duration of a build on cores workers, packages are started as soon as
+    their imports are compiled, longest remaining chain first"""
+    order = graph["order"]
+    packages = graph["packages"]
+    remaining = {m: len(packages[m]["imports"]) for m in order}
+    level = {}
+    for m in reversed(order):
+        level[m] = cost.get(m, 0) + max((level[u] for u in packages[m]["importedBy"]), default=0)
+    ready = [(-level[m], m) for m in order if remaining[m] == 0]
+    heapq.heapify(ready)
+    running = []
+    now = 0
+    while ready or running:
+        while ready and len(running) < cores:
+            _, m = heapq.heappop(ready)
+            heapq.heappush(running, (now + cost.get(m, 0), m))
+        now, m = heapq.heappop(running)
+        for u in packages[m]["importedBy"]:
+            remaining[u] -= 1
+            if remaining[u] == 0:
+                heapq.heappush(ready, (-level[u], u))
+    return now
+
+def chromeTrace(entries, filename):
+    """trace event format, viewable in chrome://tracing or Perfetto"""
+    base = min(e["start"] for e in entries)
+    events = [{"name": e["name"], "cat": "cached" if e.get("cached") else e["phase"], "ph": "X", "pid": 1, "tid": i,
+               "ts": int((e["start"] - base) * 1e6), "dur": int((e["end"] - e["start"]) * 1e6)}
+              for i, e in enumerate(entries)]
+    with open(filename, "w") as f:
+        json.dump({"traceEvents": events}, f)
+
+def report(cli):
+    try:
+        entries = loadTrace(cli.trace)
+        graph = loadGraph(cli.graph)
+    except (OSError, ValueError) as e:
+        print("Could not load trace: {}".format(e))
+        sys.exit(1)
+    if not entries:
+        print("No compilations recorded in {}".format(cli.trace))
+        sys.exit(1)
+    cost = durations([e for e in entries if e["phase"] != "link"])
+    link = [e["end"] - e["start"] for e in entries if e["phase"] == "link"]
+    work = sum(cost.get(m, 0) for m in graph["order"])
+
+    last = [e for e in entries if e.get("run") == entries[-1].get("run")]
+    print("Last build: {} steps, {:.1f}s wall clock".format(len(last), max(e["end"] for e in last) - min(e["start"] for e in last)))
+    print("Compile time of {} of {} packages: {:.1f}s".format(len([m for m in graph["order"] if m in cost]), len(graph["order"]), work))
+    if link:
+        print("Last link: {:.1f}s".format(link[-1]))
+
+    print("\nSlowest packages:")
+    phases = {e["name"]: e["phase"] for e in entries}
+    for m in sorted(cost, key=lambda m: -cost[m])[:cli.top]:
+        print("  {:8.2f}s  {:5.1f}%  {} ({})".format(cost[m], 100 * cost[m] / work if work else 0, m, phases[m]))
+
+    total, path = criticalPath(graph, cost)
+    print("\nCritical path: {:.1f}s through {} packages".format(total, len(path)))
+    for m in path:
+        print("  {:8.2f}s  {}".format(cost.get(m, 0), m))
+
+    print("\nSpeedup over one core (scheduled / upper bound):")
+    for n in sorted(set(cli.cores)):
+        makespan = schedule(graph, cost, n)
+        bound = work / max(total, work / n) if total else n
+        print("  {:3} cores: {:6.2f}x / {:6.2f}x  ({:.1f}s)".format(n, work / makespan if makespan else 1, bound, makespan))
+    if cli.chrome:
+        chromeTrace(last, cli.chrome)
+        print("\nWrote {}".format(cli.chrome))
+
+commands = {'record': record, 'report': report}
+
+def main():
+    parser = argparse.ArgumentParser(description='Time package compilations and analyze the build.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('record', help='Run a bsc command and append its timing to the trace')
+    p.add_argument('--trace', required=True, type=str)
+    p.add_argument('--name', required=True, type=str, help='Package or output name')
+    p.add_argument('bsc', nargs=argparse.REMAINDER, metavar='command')
+    p = sub.add_parser('report', help='Slowest packages, critical path and speedup at N cores')
+    p.add_argument('--trace', required=True, type=str)
+    p.add_argument('--graph', default="build/current/deps.json", type=str)
+    p.add_argument('--top', default=10, type=int, help='Number of slowest packages shown')
+    p.add_argument('--cores', nargs='+', default=[1, 2, 4, 8, 16, os.cpu_count()], type=int)
+    p.add_argument('--chrome', default=None, type=str, help='Write the last build in trace event format')
+    cli = parser.parse_args()
+
+    commands[cli.command](cli)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Module instantiation graph of Verilog sources, used to copy only the Bluespec
+# library modules a core instantiates. The modules of the Bluespec library are
+# indexed once per toolchain and cached.
+
+import os
+import re
+import glob
+import json
+import hashlib
+from bsvFiles import stamp
+
+commentPattern = re.compile(r'//[^\n]*|/\*.*?\*/', re.S)
+modulePattern = re.compile(r'\b(?:module|macromodule)\s+([A-Za-z_]\w*)')
+# <module> [#(parameters)] <instance>[range] (ports)
+instancePattern = re.compile(r'\b([A-Za-z_]\w*)\s*(?:#\s*\(|[A-Za-z_]\w*\s*(?:\[[^\]]*\]\s*)?\()')
+indexVersion = 1
+
+def cacheDir():
+    return os.getenv('BSV_TOOLS_CACHE_DIR', os.path.expanduser('~/.cache/bsvtools'))
+
+def scanVerilog(filename):
+    """returns the modules defined in filename and the names that may be
+    instantiated. Preprocessor conditions are ignored, so both branches of an
+    `ifdef count."""
+    with open(filename, "r", errors="replace") as f:
+        text = commentPattern.sub(" ", f.read())
+    modules = modulePattern.findall(text)
+    instances = set(instancePattern.findall(text)) - set(modules)
+    return {"modules": modules, "instances": sorted(instances)}
+
+def libraryFiles(bluespecdir):
+    """the library files copied into a core, Verilog.Vivado overrides Verilog"""
+    files = {}
+    for sub in ['Verilog', 'Verilog.Vivado']:
+        for filename in sorted(glob.glob(os.path.join(bluespecdir, sub, '*.v'))):
+            files[os.path.basename(filename)] = filename
+    return sorted(files.values())
+
+def primitiveIndex(bluespecdir):
+    """returns the index of the library modules of the toolchain in bluespecdir:
+    fingerprint (changes with any library file) and modules (name -> file and
+    instantiated names). Only files that changed since the cached index are parsed."""
+    bluespecdir = os.path.realpath(bluespecdir)
+    cacheFile = os.path.join(cacheDir(), "primitives-{}.json".format(hashlib.sha1(bluespecdir.encode()).hexdigest()[:16]))
+    try:
+        with open(cacheFile, "r") as f:
+            cache = json.load(f)
+        cached = cache["files"] if cache.get("version") == indexVersion else {}
+    except (OSError, ValueError, KeyError):
+        cached = {}
+    files = {}
+    for filename in libraryFiles(bluespecdir):
+        s = stamp(filename)
+        entry = cached.get(filename)
+        if not entry or entry["stamp"] != s:
+            entry = dict(scanVerilog(filename), stamp=s)
+        files[filename] = entry
+    if files != cached:
+        try:
+            os.makedirs(cacheDir(), exist_ok=True)
+            tmp = "{}.{}.tmp".format(cacheFile, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump({"version": indexVersion, "dir": bluespecdir, "files": files}, f)
+            os.replace(tmp, cacheFile)
+        except OSError:
+            pass
+    modules = {}
+    for filename, entry in files.items():
+        for m in entry["modules"]:
+            modules[m] = {"file": filename, "instances": entry["instances"]}
+    fingerprint = hashlib.sha1(json.dumps([[f, e["stamp"]] for f, e in sorted(files.items())]).encode()).hexdigest()
+    return {"fingerprint": fingerprint, "modules": modules}
+
+def requiredLibraryFiles(topModule, sources, index):
+    """library files transitively instantiated by topModule. If topModule is not
+    defined in the Verilog sources (e.g. a VHDL top level), every source module
+    is a root."""
+    defined = {}
+    for filename in sources:
+        if filename.endswith(('.v', '.sv')):
+            scanned = scanVerilog(filename)
+            for m in scanned["modules"]:
+                defined[m] = scanned["instances"]
+    roots = [topModule] if topModule in defined else list(defined)
+    seen = set(roots)
+    stack = list(roots)
+    files = set()
+    while stack:
+        m = stack.pop()
+        if m in defined:
+            instances = defined[m]
+        elif m in index["modules"]:
+            files.add(index["modules"][m]["file"])
+            instances = index["modules"][m]["instances"]
+        else:
+            continue
+        for i in instances:
+            if i not in seen:
+                seen.add(i)
+                stack.append(i)
+    return sorted(files)
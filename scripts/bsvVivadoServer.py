@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# Long running Vivado process executing packaging scripts on request, so the
+# Vivado start-up is only paid once. Requests are submitted through a local TCP
+# socket. Vivado writes its output to the server log, the output of a request
+# is read back from the log between the markers of the request. Every Vivado
+# installation has a server of its own, requests are executed one at a time
+# and the log only holds the output of the current request.
+
+import os
+import re
+import json
+import fcntl
+import hashlib
+import time
+import uuid
+import shutil
+import signal
+import socket
+import tempfile
+import subprocess
+import collections
+from bsvFiles import stamp
+
+serverTcl = """
+set port [lindex $argv 0]
+# stdout is the server log, requests are followed through it line by line
+fconfigure stdout -buffering line
+proc handle {chan} {
+    if {[gets $chan line] < 0} {
+        close $chan
+        return
+    }
+    if {$line == "EXIT"} {
+        exit 0
+    }
+    set id [lindex $line 0]
+    set script [lindex $line 1]
+    puts "REQUEST BEGIN:$id"
+    flush stdout
+    if {[catch {source $script} err]} {
+        puts "REQUEST FAILED:$id:$err"
+        catch {close_project -delete}
+    }
+    puts "REQUEST END:$id"
+    flush stdout
+    catch {puts $chan "DONE $id"; close $chan}
+}
+proc accept {chan addr port} {
+    fconfigure $chan -buffering line
+    fileevent $chan readable [list handle $chan]
+}
+socket -server accept -myaddr 127.0.0.1 $port
+puts "VIVADO SERVER LISTENING:$port"
+flush stdout
+vwait forever
+"""
+
+class ServerDied(Exception):
+    pass
+
+def serverDir(vivado):
+    """the server directory of the Vivado binary vivado (a resolved path)"""
+    base = os.getenv('BSV_VIVADO_SERVER_DIR', os.path.expanduser('~/.cache/bsvtools/vivado'))
+    return os.path.join(base, hashlib.sha1(vivado.encode()).hexdigest()[:16])
+
+def binaryStamp(path):
+    try:
+        return stamp(path)
+    except OSError:
+        return None
+
+def tclQuote(s):
+    """s as a single element of a TCL list"""
+    return re.sub(r'([\\\[\]{}"$; \t])', r'\\\1', s)
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    # Reap the server if it was started by this process
+    try:
+        return os.waitpid(pid, os.WNOHANG) == (0, 0)
+    except ChildProcessError:
+        return True
+
+class VivadoServer:
+    def __init__(self, vivado, directory=None):
+        self.vivado = vivado
+        self.dir = directory or serverDir(vivado)
+        self.stateFile = os.path.join(self.dir, "server.json")
+        self.log = os.path.join(self.dir, "server.log")
+        self.lockFile = os.path.join(self.dir, "request.lock")
+
+    def state(self):
+        try:
+            with open(self.stateFile, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def configured(self):
+        """a server was started and not stopped explicitly"""
+        return self.state() is not None
+
+    def connect(self, state, timeout=2):
+        return socket.create_connection(("127.0.0.1", state["port"]), timeout=timeout)
+
+    def alive(self):
+        state = self.state()
+        if not state or not pidAlive(state["pid"]):
+            return False
+        # Vivado was updated or replaced since the server started
+        if state.get("vivado") != self.vivado or state.get("stamp") != binaryStamp(self.vivado):
+            return False
+        try:
+            # An empty connection is closed by the server without doing anything
+            self.connect(state).close()
+            return True
+        except OSError:
+            return False
+
+    def start(self, timeout=600):
+        """starts Vivado in server mode and waits until it accepts requests"""
+        self.stop()
+        os.makedirs(self.dir, exist_ok=True)
+        tcl = os.path.join(self.dir, "server.tcl")
+        with open(tcl, "w") as f:
+            f.write(serverTcl)
+        port = freePort()
+        # Opened for appending, so Vivado keeps writing at the start of the log
+        # after it is truncated for a request
+        with open(self.log, "ab") as log:
+            log.truncate(0)
+            p = subprocess.Popen([self.vivado, "-mode", "batch", "-source", tcl, "-nojournal", "-nolog", "-tclargs", str(port)],
+                                 stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+        state = {"pid": p.pid, "port": port, "vivado": self.vivado, "stamp": binaryStamp(self.vivado)}
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if p.poll() is not None:
+                return False
+            try:
+                self.connect(state).close()
+                with open(self.stateFile, "w") as f:
+                    json.dump(state, f)
+                return True
+            except OSError:
+                time.sleep(0.2)
+        os.killpg(p.pid, signal.SIGTERM)
+        return False
+
+    def kill(self, state, sig=signal.SIGTERM):
+        """signals the process group of the server, Vivado starts helper processes"""
+        try:
+            os.killpg(state["pid"], sig)
+        except OSError:
+            pass
+        pidAlive(state["pid"])
+
+    def stop(self):
+        state = self.state()
+        if state:
+            try:
+                with self.connect(state) as s:
+                    s.sendall(b"EXIT\n")
+            except OSError:
+                pass
+            self.kill(state)
+            os.remove(self.stateFile)
+
+    def run(self, render, onLine, tailLength=200, timeout=None):
+        """executes the script render(tmpdir) returns. Every line of its output
+        is passed to onLine until it returns False. Returns the exit code and
+        the last lines of the output. Raises ServerDied if the server stopped
+        before the request was finished. A request running longer than timeout
+        seconds kills the server, it is restarted by the next request."""
+        state = self.state()
+        request = uuid.uuid4().hex
+        tmp = tempfile.mkdtemp(prefix="request.", dir=self.dir)
+        tail = collections.deque(maxlen=tailLength)
+        try:
+            script = os.path.join(tmp, "script.tcl")
+            with open(script, "w") as f:
+                f.write(render(os.path.join(tmp, "project")))
+            with open(self.lockFile, "w") as lock, open(self.log, "rb") as log:
+                # Waits for the requests of other builds, the log only holds this request
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                os.truncate(self.log, 0)
+                try:
+                    conn = self.connect(state)
+                    conn.sendall("{} {}\n".format(request, tclQuote(script)).encode())
+                except OSError:
+                    raise ServerDied()
+                with conn:
+                    return self.follow(log, request, state, onLine, tail, timeout), list(tail)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def follow(self, log, request, state, onLine, tail, timeout=None):
+        """reads the output of request from the log"""
+        deadline = time.time() + timeout if timeout else None
+        pending = b""
+        started = False
+        forward = True
+        ret = 0
+        while True:
+            if deadline and time.time() > deadline:
+                # The request is abandoned, the lock is released by the caller
+                self.kill(state, signal.SIGKILL)
+                tail.append("Vivado server request timed out after {}s, the server was stopped.".format(timeout))
+                return 1
+            chunk = log.read(1 << 16)
+            if not chunk:
+                if not pidAlive(state["pid"]):
+                    raise ServerDied()
+                time.sleep(0.05)
+                continue
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for raw in lines:
+                l = raw.decode(errors="replace").rstrip()
+                if not started:
+                    started = l == "REQUEST BEGIN:" + request
+                    continue
+                if l == "REQUEST END:" + request:
+                    return ret
+                if l.startswith("REQUEST FAILED:" + request):
+                    ret = 1
+                tail.append(l)
+                # After a stop the request is still followed to its end, the
+                # server executes one request at a time.
+                if forward and onLine(l) is False:
+                    forward = False
+                    ret = 1
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# Resident incremental build: keeps the package graph in memory, watches the
+# search path and recompiles only the packages affected by a change.
+# Results are printed and, with --socket, streamed as JSON lines to every
+# connected client (e.g. an editor).
+
+import sys
+import os
+import json
+import time
+import shlex
+import select
+import signal
+import socket
+import struct
+import ctypes
+import ctypes.util
+import argparse
+import threading
+import subprocess
+import concurrent.futures
+from bsvPreprocessor import parseDefines
+from bsvDeps import resolveRoots, resolveGraph, topologicalOrder, graphJson, writeDeps
+from bsvQuery import packagesForFiles, affectedPackages
+
+watchedExtensions = ('.bsv', '.bsvi', '.bsvh', '.defines')
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+eventHeader = struct.Struct("iIII")
+
+class InotifyWatcher:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+
+    def watch(self, directories):
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        for d in set(directories) - set(self.dirs.values()):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), mask)
+            if wd >= 0:
+                self.dirs[wd] = d
+
+    def wait(self, timeout):
+        """returns the files changed within timeout seconds (None: forever)"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        changed = set()
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = eventHeader.unpack_from(data, offset)
+            name = data[offset + eventHeader.size:offset + eventHeader.size + length].rstrip(b"\0")
+            offset += eventHeader.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, treat every watched file as changed
+                for d in self.dirs.values():
+                    changed |= {os.path.join(d, n) for n in os.listdir(d)}
+            elif wd in self.dirs and name:
+                changed.add(os.path.join(self.dirs[wd], os.fsdecode(name)))
+        return changed
+
+class PollingWatcher:
+    """fallback where inotify is not available, compares modification times"""
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.dirs = set()
+        self.stamps = {}
+
+    def scan(self, dirs):
+        stamps = {}
+        for d in dirs:
+            try:
+                for entry in os.scandir(d):
+                    if entry.is_file():
+                        st = entry.stat()
+                        stamps[entry.path] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                continue
+        return stamps
+
+    def watch(self, directories):
+        # Only new directories are scanned, changes to the watched ones since
+        # the last wait (e.g. during a build) are still reported
+        added = set(directories) - self.dirs
+        self.dirs |= added
+        self.stamps.update(self.scan(added))
+
+    def wait(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            stamps = self.scan(self.dirs)
+            changed = {f for f in set(stamps) | set(self.stamps) if stamps.get(f) != self.stamps.get(f)}
+            self.stamps = stamps
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.monotonic())))
+
+def makeWatcher(poll):
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            print("inotify is not available, polling for changes.")
+    return PollingWatcher()
+
+class Reporter:
+    """prints results and sends them as JSON lines to the clients of a unix socket"""
+    def __init__(self, path=None):
+        self.clients = []
+        self.lock = threading.Lock()
+        self.path = path
+        if path:
+            if os.path.exists(path):
+                os.remove(path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(path)
+            self.server.listen()
+            threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.clients.append(conn)
+
+    def send(self, event, message=None, **values):
+        if message:
+            print(message, flush=True)
+        if not self.path:
+            return
+        line = (json.dumps(dict(values, event=event), sort_keys=True) + "\n").encode()
+        with self.lock:
+            for c in list(self.clients):
+                try:
+                    c.sendall(line)
+                except OSError:
+                    c.close()
+                    self.clients.remove(c)
+
+    def close(self):
+        if self.path:
+            self.server.close()
+            os.remove(self.path)
+
+def outdated(package):
+    try:
+        return os.stat(package["object"]).st_mtime_ns < os.stat(package["path"]).st_mtime_ns
+    except OSError:
+        return True
+
+class Watch:
+    def __init__(self, cli):
+        self.cli = cli
+        self.defines = parseDefines(cli.flags)
+        if cli.run_test:
+            self.defines.setdefault("RUN_TEST", cli.run_test)
+        self.roots = resolveRoots(cli.roots, cli.bluespec_dir)
+        self.compileFlags = shlex.split(cli.compile_flags)
+        self.elab = dict(e.split('=', 1) for e in cli.elab)
+        self.reporter = Reporter(cli.socket)
+        self.graph = None
+
+    def update(self):
+        """rescans the search path (only changed files are parsed) and writes
+        the make rules, so make and the watcher agree. Returns False on cycles."""
+        graph = resolveGraph(self.roots, self.cli.builddir, self.defines, testbench=self.cli.testbench)
+        cycles = writeDeps(graph, self.cli.builddir, self.cli.output, self.cli.json)
+        if cycles:
+            for cycle in cycles:
+                self.reporter.send("error", "Import cycle detected: {}".format(" -> ".join(cycle)), cycle=cycle)
+            return False
+        order, _ = topologicalOrder(graph.imports)
+        self.graph = json.loads(graphJson(graph, order, self.cli.builddir))
+        return True
+
+    def directories(self):
+        files = [p["path"] for p in self.graph["packages"].values()]
+        files += [i for p in self.graph["packages"].values() for i in p["includes"]]
+        dirs = {os.path.dirname(os.path.abspath(f)) for f in files}
+        dirs |= {os.path.abspath(r) for r, prebuilt in self.roots if not prebuilt and os.path.isdir(r)}
+        # The generated testbench is checked through its timestamp
+        dirs.discard(os.path.abspath(self.cli.builddir))
+        return sorted(dirs)
+
+    def relevant(self, filename):
+        if filename.endswith(watchedExtensions):
+            return True
+        filename = os.path.realpath(filename)
+        return any(filename in map(os.path.realpath, p["includes"]) for p in self.graph["packages"].values())
+
+    def compilePackage(self, name, waitFor):
+        """compiles name once the packages it imports are compiled, returns success"""
+        if not all(f.result() for f in waitFor):
+            return False
+        package = self.graph["packages"][name]
+        flags = ["-elab", "-g", self.elab[name]] if name in self.elab else []
+        start = time.time()
+        t = subprocess.run([self.cli.bsc] + flags + self.compileFlags + [package["path"]], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = t.stdout.decode(errors="replace")
+        ok = t.returncode == 0
+        self.reporter.send("compile", "{} {} ({:.1f}s)".format("Compiled" if ok else "FAILED", name, time.time() - start) + ("" if ok else "\n" + output),
+                           package=name, ok=ok, seconds=time.time() - start, output=output)
+        return ok
+
+    def compile(self, packages):
+        """compiles packages in build order, independent packages concurrently.
+        Packages importing a failed package are not compiled."""
+        futures = {}
+        # Tasks only wait for earlier submitted tasks, which a FIFO pool has started already
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.cli.jobs) as pool:
+            for name in packages:
+                waitFor = [futures[d] for d in self.graph["packages"][name]["imports"] if d in futures]
+                futures[name] = pool.submit(self.compilePackage, name, waitFor)
+        return [n for n, f in futures.items() if not f.result()]
+
+    def run(self):
+        start = time.time()
+        self.reporter.send("run", "Running {}".format(self.cli.run), command=self.cli.run)
+        p = subprocess.Popen(self.cli.run, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for raw in p.stdout:
+            l = raw.decode(errors="replace").rstrip("\n")
+            self.reporter.send("output", l, text=l)
+        ok = p.wait() == 0
+        self.reporter.send("run_finished", "Run {} ({:.1f}s)".format("passed" if ok else "FAILED", time.time() - start),
+                           ok=ok, seconds=time.time() - start)
+
+    def rebuild(self, changed):
+        start = time.time()
+        before = packagesForFiles(self.graph, changed) if self.graph else []
+        if not self.update():
+            return
+        names = set(before) | set(packagesForFiles(self.graph, changed))
+        # New packages, a regenerated testbench and changes missed while building
+        names |= {m for m, p in self.graph["packages"].items() if outdated(p)}
+        packages = affectedPackages(self.graph, [n for n in names if n in self.graph["packages"]])
+        self.reporter.send("build", "Changed: {}".format(", ".join(sorted(os.path.relpath(f) for f in changed))),
+                           changed=sorted(changed), packages=packages)
+        failed = self.compile(packages)
+        ok = not failed
+        self.reporter.send("build_finished", "Build {}: {} packages ({:.1f}s)".format("finished" if ok else "FAILED", len(packages), time.time() - start),
+                           ok=ok, failed=failed, seconds=time.time() - start)
+        if ok and self.cli.run and packages:
+            self.run()
+
+    def loop(self):
+        watcher = makeWatcher(self.cli.poll)
+        if not self.update():
+            sys.exit(1)
+        watcher.watch(self.directories())
+        self.reporter.send("ready", "Watching {} packages in {} directories".format(len(self.graph["order"]), len(self.directories())),
+                           packages=len(self.graph["order"]))
+        while True:
+            changed = {f for f in watcher.wait(None) if self.relevant(f)}
+            if not changed:
+                continue
+            # Collect the rest of an edit (editors write several files or write twice)
+            while True:
+                more = watcher.wait(self.cli.debounce)
+                if not more:
+                    break
+                changed |= {f for f in more if self.relevant(f)}
+            self.rebuild(changed)
+            watcher.watch(self.directories())
+
+def main():
+    parser = argparse.ArgumentParser(description='Watch BSV sources and recompile the affected packages on every change.')
+    parser.add_argument('roots', nargs='+', type=str, help='bsc search path entries in search order')
+    parser.add_argument('--builddir', default="build", type=str)
+    parser.add_argument('--bluespec_dir', default=os.getenv('BLUESPECDIR', ''), type=str, help='Replaces % in the search path')
+    parser.add_argument('--flags', default="", type=str, help='bsc flags, -D defines are applied while scanning')
+    parser.add_argument('--run_test', default="", type=str, help='Shorthand for -D RUN_TEST=<package>')
+    parser.add_argument('--testbench', default=None, type=str, help='Generated testbench running all tests')
+    parser.add_argument('--output', default=None, type=str, help='Keep the make rules in this file up to date')
+    parser.add_argument('--json', default=None, type=str, help='Keep the JSON graph in this file up to date')
+    parser.add_argument('--bsc', default="bsc", type=str)
+    parser.add_argument('--compile_flags', default="", type=str, help='bsc flags of every package compilation')
+    parser.add_argument('--elab', nargs='+', default=[], type=str, help='PACKAGE=MODULE, elaborate MODULE when compiling PACKAGE')
+    parser.add_argument('--run', default=None, type=str, help='Shell command run after every successful build, e.g. make sim')
+    parser.add_argument('--jobs', default=os.cpu_count(), type=int, help='Number of concurrent compilations')
+    parser.add_argument('--debounce', default=0.2, type=float, help='Seconds without changes before building')
+    parser.add_argument('--poll', help='Poll for changes instead of using inotify', action='store_true')
+    parser.add_argument('--socket', default=None, type=str, help='Stream results as JSON lines to clients of this unix socket')
+    cli = parser.parse_args()
+
+    watch = Watch(cli)
+    # Remove the socket when stopped by make or a terminal
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        watch.loop()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watch.reporter.close()
+
+if __name__ == '__main__':
+    main()
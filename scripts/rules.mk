@@ -1,6 +1,3 @@
-ifeq ($(BUILDDIR),)
-	BUILDDIR=build
-endif
 SILENTCMD=
 ifndef VERBOSE
 	SILENTCMD=@
@@ -20,15 +17,19 @@ BSV=bsc
 
 BSV_TOOLS_PY:=$(BSV_TOOLS)/scripts/bsvTools.py
 BSV_DEPS:=$(BSV_TOOLS)/scripts/bsvDeps.py
+BSV_COMPILE:=$(BSV_TOOLS)/scripts/bsvCompile.py
+BSV_TEST:=$(BSV_TOOLS)/scripts/bsvTest.py
+BSV_SIM_MONITOR:=$(BSV_TOOLS)/scripts/bsvSimMonitor.py
+BSV_TRACE_PY:=$(BSV_TOOLS)/scripts/bsvTrace.py
+BSV_WATCH:=$(BSV_TOOLS)/scripts/bsvWatch.py
 
 BASH:=$(shell which bash)
 RM:=$(shell which rm)
 MKDIR:=$(shell which mkdir)
+FLOCK:=$(shell which flock)
 
 BSV_INCLUDEDIR?=$(PWD)/include
 
-USED_DIRECTORIES := $(BUILDDIR) $(BSV_INCLUDEDIR) $(EXTRA_DIRS)
-
 EMPTY :=
 SPACE := $(EMPTY) $(EMPTY)
 join-with = $(subst $(SPACE),$1,$(strip $2))
@@ -60,14 +61,47 @@ BSC_FLAGS += -v
 endif
 
 ifeq ($(SIM_TYPE), VERILOG)
-VERILOGDIR=verilog
-VSIM?=modelsim
-BASEPARAMS=-verilog -vdir $(BUILDDIR)/$(VERILOGDIR) -vsim $(VSIM)
-BASEPARAMS_SIM=-verilog -vdir $(VERILOGDIR) -vsim $(VSIM)
-COMPILE_FLAGS=-fdir $(PWD) -simdir $(BUILDDIR) -bdir $(BUILDDIR) -info-dir $(BUILDDIR) -p $(LIBRARIES)
-COMPLETE_FLAGS=$(BASEPARAMS) $(COMPILE_FLAGS)
-USED_DIRECTORIES += $(BUILDDIR)/$(VERILOGDIR)
 BSC_FLAGS += -D VERILOG
+endif
+
+# Build outputs are kept in one directory per flag configuration, so switching
+# between tests or simulators reuses the objects of earlier builds. Once a make
+# has finished, all but the BUILD_CONFIGS_KEEP most recently used ones are
+# removed (or explicitly with make prune_builds). Every make registers its pid
+# in the configuration it uses, configurations of running makes are never
+# removed. BUILD_LOCK keeps the registration and the removal apart.
+# An explicitly set BUILDDIR is used as is and cleaned whenever the flags change.
+BUILD_BASE?=build
+BUILD_CONFIGS_KEEP?=8
+BUILD_LOCK=$(if $(FLOCK),$(FLOCK) $(1) $(BUILD_BASE)/.lock -c,sh -c)
+PRUNE_BUILDS=$(MKDIR) -p $(BUILD_BASE) && $(call BUILD_LOCK,-x) '\
+	ls -1t $(BUILD_BASE)/[0-9]*/.last_used 2>/dev/null | tail -n +$$(($(BUILD_CONFIGS_KEEP)+1)) | sed "s|/.last_used$$||" | while read d; do \
+		used=; for u in $$d/.users/*; do [ -e "$$u" ] || continue; if kill -0 $${u\#\#*/} 2>/dev/null; then used=1; else $(RM) -f "$$u"; fi; done; \
+		if [ -n "$$used" ]; then echo "Keeping $$d, it is in use"; else $(RM) -rf "$$d"; fi; \
+	done'
+ifeq ($(BUILDDIR),)
+BSC_CONFIG:=$(shell echo '$(subst ','\'',$(SIM_TYPE) $(MULTI_TEST) $(filter-out -v,$(BSC_FLAGS)))' | cksum | cut -d' ' -f1)
+BUILDDIR:=$(BUILD_BASE)/$(BSC_CONFIG)
+$(shell $(MKDIR) -p $(BUILD_BASE) && $(call BUILD_LOCK,-s) "$(MKDIR) -p $(BUILDDIR)/.users && touch $(BUILDDIR)/.last_used $(BUILDDIR)/.users/$$PPID" && ln -sfn $(BSC_CONFIG) $(BUILD_BASE)/current)
+# A background shell waits for this make to exit, then prunes and unregisters it
+$(shell (while kill -0 $$PPID 2>/dev/null; do sleep 1; done; $(PRUNE_BUILDS); $(RM) -f $(BUILDDIR)/.users/$$PPID) </dev/null >/dev/null 2>&1 &)
+else
+BUILD_BASE:=$(BUILDDIR)
+endif
+
+# A single simulation binary containing all tests. Tests are selected at
+# runtime, e.g. make sim MULTI_TEST=1 TESTS="TestsA TestsB"
+TESTS?=
+ifdef MULTI_TEST
+TESTBENCH_FILE:=$(BUILDDIR)/TestbenchAll.bsv
+TESTBENCH_MODULE:=mkTestbenchAll
+RUN_FLAGS+=$(addprefix +test=,$(addsuffix :,$(TESTS)))
+DEPS_TESTBENCH:=--testbench $(TESTBENCH_FILE)
+endif
+
+USED_DIRECTORIES = $(BUILDDIR) $(BSV_INCLUDEDIR) $(EXTRA_DIRS)
+
+VERILOGDIR=verilog
 
 ifdef VIVADO_ADD_PARAMS
 VIVADO_ADD_PARAMS := --additional $(VIVADO_ADD_PARAMS)
@@ -85,17 +119,44 @@ ifdef IGNORE_MODULES
 	EXCLUDED_VIVADO := --exclude  $(addsuffix .v, $(IGNORE_MODULES))
 endif
 
+# The core is only packaged again if its inputs changed (see ip/$(PROJECT_NAME)/.bsv_inputs.json),
+# use ip_clean to force packaging
+IP_COMMAND=cd $(BUILDDIR); $(BSV_TOOLS_PY) . mkVivado $(PROJECT_NAME) $(TOP_MODULE) --verilog_dir $(VERILOGDIR) $(VERILOGDIR_EXTRAS) $(EXCLUDED_VIVADO) $(VIVADO_ADD_PARAMS) $(VIVADO_INCLUDES) $(CONSTRAINT_FILES)
+IP_ZIP_COMMAND=cd $(BUILDDIR)/ip && if [ ! -f $(PROJECT_NAME).zip -o $(PROJECT_NAME)/.bsv_inputs.json -nt $(PROJECT_NAME).zip ]; then $(RM) -f $(PROJECT_NAME).zip && $(ZIP) -r $(PROJECT_NAME).zip $(PROJECT_NAME) -x '*/.bsv_inputs.json'; fi
+
+ifeq ($(SIM_TYPE), VERILOG)
+VSIM?=modelsim
+BASEPARAMS=-verilog -vdir $(BUILDDIR)/$(VERILOGDIR) -vsim $(VSIM)
+BASEPARAMS_SIM=-verilog -vdir $(VERILOGDIR) -vsim $(VSIM)
+COMPILE_FLAGS=-fdir $(PWD) -simdir $(BUILDDIR) -bdir $(BUILDDIR) -info-dir $(BUILDDIR) -p $(LIBRARIES)
+COMPLETE_FLAGS=$(BASEPARAMS) $(COMPILE_FLAGS)
+USED_DIRECTORIES += $(BUILDDIR)/$(VERILOGDIR)
+
 ip_clean:
 	$(RM) -rf $(BUILDDIR)/ip/$(PROJECT_NAME)
 	$(RM) -f $(BUILDDIR)/ip/$(PROJECT_NAME).zip
 
-ip: compile_top ip_clean
+ip: compile_top
 	@echo "Creating IP $(PROJECT_NAME)"
-	$(SILENTCMD)cd $(BUILDDIR); $(BSV_TOOLS_PY) . mkVivado $(PROJECT_NAME) $(TOP_MODULE) --verilog_dir $(VERILOGDIR) $(VERILOGDIR_EXTRAS) $(EXCLUDED_VIVADO) $(VIVADO_ADD_PARAMS) $(VIVADO_INCLUDES) $(CONSTRAINT_FILES)
+	$(SILENTCMD)$(IP_COMMAND)
 ifneq (, $(ZIP))
-	$(SILENTCMD)cd $(BUILDDIR)/ip && $(ZIP) -r $(PROJECT_NAME).zip $(PROJECT_NAME)
+	$(SILENTCMD)$(IP_ZIP_COMMAND)
 endif
 
+# Keep a Vivado process running for ip and ip_batch, saving the Vivado
+# start-up on every packaging run. Batch mode is used while it is stopped.
+vivado_server_start:
+	$(SILENTCMD)$(BSV_TOOLS_PY) . startVivadoServer
+
+vivado_server_stop:
+	$(SILENTCMD)$(BSV_TOOLS_PY) . stopVivadoServer
+
+# Package all cores listed in IP_MANIFEST in a single Vivado session.
+# Verilog directories in the manifest are relative to the build directory.
+ip_batch: compile_top
+	@echo "Creating IP cores from $(IP_MANIFEST)"
+	$(SILENTCMD)cd $(BUILDDIR); $(BSV_TOOLS_PY) . mkVivadoBatch --manifest $(abspath $(IP_MANIFEST)) --verilog_dir $(VERILOGDIR) $(VERILOGDIR_EXTRAS) $(EXCLUDED_VIVADO) $(VIVADO_ADD_PARAMS) $(VIVADO_INCLUDES) $(CONSTRAINT_FILES)
+
 compile_top: $(BUILDDIR)/bsc_defines | directories
 	$(SILENTCMD)$(BSV) -elab -verilog $(COMPLETE_FLAGS) $(BSC_FLAGS) -g $(TOP_MODULE) -u $(SRCDIR)/$(MAIN_MODULE).bsv
 
@@ -110,8 +171,18 @@ SRCS=$(wildcard $(SRCDIR)/*.bsv)
 ifdef TEST_DIR
 SRCS+=$(wildcard $(TEST_DIR)/*.bsv)
 endif
-$(shell $(BSV_DEPS) $(SRCDIR) $(TEST_DIR) $(BUILDDIR) $(RUN_TEST) > .deps)
-include .deps
+# Dependencies are tracked across the complete bsc search path, including libraries.
+# Imports are resolved with the same defines bsc sees.
+# Goals only using the ninja backend skip this, build.ninja keeps itself up to date.
+DEPS_ARGS=--builddir $(BUILDDIR) --bluespec_dir "$(BLUESPECDIR)" --flags '$(subst ','\'',$(BSC_FLAGS))' --run_test "$(RUN_TEST)" --output $(BUILDDIR)/.deps --json $(BUILDDIR)/deps.json $(DEPS_TESTBENCH)
+NINJA_ONLY:=$(if $(MAKECMDGOALS),$(if $(filter-out ninja,$(MAKECMDGOALS)),,1))
+ifndef NINJA_ONLY
+$(shell $(BSV_DEPS) $(DEPS_ARGS) $(LIBRARIES_BASE))
+ifneq ($(.SHELLSTATUS),0)
+$(error Dependency generation failed (see above))
+endif
+include $(BUILDDIR)/.deps
+endif
 
 $(USED_DIRECTORIES):
 	$(MKDIR) -p $@
@@ -121,21 +192,144 @@ all: sim
 
 .PHONY: force
 $(BUILDDIR)/bsc_defines: force
-	@echo '$(shell echo $(BSC_FLAGS) | sed -r "s/'/'\\\''/g")' | cmp -s - $@ || (echo '$(shell echo $(BSC_FLAGS) | sed -r "s/'/'\\\''/g")' > $@ ; $(MAKE) clean_project)
+	@echo '$(shell echo $(BSC_FLAGS) | sed -r "s/'/'\\\''/g")' | cmp -s - $@ || (echo '$(shell echo $(BSC_FLAGS) | sed -r "s/'/'\\\''/g")' > $@ $(if $(BSC_CONFIG),,; $(MAKE) clean_project))
 
 directories: $(USED_DIRECTORIES)
 
+# Optional compile cache shared between checkouts, keyed on the package source,
+# its imports, the bsc version and the flags (e.g. BSV_CACHE_DIR=~/.cache/bsvtools/bsc)
+ifdef BSV_CACHE_DIR
+BSV_CACHE_SIZE?=5G
+PACKAGE_WRAPPER=$(BSV_COMPILE) --cache_dir $(BSV_CACHE_DIR) --cache_size $(BSV_CACHE_SIZE) --deps $^ --macros $(PACKAGE_MACROS) --
+endif
+
+# Optional timing of every bsc invocation (BSV_TRACE=1), see make trace_report
+BSV_TRACE_FILE?=$(abspath $(BUILDDIR))/trace.jsonl
+ifdef BSV_TRACE
+export BSV_TRACE_RUN:=$(shell date +%s%N)
+TRACE_WRAPPER=$(BSV_TRACE_PY) record --trace $(BSV_TRACE_FILE) --name $(basename $(notdir $@)) --
+endif
+
+# Every package is compiled by its own bsc invocation as soon as the objects
+# of its imports exist, so make -j compiles independent packages in parallel.
+# The bsc -u calls of compile/compile_top afterwards find everything up to date.
+$(OBJS): | directories $(BUILDDIR)/bsc_defines
+	$(SILENTCMD)$(TRACE_WRAPPER) $(PACKAGE_WRAPPER) $(BSV) $(PACKAGE_FLAGS) $(COMPLETE_FLAGS) $(BSC_FLAGS) $(firstword $(filter %.bsv,$^))
+
+TESTBENCH_OBJ=$(BUILDDIR)/$(basename $(notdir $(TESTBENCH_FILE))).bo
+$(TESTBENCH_OBJ): private PACKAGE_FLAGS=-elab -g $(TESTBENCH_MODULE)
+compile: $(TESTBENCH_OBJ)
+
+ifeq ($(SIM_TYPE), VERILOG)
+$(BUILDDIR)/$(MAIN_MODULE).bo: private PACKAGE_FLAGS=-elab -g $(TOP_MODULE)
+compile_top: $(BUILDDIR)/$(MAIN_MODULE).bo
+endif
+
 compile: $(BUILDDIR)/bsc_defines | directories
 	$(SILENTCMD)$(BSV) -elab $(COMPLETE_FLAGS) $(BSC_FLAGS) -g $(TESTBENCH_MODULE) -u $(TESTBENCH_FILE)
 
-$(BUILDDIR)/$(OUTFILE): compile
+# Only relinked if the elaborated testbench changed. COMPILED=1 skips the bsc -u
+# check of compile when it just ran (e.g. bsvTest timing link and sim).
+$(BUILDDIR)/$(OUTFILE): $(TESTBENCH_OBJ) $(C_FILES) $(CPP_FILES) | $(if $(COMPILED),,compile)
 	@echo Linking $@...
-	$(SILENTCMD)cd $(BUILDDIR); CXXFLAGS="$(CXXFLAGS)" $(BSV) -e $(TESTBENCH_MODULE) -o $(notdir $@) $(BSC_FLAGS) $(BASEPARAMS_SIM) $(addprefix -l , $(EXTRA_LIBRARIES)) $(C_FILES) $(CPP_FILES)
+	$(SILENTCMD)cd $(BUILDDIR); CXXFLAGS="$(CXXFLAGS)" $(TRACE_WRAPPER) $(BSV) -e $(TESTBENCH_MODULE) -o $(notdir $@) $(BSC_FLAGS) $(BASEPARAMS_SIM) $(addprefix -l , $(EXTRA_LIBRARIES)) $(C_FILES) $(CPP_FILES)
 	@echo Linking finished
 
+# The simulation output is checked while the simulation runs. It is stopped
+# on the first line matching SIM_FAIL_PATTERNS, after SIM_TIMEOUT seconds or
+# once the cycle parsed with SIM_CYCLE_PATTERN exceeds SIM_MAX_CYCLES.
+# Matches and the last lines of output are kept in simreport.txt.
+SIM_FAIL_PATTERNS?=ERROR
+SIM_MONITOR_FLAGS=--fail $(SIM_FAIL_PATTERNS) --report simreport.txt
+ifdef SIM_SUCCESS_PATTERN
+SIM_MONITOR_FLAGS+=--success '$(SIM_SUCCESS_PATTERN)'
+endif
+ifdef SIM_TIMEOUT
+SIM_MONITOR_FLAGS+=--timeout $(SIM_TIMEOUT)
+endif
+ifdef SIM_CYCLE_PATTERN
+SIM_MONITOR_FLAGS+=--cycle_pattern '$(SIM_CYCLE_PATTERN)'
+endif
+ifdef SIM_MAX_CYCLES
+SIM_MONITOR_FLAGS+=--max_cycles $(SIM_MAX_CYCLES)
+endif
+ifdef SIM_STATS
+SIM_MONITOR_FLAGS+=--stats $(SIM_STATS)
+endif
+
+link: $(BUILDDIR)/$(OUTFILE)
+
+SIM_COMMAND=cd $(BUILDDIR) && $(BSV_SIM_MONITOR) $(SIM_MONITOR_FLAGS) -- ./$(OUTFILE) $(RUN_FLAGS)
 sim: $(BUILDDIR)/$(OUTFILE)
 	@echo Simulating $<
-	$(SILENTCMD)cd $(BUILDDIR) && $(BASH) -c './$(OUTFILE) $(RUN_FLAGS) | tee simresult.tmp; (! grep -q "ERROR" simresult.tmp); retVal=$$?; $(RM) simresult.tmp; exit $${retVal}'
+	$(SILENTCMD)$(SIM_COMMAND)
+
+# Recompile the affected packages whenever a source changes, without going
+# through make. WATCH_RUN is run after every successful build (e.g.
+# WATCH_RUN="make sim"), WATCH_SOCKET streams the results as JSON lines.
+ELAB_PACKAGES=$(basename $(notdir $(TESTBENCH_FILE)))=$(TESTBENCH_MODULE)
+ifeq ($(SIM_TYPE), VERILOG)
+ELAB_PACKAGES+=$(MAIN_MODULE)=$(TOP_MODULE)
+endif
+WATCH_FLAGS=$(if $(WATCH_RUN),--run '$(subst ','\'',$(WATCH_RUN))') $(if $(WATCH_SOCKET),--socket $(WATCH_SOCKET))
+watch: compile
+	$(SILENTCMD)$(BSV_WATCH) $(DEPS_ARGS) --bsc $(BSV) --compile_flags '$(subst ','\'',$(COMPLETE_FLAGS) $(BSC_FLAGS))' --elab $(ELAB_PACKAGES) $(WATCH_FLAGS) -- $(LIBRARIES_BASE)
+
+deps_graph:
+	@echo $(abspath $(BUILDDIR)/deps.json)
+
+# Slowest packages, critical import chain and speedup at N cores of the
+# builds run with BSV_TRACE=1
+trace_report:
+	$(SILENTCMD)$(BSV_TRACE_PY) report --trace $(BSV_TRACE_FILE) --graph $(BUILDDIR)/deps.json --chrome $(BUILDDIR)/trace_chrome.json
+
+sim_binary: $(BUILDDIR)/$(OUTFILE)
+	@echo $(abspath $<)
+
+# Build and simulate only the tests affected by changes since CHANGED_SINCE
+# Additional options of bsvTest.py, e.g. BSV_TEST_FLAGS="--junit results.xml"
+BSV_TEST_FLAGS?=
+CHANGED_SINCE?=HEAD
+sim_affected:
+	$(SILENTCMD)$(BSV_TEST) $(BSV_TEST_FLAGS) --testbench $(basename $(notdir $(TESTBENCH_FILE))) --graph $(BUILDDIR)/deps.json --log_dir $(BUILD_BASE)/tests affected --git $(CHANGED_SINCE) --run
+
+# Build and simulate several tests concurrently, e.g. make sim_matrix TESTS="Tests*".
+# With MULTI_TEST=1 all tests share one simulation binary.
+sim_matrix:
+	$(SILENTCMD)$(BSV_TEST) $(BSV_TEST_FLAGS) --graph $(BUILDDIR)/deps.json --log_dir $(BUILD_BASE)/tests run $(if $(MULTI_TEST),--single_binary) $(TESTS)
+
+# Ninja backend: make ninja [NINJA_TARGETS="compile link sim ip"] only forwards
+# to ninja (default: sim). build.ninja regenerates itself when sources change,
+# make only regenerates it when the settings change. The ip edges are only
+# generated when ip is one of the NINJA_TARGETS.
+NINJA?=ninja
+NINJA_FILE=$(BUILDDIR)/build.ninja
+NINJA_TARGETS?=
+NINJA_LINK_JOBS?=1
+NINJA_SIM_JOBS?=1
+NINJA_LINK_COMMAND=cd $(BUILDDIR); CXXFLAGS="$(CXXFLAGS)" $(BSV) -e $(TESTBENCH_MODULE) -o $(OUTFILE) $(BSC_FLAGS) $(BASEPARAMS_SIM) $(addprefix -l , $(EXTRA_LIBRARIES)) $(abspath $(C_FILES) $(CPP_FILES))
+# The top module is elaborated to Verilog for ip in either simulation mode. Bluesim
+# builds compile the Verilog variants of the packages into a directory of their own.
+ifeq ($(SIM_TYPE), VERILOG)
+NINJA_IP_ELAB=$(BSV) -elab $(COMPLETE_FLAGS) $(BSC_FLAGS) -g $(TOP_MODULE) -u $(SRCDIR)/$(MAIN_MODULE).bsv
+else
+NINJA_IP_OBJECTS=$(BUILDDIR)/ip_objects
+NINJA_IP_ELAB=$(MKDIR) -p $(NINJA_IP_OBJECTS) $(BUILDDIR)/$(VERILOGDIR) && $(BSV) -elab -verilog -vdir $(BUILDDIR)/$(VERILOGDIR) -fdir $(PWD) \
+	-bdir $(NINJA_IP_OBJECTS) -info-dir $(NINJA_IP_OBJECTS) -p $(LIBRARIES) $(BSC_FLAGS) -D VERILOG -g $(TOP_MODULE) -u $(SRCDIR)/$(MAIN_MODULE).bsv
+endif
+NINJA_ARGS=$(DEPS_ARGS) --ninja $(NINJA_FILE) --bsc $(BSV) --compile_flags '$(subst ','\'',$(COMPLETE_FLAGS) $(BSC_FLAGS))' --elab $(ELAB_PACKAGES) \
+	--link '$(subst ','\'',$(NINJA_LINK_COMMAND))' --link_output $(BUILDDIR)/$(OUTFILE) --link_package $(basename $(notdir $(TESTBENCH_FILE))) \
+	$(if $(strip $(C_FILES) $(CPP_FILES)),--link_inputs $(C_FILES) $(CPP_FILES)) --sim '$(subst ','\'',$(SIM_COMMAND))' \
+	$(if $(filter ip,$(NINJA_TARGETS)),--ip '$(subst ','\'',($(IP_COMMAND))$(if $(ZIP), && $(IP_ZIP_COMMAND)))' \
+		--ip_elab '$(subst ','\'',$(NINJA_IP_ELAB))' --ip_elab_output $(BUILDDIR)/$(VERILOGDIR)/$(TOP_MODULE).v --ip_elab_package $(MAIN_MODULE)) \
+	--link_jobs $(NINJA_LINK_JOBS) --sim_jobs $(NINJA_SIM_JOBS) -- $(LIBRARIES_BASE)
+ninja: | directories
+	$(SILENTCMD)echo '$(subst ','\'',$(NINJA_ARGS))' | cmp -s - $(BUILDDIR)/.ninja_args && [ -f $(NINJA_FILE) ] || \
+		($(BSV_DEPS) $(NINJA_ARGS) && echo '$(subst ','\'',$(NINJA_ARGS))' > $(BUILDDIR)/.ninja_args)
+	$(SILENTCMD)$(NINJA) -f $(NINJA_FILE) $(NINJA_TARGETS)
+
+prune_builds:
+	$(SILENTCMD)$(PRUNE_BUILDS)
 
 clean:
 	@echo "Cleaning working files"
@@ -156,4 +350,4 @@ clean_project:
 
 clean_all: clean
 	@echo "Cleaning all files"
-	$(SILENTCMD)$(RM) -rf $(BUILDDIR)
+	$(SILENTCMD)$(RM) -rf $(BUILD_BASE)
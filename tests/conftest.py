@@ -0,0 +1,8 @@
+import os
+import sys
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The scripts are run directly by rules.mk and import each other by module name,
+# bsvNew.py and bsvAdd.py are run from the repository root
+sys.path.insert(0, os.path.join(repo, "scripts"))
+sys.path.insert(0, repo)
@@ -0,0 +1,83 @@
+import os
+import sys
+import stat
+import subprocess
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "bsvCompile.py")
+
+fakeBsc = """#!{python}
+# Writes the source and the defines it was called with into the .bo
+import os
+import sys
+args = sys.argv[1:]
+if args == ["-v"]:
+    print("fake bsc 1.0")
+    sys.exit(0)
+with open(os.environ["FAKE_BSC_LOG"], "a") as f:
+    f.write(" ".join(args) + "\\n")
+source = args[-1]
+with open(source) as f:
+    text = f.read()
+bo = os.path.join(args[args.index("-bdir") + 1], os.path.basename(source)[:-4] + ".bo")
+with open(bo, "w") as f:
+    f.write(text + " ".join(a for a in args if a.startswith("-D")))
+"""
+
+class Project:
+    def __init__(self, root):
+        self.root = root
+        self.bsc = os.path.join(root, "bsc")
+        with open(self.bsc, "w") as f:
+            f.write(fakeBsc.format(python=sys.executable))
+        os.chmod(self.bsc, os.stat(self.bsc).st_mode | stat.S_IXUSR)
+        self.log = os.path.join(root, "bsc.log")
+        self.source = os.path.join(root, "A.bsv")
+        self.write("package A;\nendpackage\n")
+
+    def write(self, text):
+        with open(self.source, "w") as f:
+            f.write(text)
+
+    def compile(self, builddir, defines, macros, flags=[]):
+        """returns the .bo and whether bsc ran"""
+        bdir = os.path.join(self.root, builddir)
+        os.makedirs(bdir, exist_ok=True)
+        calls = self.calls()
+        command = [sys.executable, script, "--cache_dir", os.path.join(self.root, "cache"), "--deps", self.source, "--macros"] + macros + \
+                  ["--", self.bsc, "-bdir", bdir] + ["-D{}".format(d) for d in defines] + flags + [self.source]
+        subprocess.check_call(command, env=dict(os.environ, FAKE_BSC_LOG=self.log), stdout=subprocess.DEVNULL)
+        with open(os.path.join(bdir, "A.bo")) as f:
+            return f.read(), self.calls() > calls
+
+    def calls(self):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as f:
+            return len(f.readlines())
+
+def test_unreferenced_defines_are_not_part_of_the_key(tmp_path):
+    p = Project(str(tmp_path))
+    assert p.compile("a", ["X=1", "Y=1"], ["X"])[1]
+    bo, compiled = p.compile("b", ["X=1", "Y=2"], ["X"])
+    assert not compiled
+    # Restored outputs are those of the first compile
+    assert bo.endswith("-DX=1 -DY=1")
+
+def test_referenced_defines_and_sources_are_part_of_the_key(tmp_path):
+    p = Project(str(tmp_path))
+    assert p.compile("a", ["X=1"], ["X"])[1]
+    assert p.compile("a", ["X=2"], ["X"])[1]
+    p.write("package A;\n// changed\nendpackage\n")
+    assert p.compile("a", ["X=2"], ["X"])[1]
+    assert not p.compile("b", ["X=2"], ["X"])[1]
+
+def test_objects_are_shared_across_run_test(tmp_path):
+    # rules.mk passes -D "RUN_TEST=<test>" and builds every test in its own directory
+    p = Project(str(tmp_path))
+    runTest = lambda test: ["-D", "RUN_TEST={}".format(test), "-D", "TESTNAME=mk{}".format(test)]
+    assert p.compile("TestsA", [], [], runTest("TestsA"))[1]
+    assert not p.compile("TestsB", [], [], runTest("TestsB"))[1]
+    # A package selecting the test is compiled per test
+    assert p.compile("TestsA", [], ["RUN_TEST"], runTest("TestsA"))[1]
+    assert p.compile("TestsB", [], ["RUN_TEST"], runTest("TestsB"))[1]
+    assert not p.compile("TestsC", [], ["RUN_TEST"], runTest("TestsA"))[1]
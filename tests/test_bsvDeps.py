@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import subprocess
+import bsvDeps
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "bsvDeps.py")
+
+def writeSources(root):
+    os.makedirs(root)
+    with open(os.path.join(root, "A.bsv"), "w") as f:
+        f.write("package A;\nimport B :: *;\nendpackage\n")
+    with open(os.path.join(root, "B.bsv"), "w") as f:
+        f.write("package B;\nendpackage\n")
+
+def runDeps(builddir, output, roots, args=[]):
+    subprocess.check_call([sys.executable, script, "--builddir", builddir, "--output", output] + args + roots)
+    with open(output) as f:
+        return f.read().splitlines()
+
+def loadStamps(builddir):
+    with open(os.path.join(builddir, bsvDeps.cacheName)) as f:
+        return {k: v["stamp"] for k, v in json.load(f)["files"].items()}
+
+def countPreprocess(monkeypatch):
+    calls = []
+    original = bsvDeps.preprocess
+    def counting(filename, *args, **kwargs):
+        calls.append(filename)
+        return original(filename, *args, **kwargs)
+    monkeypatch.setattr(bsvDeps, "preprocess", counting)
+    return calls
+
+def test_graph(tmp_path):
+    src = str(tmp_path / "src")
+    writeSources(src)
+    graph = bsvDeps.resolveGraph([(src, False)], str(tmp_path / "build"), {})
+    assert graph.imports == {"A": {"B"}, "B": set()}
+
+def test_rules_are_only_rewritten_on_change(tmp_path):
+    src = str(tmp_path / "src")
+    builddir = str(tmp_path / "build")
+    output = str(tmp_path / ".deps")
+    writeSources(src)
+    rules = runDeps(builddir, output, [src])
+    assert "{0}/A.bo: {1}/A.bsv {0}/B.bo".format(builddir, src) in rules
+    assert "OBJS={0}/B.bo {0}/A.bo".format(builddir) in rules
+    os.utime(output, ns=(0, 0))
+    runDeps(builddir, output, [src])
+    assert os.stat(output).st_mtime_ns == 0
+
+def test_unchanged_files_are_not_preprocessed(tmp_path, monkeypatch):
+    src = str(tmp_path / "src")
+    writeSources(src)
+    a = os.path.join(src, "A.bsv")
+    cache = {a: bsvDeps.scanFile(a, {}, {}, [src])}
+    calls = countPreprocess(monkeypatch)
+    assert bsvDeps.scanFile(a, cache, {}, [src])["imports"] == ["B"]
+    assert calls == []
+    with open(a, "a") as f:
+        f.write("// changed\n")
+    bsvDeps.scanFile(a, cache, {}, [src])
+    assert calls == [a]
+
+def test_changed_define_rescans(tmp_path, monkeypatch):
+    src = str(tmp_path / "src")
+    os.makedirs(src)
+    a = os.path.join(src, "A.bsv")
+    with open(a, "w") as f:
+        f.write("package A;\n`ifdef USE_B\nimport B :: *;\n`endif\nendpackage\n")
+    cache = {a: bsvDeps.scanFile(a, {}, {}, [src])}
+    assert cache[a]["imports"] == []
+    calls = countPreprocess(monkeypatch)
+    # Defines the file does not reference keep the entry
+    assert bsvDeps.scanFile(a, cache, {"OTHER": "1"}, [src]) is cache[a]
+    assert bsvDeps.scanFile(a, cache, {"USE_B": "1"}, [src])["imports"] == ["B"]
+    assert calls == [a]
+
+def test_missing_include_rescans_once_it_exists(tmp_path):
+    src = str(tmp_path / "src")
+    os.makedirs(src)
+    a = os.path.join(src, "A.bsv")
+    with open(a, "w") as f:
+        f.write("package A;\n`include \"Imports.bsvi\"\nendpackage\n")
+    cache = {a: bsvDeps.scanFile(a, {}, {}, [src])}
+    assert cache[a]["imports"] == []
+    assert bsvDeps.scanFile(a, cache, {}, [src]) is cache[a]
+    with open(os.path.join(src, "Imports.bsvi"), "w") as f:
+        f.write("import B :: *;\n")
+    assert bsvDeps.scanFile(a, cache, {}, [src])["imports"] == ["B"]
+
+def test_touched_file_stamp_is_stored(tmp_path, monkeypatch):
+    src = str(tmp_path / "src")
+    builddir = str(tmp_path / "build")
+    writeSources(src)
+    bsvDeps.resolveGraph([(src, False)], builddir, {})
+    a = os.path.join(src, "A.bsv")
+    st = os.stat(a)
+    os.utime(a, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+    calls = countPreprocess(monkeypatch)
+    bsvDeps.resolveGraph([(src, False)], builddir, {})
+    # Same content: hashed again but not preprocessed, the new stamp is stored
+    assert calls == []
+    assert loadStamps(builddir)[a] == bsvDeps.stamp(a)
+
+def test_topological_order():
+    graph = {"A": ["B", "C"], "B": ["C"], "C": [], "D": []}
+    assert bsvDeps.topologicalOrder(graph) == (["C", "B", "A", "D"], [])
+
+def test_import_cycles():
+    graph = {"A": ["B"], "B": ["C"], "C": ["A"], "D": ["D"], "E": ["A"]}
+    order, cycles = bsvDeps.topologicalOrder(graph)
+    assert order == []
+    assert sorted(cycles) == [["A", "B", "C", "A"], ["D", "D"]]
+
+def test_first_root_defines_a_package(tmp_path):
+    src = str(tmp_path / "src")
+    lib = str(tmp_path / "lib")
+    builddir = str(tmp_path / "build")
+    writeSources(src)
+    os.makedirs(lib)
+    with open(os.path.join(lib, "B.bsv"), "w") as f:
+        f.write("package B;\nimport C :: *;\nendpackage\n")
+    with open(os.path.join(lib, "C.bsv"), "w") as f:
+        f.write("package C;\nendpackage\n")
+    rules = runDeps(builddir, str(tmp_path / ".deps"), ["%/Libraries", src, lib])
+    assert "{}/B.bo: {}/B.bsv ".format(builddir, src) in rules
+    assert "OBJS={0}/B.bo {0}/A.bo {0}/C.bo".format(builddir) in rules
+
+def test_prebuilt_library_imports(tmp_path):
+    src = str(tmp_path / "src")
+    bluespecdir = str(tmp_path / "bluespec")
+    builddir = str(tmp_path / "build")
+    os.makedirs(src)
+    os.makedirs(os.path.join(bluespecdir, "Libraries"))
+    vector = os.path.join(bluespecdir, "Libraries", "Vector.bo")
+    open(vector, "w").close()
+    with open(os.path.join(src, "A.bsv"), "w") as f:
+        f.write("package A;\nimport Vector :: *;\nimport Missing :: *;\nendpackage\n")
+    rules = runDeps(builddir, str(tmp_path / ".deps"), ["%/Libraries", src], ["--bluespec_dir", bluespecdir])
+    assert "{}/A.bo: {}/A.bsv {}".format(builddir, src, vector) in rules
+
+def test_package_rules(tmp_path):
+    # One make rule per package lets make compile independent packages in parallel
+    src = str(tmp_path / "src")
+    builddir = str(tmp_path / "build")
+    writeSources(src)
+    with open(os.path.join(src, "C.bsv"), "w") as f:
+        f.write("package C;\n`ifdef RUN_TEST\nimport B :: *;\n`endif\nendpackage\n")
+    rules = runDeps(builddir, str(tmp_path / ".deps"), [src], ["--run_test", "TestsA"])
+    bo = lambda m: "{}/{}.bo".format(builddir, m)
+    assert "{}: {} {}".format(bo("A"), os.path.join(src, "A.bsv"), bo("B")) in rules
+    assert "{}: {} {}".format(bo("C"), os.path.join(src, "C.bsv"), bo("B")) in rules
+    assert "{}: private PACKAGE_MACROS=RUN_TEST".format(bo("C")) in rules
+    objs = [l for l in rules if l.startswith("OBJS=")][0][5:].split()
+    assert objs.index(bo("B")) < objs.index(bo("A"))
+    assert objs.index(bo("B")) < objs.index(bo("C"))
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import bsvNew
+
+def git(*args):
+    return subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@localhost"] + list(args), check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout.strip()
+
+def writeOrigin(tmp_path):
+    """returns the file:// URL of a library repository with one commit"""
+    origin = str(tmp_path / "origin" / "Lib")
+    os.makedirs(origin)
+    git("init", "--quiet", origin)
+    commit(origin, "first")
+    return "file://" + origin
+
+def commit(repo, message):
+    with open(os.path.join(repo, "history.txt"), "a") as f:
+        f.write(message + "\n")
+    git("-C", repo, "add", "history.txt")
+    git("-C", repo, "commit", "--quiet", "-m", message)
+
+def project(tmp_path, name):
+    path = str(tmp_path / name)
+    os.makedirs(os.path.join(path, "libraries"))
+    return path
+
+def history(path):
+    with open(os.path.join(path, "libraries", "Lib", "history.txt")) as f:
+        return f.read().split()
+
+def test_libraries_are_cloned_from_the_mirror(tmp_path, monkeypatch):
+    monkeypatch.setenv("BSV_MIRROR_DIR", str(tmp_path / "mirrors"))
+    url = writeOrigin(tmp_path)
+    first = project(tmp_path, "first")
+    bsvNew.create_libraries(first, [url])
+    assert history(first) == ["first"]
+    assert git("-C", os.path.join(first, "libraries", "Lib"), "remote", "get-url", "origin") == url
+    assert os.listdir(str(tmp_path / "mirrors")) == [os.path.basename(bsvNew.mirror_path(url))]
+    # The mirror is updated before it is used
+    commit(url[len("file://"):], "second")
+    second = project(tmp_path, "second")
+    bsvNew.create_libraries(second, [url])
+    assert history(second) == ["first", "second"]
+
+def test_offline_uses_existing_mirrors(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("BSV_MIRROR_DIR", str(tmp_path / "mirrors"))
+    url = writeOrigin(tmp_path)
+    bsvNew.create_libraries(project(tmp_path, "first"), [url])
+    commit(url[len("file://"):], "second")
+    offline = project(tmp_path, "offline")
+    assert bsvNew.create_libraries(offline, [url], offline=True)
+    assert history(offline) == ["first"]
+    capsys.readouterr()
+    assert not bsvNew.create_libraries(project(tmp_path, "missing"), [url + "2"], offline=True)
+    out = capsys.readouterr().out
+    assert "No mirror of {}2".format(url) in out
+    assert "Not all libraries could be fetched." in out
@@ -0,0 +1,45 @@
+import bsvDeps
+from bsvNinja import ninjaFile
+from test_bsvDeps import writeSources
+
+def settings(**kwargs):
+    s = {"bsc": "bsc", "compile_flags": "-sim", "elab": {}, "link": None, "sim": None, "ip": None,
+         "output": "build/build.ninja", "regen": "bsvDeps.py", "sources": [], "link_jobs": 1, "sim_jobs": 1, "ip_jobs": 1}
+    s.update(kwargs)
+    return s
+
+def generate(tmp_path, **kwargs):
+    src = str(tmp_path / "src")
+    writeSources(src)
+    graph = bsvDeps.resolveGraph([(src, False)], str(tmp_path / "build"), {})
+    return src, ninjaFile(graph, ["B", "A"], "build", settings(**kwargs))
+
+def test_compile_edge_per_package(tmp_path):
+    src, text = generate(tmp_path, elab={"A": "mkA"})
+    lines = text.splitlines()
+    assert "build build/A.bo: bsc {0}/A.bsv | build/B.bo".format(src) in lines
+    assert "build build/B.bo: bsc {0}/B.bsv | ".format(src) in lines
+    assert "  flags = -elab -g mkA" in lines
+    assert "build compile: phony build/A.bo" in lines
+    assert "build build/build.ninja: regen | {0}/A.bsv {0}/B.bsv".format(src) in lines
+    assert lines[-1] == "default compile"
+
+def test_link_and_sim_run_in_pools(tmp_path):
+    _, text = generate(tmp_path, elab={"A": "mkA"}, link="bsc -e mkA -o build/out", link_output="build/out",
+                       link_package="A", link_inputs=[], sim="build/out", sim_jobs=2)
+    lines = text.splitlines()
+    assert "build build/out: link build/A.bo | " in lines
+    assert "build sim: sim build/out" in lines
+    assert lines[lines.index("pool sim_pool") + 1] == "  depth = 2"
+    assert lines[-1] == "default sim"
+
+def test_no_ip_without_command(tmp_path):
+    assert "build ip:" not in generate(tmp_path)[1]
+
+def test_ip_elaborates_verilog(tmp_path):
+    _, text = generate(tmp_path, ip="package", ip_elab="bsc -elab -verilog -g mkA -u A.bsv",
+                       ip_elab_output="build/verilog/mkA.v", ip_elab_package="A")
+    lines = text.splitlines()
+    assert "  command = bsc -elab -verilog -g mkA -u A.bsv" in lines
+    assert any(l.startswith("build build/verilog/mkA.v: ip_elab ") and l.endswith("| build/A.bo") for l in lines)
+    assert "build ip: ip build/verilog/mkA.v" in lines
@@ -0,0 +1,32 @@
+import os
+from bsvPreprocessor import preprocess, parseDefines
+
+def scan(tmp_path, text, defines={}, files={}):
+    for name, content in files.items():
+        with open(os.path.join(str(tmp_path), name), "w") as f:
+            f.write(content)
+    filename = os.path.join(str(tmp_path), "A.bsv")
+    with open(filename, "w") as f:
+        f.write(text)
+    return preprocess(filename, defines, [str(tmp_path)])
+
+def test_parse_defines():
+    assert parseDefines('-D A -DB=2 -D "C=x y" -v') == {"A": "", "B": "2", "C": "x y"}
+
+def test_comments_and_strings(tmp_path):
+    r = scan(tmp_path, 'package A;\n// import X :: *;\n/* import Y :: *;\n*/ import B :: *; import C::*;\nString s = "import Z :: *;";\nendpackage\n')
+    assert r["imports"] == ["B", "C"]
+
+def test_conditionals(tmp_path):
+    text = "`ifdef FAST\nimport F :: *;\n`elsif SMALL\nimport S :: *;\n`else\nimport D :: *;\n`endif\n`ifndef FAST\nimport N :: *;\n`endif\n"
+    assert scan(tmp_path, text)["imports"] == ["D", "N"]
+    assert scan(tmp_path, text, {"SMALL": "1"})["imports"] == ["S", "N"]
+    r = scan(tmp_path, text, {"FAST": "1"})
+    assert r["imports"] == ["F"]
+    assert r["macros"] == ["FAST", "SMALL"]
+
+def test_macros_and_includes(tmp_path):
+    r = scan(tmp_path, '`include "Defs.bsvi"\n`define PKG Tests\nimport `PKG :: *;\n`ifdef FROM_INCLUDE\nimport I :: *;\n`endif\n',
+             files={"Defs.bsvi": "`define FROM_INCLUDE\n"})
+    assert r["imports"] == ["Tests", "I"]
+    assert r["includes"] == [os.path.join(str(tmp_path), "Defs.bsvi")]
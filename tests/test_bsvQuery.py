@@ -0,0 +1,34 @@
+import os
+import sys
+import subprocess
+import bsvQuery
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "bsvDeps.py")
+
+def writeGraph(tmp_path):
+    """Top imports A and B, both import C, D is alone"""
+    src = str(tmp_path / "src")
+    os.makedirs(src)
+    packages = {"Top": ["A", "B"], "A": ["C"], "B": ["C"], "C": [], "D": []}
+    for name, imports in packages.items():
+        with open(os.path.join(src, name + ".bsv"), "w") as f:
+            f.write("package {};\n{}endpackage\n".format(name, "".join("import {} :: *;\n".format(i) for i in imports)))
+    graph = str(tmp_path / "deps.json")
+    subprocess.check_call([sys.executable, script, "--builddir", str(tmp_path / "build"), "--output", str(tmp_path / ".deps"),
+                           "--json", graph, src])
+    return src, bsvQuery.loadGraph(graph)
+
+def test_affected_packages(tmp_path):
+    src, graph = writeGraph(tmp_path)
+    assert bsvQuery.packagesForFiles(graph, [os.path.join(src, "C.bsv")]) == ["C"]
+    assert sorted(bsvQuery.affectedPackages(graph, ["C"])) == ["A", "B", "C", "Top"]
+    assert bsvQuery.affectedPackages(graph, ["D"]) == ["D"]
+    # Build order: importers come after their imports
+    order = bsvQuery.affectedPackages(graph, ["C", "A"])
+    assert order.index("C") < order.index("A") < order.index("Top")
+
+def test_imports_and_importers(tmp_path):
+    src, graph = writeGraph(tmp_path)
+    assert sorted(bsvQuery.importedPackages(graph, "Top")) == ["A", "B", "C"]
+    assert sorted(bsvQuery.importingPackages(graph, "C")) == ["A", "B", "Top"]
+    assert bsvQuery.importingPackages(graph, "Top") == []
@@ -0,0 +1,43 @@
+import xml.etree.ElementTree as ET
+import bsvResults
+
+def result(test, sim, passed=True):
+    return {"test": test, "passed": passed, "seconds": sim + 2.0, "phases": {"compile": 1.0, "link": 1.0, "sim": sim}}
+
+def test_history_round_trip(tmp_path):
+    history = str(tmp_path / "history" / ".bsv_test_history")
+    bsvResults.appendHistory(history, [result("TestsA", 1.0)])
+    bsvResults.appendHistory(history, [result("TestsB", 2.0, False)])
+    runs = bsvResults.loadHistory(history)
+    assert [(r["test"], r["passed"], r["phases"]["sim"]) for r in runs] == [("TestsA", True, 1.0), ("TestsB", False, 2.0)]
+
+def test_slowdowns():
+    history = [result("TestsA", s) for s in [1.0, 1.1, 0.9, 1.0]] + [result("TestsA", 10.0, False)]
+    assert bsvResults.findSlowdowns(history, [result("TestsA", 1.05)]) == []
+    slowdowns = bsvResults.findSlowdowns(history, [result("TestsA", 2.0)])
+    assert [(s["test"], s["phase"], s["runs"]) for s in slowdowns] == [("TestsA", "sim", 4)]
+    # Too few previous runs
+    assert bsvResults.findSlowdowns(history[:2], [result("TestsA", 2.0)]) == []
+    # Failed runs are not compared
+    assert bsvResults.findSlowdowns(history, [result("TestsA", 2.0, False)]) == []
+
+def test_modes_are_compared_separately():
+    matrix = [result("TestsA", s) for s in [1.0, 1.1, 0.9, 1.0]]
+    single = dict(result("TestsA", 2.0), mode="single_binary")
+    # Runs without a mode are matrix runs
+    assert bsvResults.findSlowdowns(matrix, [single]) == []
+    slowdowns = bsvResults.findSlowdowns(matrix + [dict(r, mode="single_binary") for r in matrix], [single])
+    assert [(s["mode"], s["phase"], s["runs"]) for s in slowdowns] == [("single_binary", "sim", 4)]
+
+def test_junit(tmp_path):
+    log = tmp_path / "TestsB.log"
+    log.write_text("ERROR: mismatch\n")
+    failed = dict(result("TestsB", 1.0, False), log=str(log), failure="Failure pattern 'ERROR' matched in line 1")
+    junit = str(tmp_path / "results.xml")
+    bsvResults.writeJunit(junit, [result("TestsA", 1.0), failed], ["TestsC"])
+    suite = ET.parse(junit).getroot()
+    assert (suite.get("tests"), suite.get("failures"), suite.get("skipped")) == ("3", "1", "1")
+    cases = {c.get("name"): c for c in suite.findall("testcase")}
+    assert cases["TestsA"].find("failure") is None
+    assert cases["TestsB"].find("failure").text == "ERROR: mismatch\n"
+    assert cases["TestsC"].find("skipped") is not None
@@ -0,0 +1,41 @@
+import time
+from bsvSimMonitor import SimMonitor, run
+
+def test_failure_keeps_context():
+    monitor = SimMonitor(["ERROR"], context=1)
+    for l in ["a", "b", "ERROR: x", "c", "d"]:
+        monitor.feed(l)
+    assert monitor.finish(0) == "Failure pattern 'ERROR' matched in line 3"
+    assert monitor.matches == [{"line": 3, "before": ["b"], "text": "ERROR: x", "after": ["c"]}]
+
+def test_success_and_cycle_limit():
+    monitor = SimMonitor(["ERROR"], successPattern="PASSED")
+    monitor.feed("done")
+    assert monitor.finish(0) == "Success pattern 'PASSED' not found"
+    monitor = SimMonitor(["ERROR"], cyclePattern=r'^\[(\d+)\]', maxCycles=10)
+    assert monitor.feed("[5] running")
+    assert not monitor.feed("[11] running")
+    assert monitor.finish(0) == "Cycle limit of 10 exceeded"
+
+def test_failing_simulation_is_stopped():
+    start = time.monotonic()
+    failure = run(["sh", "-c", "echo ERROR; sleep 30"], SimMonitor(["ERROR"]), echo=False, drain=0.1)
+    assert failure.startswith("Failure pattern")
+    assert time.monotonic() - start < 10
+
+def test_timeout():
+    assert run(["sleep", "30"], SimMonitor(["ERROR"]), timeout=0.2, echo=False) == "Timeout after 0.2s"
+
+def cycles(lines, pattern=None):
+    monitor = SimMonitor(["ERROR"], cyclePattern=pattern)
+    for l in lines:
+        monitor.feed(l)
+    return monitor.cycles
+
+def test_finish_time():
+    assert cycles(["42 packets sent", "$finish called at time 1200"]) == 1200
+    assert cycles(["tb.v:10: $finish(1) called at 300 (1ps)"]) == 300
+
+def test_leading_numbers_need_a_pattern():
+    assert cycles(["42 packets sent", "[7] done"]) is None
+    assert cycles(["42 packets sent", "[7] done"], r'^\[(\d+)\]') == 7
@@ -0,0 +1,65 @@
+import os
+import sys
+import subprocess
+import pytest
+from bsvQuery import loadGraph
+from bsvTest import impactedTests, makeVariable
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "bsvDeps.py")
+
+def writeProject(root):
+    os.makedirs(root)
+    with open(os.path.join(root, "Common.bsv"), "w") as f:
+        f.write("package Common;\nendpackage\n")
+    with open(os.path.join(root, "Testbench.bsv"), "w") as f:
+        f.write("package Testbench;\nimport TestsA :: *;\nendpackage\n")
+    for name, imports in [("TestsA", "import Common :: *;\n"), ("TestsB", "")]:
+        with open(os.path.join(root, name + ".bsv"), "w") as f:
+            f.write("package {0};\n{1}module [Module] mk{0}(TestHandler);\nendmodule\nendpackage\n".format(name, imports))
+
+def projectGraph(tmp_path):
+    src = str(tmp_path / "src")
+    builddir = str(tmp_path / "build")
+    writeProject(src)
+    jsonFile = os.path.join(builddir, "deps.json")
+    subprocess.check_call([sys.executable, script, "--builddir", builddir, "--output", os.path.join(builddir, ".deps"),
+                           "--json", jsonFile, src])
+    return src, loadGraph(jsonFile)
+
+def test_changed_package_selects_importing_tests(tmp_path):
+    src, graph = projectGraph(tmp_path)
+    impacted, reasons = impactedTests(graph, [os.path.join(src, "Common.bsv")], "Testbench")
+    assert impacted == ["TestsA"]
+    assert reasons["TestsA"] == "Common changed"
+
+def test_testbench_selects_all_tests(tmp_path):
+    src, graph = projectGraph(tmp_path)
+    impacted, _ = impactedTests(graph, [os.path.join(src, "Testbench.bsv")], "Testbench")
+    assert sorted(impacted) == ["TestsA", "TestsB"]
+
+def test_unknown_file_selects_all_tests(tmp_path):
+    src, graph = projectGraph(tmp_path)
+    impacted, reasons = impactedTests(graph, [os.path.join(src, "model.cpp")], "Testbench")
+    assert sorted(impacted) == ["TestsA", "TestsB"]
+    assert reasons["TestsB"] == "{} changed".format(os.path.relpath(os.path.join(src, "model.cpp")))
+
+def test_unknown_package_selects_all_tests(tmp_path):
+    src, graph = projectGraph(tmp_path)
+    # e.g. a deleted or renamed package
+    impacted, reasons = impactedTests(graph, [os.path.join(src, "Removed.bsv")], "Testbench")
+    assert sorted(impacted) == ["TestsA", "TestsB"]
+    assert reasons["TestsB"] == "{} changed".format(os.path.relpath(os.path.join(src, "Removed.bsv")))
+
+def test_documentation_is_ignored(tmp_path):
+    src, graph = projectGraph(tmp_path)
+    impacted, _ = impactedTests(graph, [os.path.join(src, "Readme.md")], "Testbench")
+    assert impacted == []
+
+def test_failing_make_output_is_shown(tmp_path, monkeypatch, capsys):
+    with open(str(tmp_path / "Makefile"), "w") as f:
+        f.write("deps_graph:\n\t@echo generating\n\t@echo broken rule >&2; false\n")
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(SystemExit):
+        makeVariable("make", "deps_graph")
+    out = capsys.readouterr().out
+    assert "generating" in out and "broken rule" in out
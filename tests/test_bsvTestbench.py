@@ -0,0 +1,30 @@
+import os
+import bsvDeps
+import bsvTestbench
+
+def test_all_tests_are_instantiated():
+    source = bsvTestbench.testbenchSource("TestbenchAll", ["TestsA", "TestsB"])
+    assert "module [Module] mkTestbenchAll();" in source
+    assert "TestHandler test0 <- mkTestsA();" in source
+    assert "TestHandler test1 <- mkTestsB();" in source
+    assert '$test$plusargs("test=TestsB:")' in source
+
+def test_selection_is_exact():
+    source = bsvTestbench.testbenchSource("TestbenchAll", ["TestsA", "TestsAB"])
+    assert '$test$plusargs("test=TestsA:")' in source
+    assert '$test$plusargs("test=TestsAB:")' in source
+    assert "selected0 <= t0;" in source
+
+def test_testbench_is_added_to_the_graph(tmp_path):
+    src = str(tmp_path / "src")
+    builddir = str(tmp_path / "build")
+    os.makedirs(src)
+    for name in ["TestsA", "TestsB"]:
+        with open(os.path.join(src, name + ".bsv"), "w") as f:
+            f.write("package {0};\nmodule [Module] mk{0}(TestHandler);\nendmodule\nendpackage\n".format(name))
+    testbench = os.path.join(builddir, "TestbenchAll.bsv")
+    os.makedirs(builddir)
+    graph = bsvDeps.resolveGraph([(src, False)], builddir, {}, testbench=testbench)
+    assert graph.tests == ["TestsA", "TestsB"]
+    assert graph.sources["TestbenchAll"] == testbench
+    assert sorted(graph.imports["TestbenchAll"]) == ["TestsA", "TestsB"]
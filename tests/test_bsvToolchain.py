@@ -0,0 +1,57 @@
+import os
+import stat
+from bsvToolchain import Toolchain, cachePrefix
+
+fakeBsc = """#!/bin/sh
+# Reports the Bluespec directory and counts the calls
+echo call >> "$FAKE_BSC_LOG"
+echo "Bluespec directory: $FAKE_BLUESPECDIR"
+"""
+
+def writeBsc(tmp_path, monkeypatch):
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    bsc = bin / "bsc"
+    bsc.write_text(fakeBsc)
+    os.chmod(str(bsc), os.stat(str(bsc)).st_mode | stat.S_IXUSR)
+    (tmp_path / "bluespec").mkdir()
+    monkeypatch.setenv("PATH", "{}:{}".format(bin, os.environ["PATH"]))
+    monkeypatch.setenv("FAKE_BSC_LOG", str(tmp_path / "bsc.log"))
+    monkeypatch.setenv("FAKE_BLUESPECDIR", str(tmp_path / "bluespec"))
+    monkeypatch.delenv("BLUESPECDIR", raising=False)
+    project = tmp_path / "project"
+    (project / "src").mkdir(parents=True)
+    (project / ".bsv_tools").write_text("BSV_TOOLS=/opt/BSVTools\n")
+    return bsc, project
+
+def calls(tmp_path):
+    log = tmp_path / "bsc.log"
+    return len(log.read_text().splitlines()) if log.exists() else 0
+
+def test_bluespec_dir_is_cached(tmp_path, monkeypatch):
+    bsc, project = writeBsc(tmp_path, monkeypatch)
+    assert Toolchain(str(project / "src")).bluespecDir() == str(tmp_path / "bluespec")
+    assert calls(tmp_path) == 1
+    lines = (project / ".bsv_tools").read_text().splitlines()
+    assert lines[0] == "BSV_TOOLS=/opt/BSVTools"
+    assert lines[1].startswith(cachePrefix)
+    # A new process reads the result from .bsv_tools
+    assert Toolchain(str(project)).bluespecDir() == str(tmp_path / "bluespec")
+    assert calls(tmp_path) == 1
+
+def test_changed_bsc_or_path_is_probed_again(tmp_path, monkeypatch):
+    bsc, project = writeBsc(tmp_path, monkeypatch)
+    Toolchain(str(project)).bluespecDir()
+    with open(str(bsc), "a") as f:
+        f.write("# updated\n")
+    Toolchain(str(project)).bluespecDir()
+    assert calls(tmp_path) == 2
+    monkeypatch.setenv("PATH", os.environ["PATH"] + ":/nonexistent")
+    Toolchain(str(project)).bluespecDir()
+    assert calls(tmp_path) == 3
+
+def test_environment_overrides(tmp_path, monkeypatch):
+    bsc, project = writeBsc(tmp_path, monkeypatch)
+    monkeypatch.setenv("BLUESPECDIR", "/opt/bluespec/lib")
+    assert Toolchain(str(project)).bluespecDir() == "/opt/bluespec/lib"
+    assert calls(tmp_path) == 0
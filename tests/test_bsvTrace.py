@@ -0,0 +1,49 @@
+import os
+import sys
+import json
+import subprocess
+from bsvTrace import durations, criticalPath, schedule
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "bsvTrace.py")
+
+def record(trace, name, command):
+    subprocess.check_call([sys.executable, script, "record", "--trace", trace, "--name", name, "--"] + command)
+    with open(trace) as f:
+        return [json.loads(l) for l in f]
+
+def makeGraph(imports):
+    order = list(imports)
+    packages = {m: {"imports": imports[m], "importedBy": [u for u in order if m in imports[u]]} for m in order}
+    return {"order": order, "packages": packages}
+
+# C is imported by A and B, Top imports both
+graph = makeGraph({"C": [], "A": ["C"], "B": ["C"], "Top": ["A", "B"]})
+cost = {"C": 1, "A": 4, "B": 2, "Top": 1}
+
+def test_record(tmp_path):
+    trace = str(tmp_path / "trace.jsonl")
+    record(trace, "A", ["true"])
+    entries = record(trace, "mkTestbench", ["true", "-e", "mkTestbench"])
+    assert [(e["name"], e["phase"], e["ok"]) for e in entries] == [("A", "compile", True), ("mkTestbench", "link", True)]
+
+def test_latest_duration():
+    entries = [{"name": "A", "start": 0, "end": 5}, {"name": "A", "start": 10, "end": 12}]
+    assert durations(entries) == {"A": 2}
+
+def test_critical_path():
+    assert criticalPath(graph, cost) == (6, ["C", "A", "Top"])
+
+def test_schedule():
+    assert schedule(graph, cost, 1) == 8
+    assert schedule(graph, cost, 2) == 6
+
+def test_cache_hits_are_marked(tmp_path):
+    trace = str(tmp_path / "trace.jsonl")
+    record(trace, "A", ["true"])
+    entries = record(trace, "A", ["sh", "-c", 'touch "$BSV_COMPILE_HIT_FILE"'])
+    assert [e["cached"] for e in entries] == [False, True]
+
+def test_cache_hits_keep_the_compile_time():
+    entries = [{"name": "A", "start": 0, "end": 5}, {"name": "A", "start": 10, "end": 10.01, "cached": True},
+               {"name": "B", "start": 0, "end": 1, "cached": True}]
+    assert durations(entries) == {"A": 5}
@@ -0,0 +1,42 @@
+import os
+import bsvVerilog
+
+def writeLibrary(root):
+    """FIFO2 instantiates RegN, SizedFIFO is not used"""
+    for sub, name, body in [("Verilog", "FIFO2", "RegN #(.width(1)) r(.CLK(CLK));"), ("Verilog", "RegN", ""),
+                            ("Verilog", "SizedFIFO", ""), ("Verilog.Vivado", "RegN", "")]:
+        os.makedirs(os.path.join(root, sub), exist_ok=True)
+        with open(os.path.join(root, sub, name + ".v"), "w") as f:
+            f.write("module {}(CLK);\n{}\nendmodule\n".format(name, body))
+
+def writeTop(root, body):
+    top = os.path.join(root, "mkTop.v")
+    with open(top, "w") as f:
+        f.write("module mkTop(CLK);\n{}\nendmodule\n".format(body))
+    return top
+
+def test_instantiated_library_files(tmp_path, monkeypatch):
+    monkeypatch.setenv("BSV_TOOLS_CACHE_DIR", str(tmp_path / "cache"))
+    bluespec = str(tmp_path / "bluespec")
+    writeLibrary(bluespec)
+    index = bsvVerilog.primitiveIndex(bluespec)
+    top = writeTop(str(tmp_path), "FIFO2 f(.CLK(CLK));\n// SizedFIFO s(.CLK(CLK));")
+    files = bsvVerilog.requiredLibraryFiles("mkTop", [top], index)
+    # Verilog.Vivado replaces the generic RegN
+    assert [os.path.relpath(f, bluespec) for f in files] == ["Verilog.Vivado/RegN.v", "Verilog/FIFO2.v"]
+
+def test_index_is_cached(tmp_path, monkeypatch):
+    monkeypatch.setenv("BSV_TOOLS_CACHE_DIR", str(tmp_path / "cache"))
+    bluespec = str(tmp_path / "bluespec")
+    writeLibrary(bluespec)
+    first = bsvVerilog.primitiveIndex(bluespec)
+    scanned = []
+    original = bsvVerilog.scanVerilog
+    monkeypatch.setattr(bsvVerilog, "scanVerilog", lambda f: scanned.append(f) or original(f))
+    assert bsvVerilog.primitiveIndex(bluespec) == first
+    assert scanned == []
+    fifo = os.path.join(os.path.realpath(bluespec), "Verilog", "FIFO2.v")
+    with open(fifo, "a") as f:
+        f.write("// changed\n")
+    assert bsvVerilog.primitiveIndex(bluespec)["fingerprint"] != first["fingerprint"]
+    assert scanned == [fifo]
@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import stat
+import time
+import subprocess
+import bsvTools
+import bsvToolchain
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "bsvTools.py")
+
+fakeVivado = """#!/bin/sh
+# Prints the lines of $FAKE_VIVADO_OUTPUT as Vivado output, then keeps running
+cat "$FAKE_VIVADO_OUTPUT"
+sleep ${FAKE_VIVADO_SLEEP:-0}
+"""
+
+def writeVivado(tmp_path, monkeypatch, output, sleep=0):
+    """puts the fake vivado in the PATH, packaging runs in batch mode in tmp_path"""
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    vivado = str(bin / "vivado")
+    with open(vivado, "w") as f:
+        f.write(fakeVivado)
+    os.chmod(vivado, os.stat(vivado).st_mode | stat.S_IXUSR)
+    (tmp_path / "output").write_text("".join(l + "\n" for l in output))
+    monkeypatch.setenv("FAKE_VIVADO_OUTPUT", str(tmp_path / "output"))
+    monkeypatch.setenv("FAKE_VIVADO_SLEEP", str(sleep))
+    monkeypatch.setenv("PATH", "{}:{}".format(bin, os.environ["PATH"]))
+    monkeypatch.setenv("BSV_VIVADO_SERVER_DIR", str(tmp_path / "server"))
+    monkeypatch.chdir(tmp_path)
+    # Tools are looked up again in the new PATH
+    monkeypatch.setattr(bsvToolchain, "current", None)
+    return vivado
+
+def runVivado():
+    return bsvTools.runVivado(lambda tmp, convert: "", "tmp")
+
+def test_used_files(tmp_path, monkeypatch):
+    writeVivado(tmp_path, monkeypatch, ["# read_verilog", "USED FILE:/ip/src/A.v", "USED FILE:/ip/src/B.v",
+                                        "VIVADO FINISHED SUCCESSFULLY"])
+    usedfiles, tail = runVivado()
+    assert usedfiles == ["/ip/src/A.v", "/ip/src/B.v"]
+    assert tail[-1] == "VIVADO FINISHED SUCCESSFULLY"
+
+def test_missing_success_marker_fails(tmp_path, monkeypatch):
+    writeVivado(tmp_path, monkeypatch, ["USED FILE:/ip/src/A.v"])
+    assert runVivado()[0] is None
+
+def test_first_error_stops_vivado(tmp_path, monkeypatch):
+    writeVivado(tmp_path, monkeypatch, ["# synth_design", "ERROR: [Synth 8-439] module 'mkX' not found"], sleep=30)
+    start = time.monotonic()
+    usedfiles, tail = runVivado()
+    assert usedfiles is None
+    assert tail[-1].startswith("ERROR: [Synth 8-439]")
+    assert time.monotonic() - start < 10
+
+def test_tail_is_bounded(tmp_path, monkeypatch):
+    vivado = writeVivado(tmp_path, monkeypatch, ["INFO: {}".format(i) for i in range(500)] + ["VIVADO FINISHED SUCCESSFULLY"])
+    assert len(bsvTools.streamVivado(vivado, lambda l: None, tailLength=20)[1]) == 20
+
+# Stands in for Vivado in batch mode. The packaging commands used by bsvTools
+# either do nothing or keep the state Vivado would: the constraint files of the
+# project and those merged into the core, which ipx::save_core writes into
+# component.xml. A missing top level file fails like in Vivado. Every other
+# command is logged to $FAKE_VIVADO_LOG.
+fakeVivadoTcl = """
+namespace eval ipx {}
+set root ""
+set constrs {}
+set merged {}
+proc called {args} {
+    set f [open $::env(FAKE_VIVADO_LOG) a]
+    puts $f $args
+    close $f
+}
+proc ipx::infer_core {args} {
+    global root
+    called ipx::infer_core
+    set files [lindex $args [expr {[lsearch $args -files] + 1}]]
+    set root [lindex $args [expr {[lsearch $args -root_dir] + 1}]]
+    set ::constrs {}
+    set ::merged {}
+    if {![file exists $files]} {
+        puts "ERROR: \\[IP_Flow 19-167\\] Failed to deduce top HDL module"
+        error "infer_core failed"
+    }
+}
+proc ipx::edit_ip_in_project {args} {
+    global root
+    set root [file dirname [lindex $args end]]
+    if {[file exists $root/component.xml]} {
+        set f [open $root/component.xml]
+        set ::constrs [read -nonewline $f]
+        set ::merged $::constrs
+        close $f
+    }
+}
+proc ipx::current_core {args} {
+    return core
+}
+proc ipx::merge_project_changes {what core} {
+    if {$what eq "files"} {
+        set ::merged $::constrs
+    }
+}
+proc ipx::save_core {core} {
+    global root
+    set f [open $root/component.xml w]
+    puts $f $::merged
+    close $f
+}
+proc ipx::get_files {args} {
+    global root
+    set used {}
+    foreach f [glob -directory $root/src *] {
+        if {[file tail $f] ne "unused.v"} {
+            lappend used $f
+        }
+    }
+    return $used
+}
+proc add_files {args} {
+    if {[lsearch $args constrs_1] >= 0} {
+        lappend ::constrs [lindex $args end]
+    }
+}
+proc remove_files {f} {
+    set ::constrs [lsearch -all -inline -exact -not $::constrs $f]
+}
+proc get_files {args} {
+    if {[lsearch $args -of_objects] >= 0} {
+        return $::constrs
+    }
+    return [lindex $args end]
+}
+proc get_property {name object} {
+    return $object
+}
+proc unknown {args} {
+    called {*}$args
+    return ""
+}
+source [lindex $argv 0]
+"""
+
+def writeIpProject(tmp_path):
+    """returns the environment running the fake Vivado"""
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    (bin / "vivado.tcl").write_text(fakeVivadoTcl)
+    vivado = str(bin / "vivado")
+    with open(vivado, "w") as f:
+        f.write('#!/bin/sh\n# vivado -mode batch -source <script> ...\nexec tclsh "$(dirname "$0")/vivado.tcl" "$4"\n')
+    os.chmod(vivado, os.stat(vivado).st_mode | stat.S_IXUSR)
+    verilog = tmp_path / "verilog"
+    verilog.mkdir()
+    (verilog / "mkTop.v").write_text("module mkTop();\nendmodule\n")
+    (verilog / "unused.v").write_text("module unused();\nendmodule\n")
+    (tmp_path / "bluespec").mkdir()
+    return dict(os.environ, PATH="{}:{}".format(bin, os.environ["PATH"]), BSV_VIVADO_SERVER_DIR=str(tmp_path / "server"),
+                BSV_TOOLS_CACHE_DIR=str(tmp_path / "cache"), FAKE_VIVADO_LOG=str(tmp_path / "vivado.log"))
+
+def runTools(tmp_path, env, args):
+    return subprocess.run([sys.executable, script, ".", ] + args + ["--verilog_dir", "verilog", "--bluespec_dir", "bluespec"],
+                          cwd=str(tmp_path), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+def vivadoCalls(tmp_path):
+    """returns the commands logged by the fake Vivado since the last call"""
+    log = tmp_path / "vivado.log"
+    if not log.exists():
+        return []
+    calls = log.read_text().splitlines()
+    log.unlink()
+    return calls
+
+def packagedConstraints(tmp_path, core):
+    return [os.path.basename(f) for f in (tmp_path / "ip" / core / "component.xml").read_text().split()]
+
+def test_unused_files_are_removed(tmp_path):
+    env = writeIpProject(tmp_path)
+    p = runTools(tmp_path, env, ["mkVivado", "Core", "mkTop"])
+    assert p.returncode == 0, p.stdout
+    assert "Vivado finished successfully." in p.stdout
+    assert os.listdir(str(tmp_path / "ip" / "Core" / "src")) == ["mkTop.v"]
+
+def test_batch_keeps_going_after_a_failing_core(tmp_path):
+    env = writeIpProject(tmp_path)
+    manifest = tmp_path / "cores.json"
+    manifest.write_text(json.dumps({"cores": [{"name": "Broken", "topModule": "mkMissing"}, {"name": "Good", "topModule": "mkTop"}]}))
+    p = runTools(tmp_path, env, ["mkVivadoBatch", "--manifest", str(manifest)])
+    assert p.returncode == 1
+    assert "Good: packaged (1 files used)" in p.stdout
+    assert "Broken: FAILED" in p.stdout
+    assert "ERROR: [IP_Flow 19-167] Failed to deduce top HDL module" in p.stdout
+    assert os.listdir(str(tmp_path / "ip" / "Good" / "src")) == ["mkTop.v"]
+
+def test_unchanged_core_is_reused(tmp_path):
+    env = writeIpProject(tmp_path)
+    assert runTools(tmp_path, env, ["mkVivado", "Core", "mkTop"]).returncode == 0
+    assert "ipx::infer_core" in vivadoCalls(tmp_path)
+    p = runTools(tmp_path, env, ["mkVivado", "Core", "mkTop"])
+    assert "Core is up to date." in p.stdout
+    assert vivadoCalls(tmp_path) == []
+    (tmp_path / "verilog" / "mkTop.v").write_text("module mkTop(input x);\nendmodule\n")
+    assert runTools(tmp_path, env, ["mkVivado", "Core", "mkTop"]).returncode == 0
+    assert "ipx::infer_core" in vivadoCalls(tmp_path)
+
+def test_changed_constraints_are_replaced(tmp_path):
+    env = writeIpProject(tmp_path)
+    (tmp_path / "a.xdc").write_text("# a\n")
+    (tmp_path / "b.xdc").write_text("# b\n")
+    assert runTools(tmp_path, env, ["mkVivado", "Core", "mkTop", "--constraints", "a.xdc,LATE"]).returncode == 0
+    assert packagedConstraints(tmp_path, "Core") == ["a.xdc"]
+    vivadoCalls(tmp_path)
+    p = runTools(tmp_path, env, ["mkVivado", "Core", "mkTop", "--constraints", "b.xdc,LATE"])
+    assert p.returncode == 0, p.stdout
+    assert "Updating constraints of Core" in p.stdout
+    assert "ipx::infer_core" not in vivadoCalls(tmp_path)
+    assert packagedConstraints(tmp_path, "Core") == ["b.xdc"]
+    assert os.listdir(str(tmp_path / "ip" / "Core" / "constraints")) == ["b.xdc"]
+
+def test_constraints_can_be_removed(tmp_path):
+    env = writeIpProject(tmp_path)
+    (tmp_path / "a.xdc").write_text("# a\n")
+    assert runTools(tmp_path, env, ["mkVivado", "Core", "mkTop", "--constraints", "a.xdc,LATE"]).returncode == 0
+    vivadoCalls(tmp_path)
+    p = runTools(tmp_path, env, ["mkVivado", "Core", "mkTop"])
+    assert p.returncode == 0, p.stdout
+    assert "Updating constraints of Core" in p.stdout
+    assert packagedConstraints(tmp_path, "Core") == []
+
+def test_changed_vivado_packages_again(tmp_path):
+    env = writeIpProject(tmp_path)
+    assert runTools(tmp_path, env, ["mkVivado", "Core", "mkTop"]).returncode == 0
+    vivadoCalls(tmp_path)
+    with open(str(tmp_path / "bin" / "vivado"), "a") as f:
+        f.write("\n")
+    p = runTools(tmp_path, env, ["mkVivado", "Core", "mkTop"])
+    assert p.returncode == 0, p.stdout
+    assert "ipx::infer_core" in vivadoCalls(tmp_path)
+
+def writeSources(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "plain.v").write_bytes(b"module plain();\nendmodule\n")
+    (src / "top.v").write_bytes(b'`include "../include/defs.vh"\n  `include "x.vh"\nmodule top();\nendmodule\n')
+    (src / "notes.txt").write_bytes(b"")
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    return src, dest
+
+def test_includes_are_flattened(tmp_path):
+    src, dest = writeSources(tmp_path)
+    bsvTools.copyVerilog([str(src)], str(dest), "")
+    assert sorted(os.listdir(str(dest))) == ["plain.v", "top.v"]
+    assert (dest / "top.v").read_bytes() == b'`include "defs.vh"\n`include "x.vh"\nmodule top();\nendmodule\n'
+    assert (dest / "plain.v").read_bytes() == (src / "plain.v").read_bytes()
+    # The marker spans two blocks
+    (src / "split.v").write_bytes(b'abcdef`include "x.vh"\n')
+    assert bsvTools.hasInclude(str(src / "split.v"), blockSize=10)
+    assert not bsvTools.hasInclude(str(src / "plain.v"), blockSize=10)
+
+def test_hardlinks_are_opt_in(tmp_path, monkeypatch):
+    src, dest = writeSources(tmp_path)
+    bsvTools.copyVerilog([str(src)], str(dest), "")
+    assert not os.path.samefile(str(src / "plain.v"), str(dest / "plain.v"))
+    monkeypatch.setenv("BSV_STAGE_HARDLINKS", "1")
+    bsvTools.copyVerilog([str(src)], str(dest), "")
+    assert os.path.samefile(str(src / "plain.v"), str(dest / "plain.v"))
+    # Rewritten files never share the inode of their source
+    assert not os.path.samefile(str(src / "top.v"), str(dest / "top.v"))
+    assert (src / "top.v").read_bytes().startswith(b'`include "../include/defs.vh"')
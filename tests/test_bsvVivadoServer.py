@@ -0,0 +1,74 @@
+import os
+import time
+import fcntl
+import shutil
+import stat
+import pytest
+from bsvVivadoServer import VivadoServer, serverDir
+
+tclsh = shutil.which("tclsh")
+
+def fakeVivado(directory):
+    """runs the server script with tclsh: vivado -mode batch -source <tcl> ... -tclargs <port>"""
+    path = os.path.join(directory, "vivado")
+    with open(path, "w") as f:
+        f.write('#!/bin/sh\nexec {} "$4" "$8"\n'.format(tclsh))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setenv("BSV_VIVADO_SERVER_DIR", str(tmp_path / "servers"))
+    s = VivadoServer(fakeVivado(str(tmp_path)))
+    assert s.start(timeout=20)
+    yield s
+    s.stop()
+
+def request(server, script, timeout=None):
+    lines = []
+    ret, _ = server.run(lambda project: script, lines.append, timeout=timeout)
+    return ret, lines
+
+@pytest.mark.skipif(tclsh is None, reason="needs tclsh")
+def test_requests(server, monkeypatch):
+    assert server.configured() and server.alive()
+    # Paths with spaces and braces are passed as one TCL list element
+    monkeypatch.setattr(server, "dir", os.path.join(server.dir, "a {b} c$"))
+    os.makedirs(server.dir)
+    assert request(server, 'puts "first"\n') == (0, ["first"])
+    ret, lines = request(server, 'puts "second"\nerror "broken"\n')
+    assert ret == 1
+    assert lines[0] == "second"
+    assert lines[1].endswith(":broken")
+    # The log only holds the last request
+    with open(server.log) as f:
+        assert "first" not in f.read()
+
+@pytest.mark.skipif(tclsh is None, reason="needs tclsh")
+def test_stopped_server(server):
+    server.stop()
+    assert not server.configured()
+    assert not server.alive()
+
+@pytest.mark.skipif(tclsh is None, reason="needs tclsh")
+def test_server_per_vivado(server, tmp_path):
+    assert server.alive()
+    assert serverDir(server.vivado) != serverDir(server.vivado + "2")
+    # An updated binary is not served by the running server
+    with open(server.vivado, "a") as f:
+        f.write("\n")
+    assert not server.alive()
+
+@pytest.mark.skipif(tclsh is None, reason="needs tclsh")
+def test_hanging_request_is_stopped(server):
+    start = time.monotonic()
+    ret, lines = request(server, 'puts "working"\nafter 30000\n', timeout=1)
+    assert ret == 1
+    assert time.monotonic() - start < 10
+    # Output written before the timeout is not lost with the server
+    assert lines == ["working"]
+    assert not server.alive()
+    with open(server.lockFile, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    assert server.start(timeout=20)
+    assert request(server, 'puts "again"\n') == (0, ["again"])
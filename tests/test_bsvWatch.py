@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import stat
+import time
+import queue
+import socket
+import threading
+import subprocess
+from bsvWatch import PollingWatcher
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "bsvWatch.py")
+
+fakeBsc = """#!{python}
+# Writes the .bo of the package into -bdir
+import os
+import sys
+args = sys.argv[1:]
+open(os.path.join(args[args.index("-bdir") + 1], os.path.basename(args[-1])[:-4] + ".bo"), "w").close()
+"""
+
+def test_polling_watcher(tmp_path):
+    (tmp_path / "A.bsv").write_text("package A;\nendpackage\n")
+    watcher = PollingWatcher(interval=0.05)
+    watcher.watch([str(tmp_path)])
+    assert watcher.wait(0.1) == set()
+    (tmp_path / "A.bsv").write_text("package A;\n// changed\nendpackage\n")
+    (tmp_path / "B.bsv").write_text("package B;\nendpackage\n")
+    assert watcher.wait(5) == {str(tmp_path / "A.bsv"), str(tmp_path / "B.bsv")}
+    # A change made between two waits is not lost when the directories are watched again
+    (tmp_path / "B.bsv").write_text("package B;\n// changed\nendpackage\n")
+    watcher.watch([str(tmp_path)])
+    assert watcher.wait(5) == {str(tmp_path / "B.bsv")}
+
+class Watcher:
+    """bsvWatch in polling mode on a project where A imports B"""
+    def __init__(self, tmp_path):
+        self.src = tmp_path / "src"
+        self.src.mkdir()
+        self.write("A", "import B :: *;\n")
+        self.write("B", "")
+        builddir = tmp_path / "build"
+        builddir.mkdir()
+        bsc = tmp_path / "bsc"
+        bsc.write_text(fakeBsc.format(python=sys.executable))
+        os.chmod(str(bsc), os.stat(str(bsc)).st_mode | stat.S_IXUSR)
+        self.socket = str(tmp_path / "watch.sock")
+        self.p = subprocess.Popen([sys.executable, "-u", script, "--poll", "--debounce", "0.1", "--builddir", str(builddir),
+                                   "--bsc", str(bsc), "--compile_flags", "-bdir {}".format(builddir), "--output", str(builddir / ".deps"),
+                                   "--socket", self.socket, str(self.src)], stdout=subprocess.PIPE, universal_newlines=True)
+        self.lines = queue.Queue()
+        threading.Thread(target=lambda: [self.lines.put(l.rstrip("\n")) for l in self.p.stdout], daemon=True).start()
+
+    def write(self, name, body):
+        (self.src / (name + ".bsv")).write_text("package {};\n{}// {}\nendpackage\n".format(name, body, time.time()))
+
+    def waitFor(self, prefix, timeout=20):
+        """returns the lines printed until one starting with prefix"""
+        lines = []
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                lines.append(self.lines.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+            if lines[-1].startswith(prefix):
+                return lines
+        raise AssertionError("'{}' not printed, got {}".format(prefix, lines))
+
+    def stop(self):
+        self.p.terminate()
+        self.p.wait()
+
+def test_changes_rebuild_affected_packages(tmp_path):
+    w = Watcher(tmp_path)
+    try:
+        w.waitFor("Watching 2 packages")
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(w.socket)
+        time.sleep(0.2)
+        w.write("B", "")
+        lines = w.waitFor("Build")
+        assert lines[-1].startswith("Build finished: 2 packages")
+        assert [l.split()[1] for l in lines if l.startswith("Compiled")] == ["B", "A"]
+        w.write("A", "import B :: *;\n")
+        assert w.waitFor("Build")[-1].startswith("Build finished: 1 packages")
+        f = client.makefile()
+        events = []
+        while not events or events[-1]["event"] != "build_finished":
+            events.append(json.loads(f.readline()))
+        assert events[-1]["ok"] and [e["package"] for e in events if e["event"] == "compile"] == ["B", "A"]
+        client.close()
+    finally:
+        w.stop()
+    # The socket is removed on exit
+    assert not os.path.exists(w.socket)
@@ -0,0 +1,111 @@
+import os
+import sys
+import stat
+import time
+import subprocess
+
+bsvTools = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+fakeBsc = """#!{python}
+# Logs when a package compile starts and ends and writes its .bo
+import os
+import sys
+import time
+args = sys.argv[1:]
+if "-u" in args or "-bdir" not in args:
+    sys.exit(0)
+package = os.path.basename(args[-1])[:-4]
+with open(os.environ["FAKE_BSC_LOG"], "a") as f:
+    f.write("start {{}} {{}}\\n".format(package, time.time()))
+time.sleep(0.3)
+open(os.path.join(args[args.index("-bdir") + 1], package + ".bo"), "w").close()
+with open(os.environ["FAKE_BSC_LOG"], "a") as f:
+    f.write("end {{}} {{}}\\n".format(package, time.time()))
+"""
+
+def writeProject(root, packages):
+    """packages: name -> imported packages"""
+    os.makedirs(os.path.join(root, "src"))
+    for name, imports in packages.items():
+        with open(os.path.join(root, "src", name + ".bsv"), "w") as f:
+            f.write("package {};\n{}endpackage\n".format(name, "".join("import {} :: *;\n".format(i) for i in imports)))
+    with open(os.path.join(root, "Makefile"), "w") as f:
+        f.write("TESTBENCH_MODULE=mkTestbench\nTESTBENCH_FILE=src/Testbench.bsv\ninclude {}/scripts/rules.mk\n".format(bsvTools))
+    bsc = os.path.join(root, "bsc")
+    with open(bsc, "w") as f:
+        f.write(fakeBsc.format(python=sys.executable))
+    os.chmod(bsc, os.stat(bsc).st_mode | stat.S_IXUSR)
+    return bsc
+
+def compileLog(root, bsc, args=[]):
+    """runs make compile, returns package -> (start, end)"""
+    log = os.path.join(root, "bsc.log")
+    open(log, "w").close()
+    subprocess.check_call(["make", "-s", "-j4", "compile", "BSV_TOOLS={}".format(bsvTools), "BSV={}".format(bsc)] + args,
+                          cwd=root, env=dict(os.environ, FAKE_BSC_LOG=log), stdout=subprocess.DEVNULL)
+    times = {}
+    with open(log) as f:
+        for l in f:
+            event, package, t = l.split()
+            times.setdefault(package, {})[event] = float(t)
+    return {p: (t["start"], t["end"]) for p, t in times.items()}
+
+def test_packages_compile_in_parallel_after_their_imports(tmp_path):
+    packages = {"Testbench": ["A", "B"], "A": ["C"], "B": ["C"], "C": [], "D": []}
+    root = str(tmp_path)
+    times = compileLog(root, writeProject(root, packages))
+    # D is not imported by the testbench
+    assert sorted(times) == ["A", "B", "C", "Testbench"]
+    for name, imports in packages.items():
+        for i in imports:
+            assert times[name][0] >= times[i][1], "{} started before {} finished".format(name, i)
+    # Independent packages share the make jobs
+    assert times["A"][0] < times["B"][1] and times["B"][0] < times["A"][1]
+
+def configurations(root):
+    return sorted(d for d in os.listdir(os.path.join(root, "build")) if d.isdigit())
+
+def test_build_directory_per_configuration(tmp_path):
+    root = str(tmp_path)
+    bsc = writeProject(root, {"Testbench": ["A"], "A": []})
+    assert len(compileLog(root, bsc, ["EXTRA_FLAGS=-D X=1"])) == 2
+    assert len(compileLog(root, bsc, ["EXTRA_FLAGS=-D X=2"])) == 2
+    assert len(configurations(root)) == 2
+    # Switching back reuses the objects of the first configuration
+    assert compileLog(root, bsc, ["EXTRA_FLAGS=-D X=1"]) == {}
+    assert os.path.exists(os.path.join(root, "build", "current", "A.bo"))
+
+def pruneBuilds(root, keep):
+    subprocess.check_call(["make", "-s", "prune_builds", "BSV_TOOLS={}".format(bsvTools), "BUILD_CONFIGS_KEEP={}".format(keep)],
+                          cwd=root, stdout=subprocess.DEVNULL)
+
+def test_least_recently_used_configurations_are_removed(tmp_path):
+    root = str(tmp_path)
+    bsc = writeProject(root, {"Testbench": []})
+    for x in range(3):
+        compileLog(root, bsc, ["EXTRA_FLAGS=-D X={}".format(x), "BUILD_CONFIGS_KEEP=2"])
+    # Unregistered and pruned in the background once make has exited
+    users = os.path.join(root, "build", "current", ".users")
+    deadline = time.monotonic() + 10
+    while os.listdir(users) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert not os.listdir(users)
+    assert len(configurations(root)) == 2
+
+def test_configurations_in_use_are_kept(tmp_path):
+    root = str(tmp_path)
+    bsc = writeProject(root, {"Testbench": []})
+    compileLog(root, bsc, ["EXTRA_FLAGS=-D X=1"])
+    used = configurations(root)[0]
+    # A running make has registered itself in the configuration
+    make = subprocess.Popen(["sleep", "30"])
+    try:
+        open(os.path.join(root, "build", used, ".users", str(make.pid)), "w").close()
+        compileLog(root, bsc, ["EXTRA_FLAGS=-D X=2"])
+        pruneBuilds(root, 1)
+        assert used in configurations(root)
+    finally:
+        make.kill()
+        make.wait()
+    pruneBuilds(root, 1)
+    assert used not in configurations(root)